@@ -422,7 +422,62 @@ def stateless_property(func):
         doc=func.__doc__)
 
 
-class PropertyHolder(qubes.events.Emitter):
+class PropertyHolderMeta(qubes.events.EmitterMeta):
+    '''Metaclass for :py:class:`PropertyHolder`
+
+    Properties of each class are collected once and cached (see
+    :py:meth:`PropertyHolder.property_list`). Adding or removing a property
+    after a class was created invalidates caches of all classes, as
+    subclasses inherit it.
+    '''
+
+    #: incremented on each change of properties of any class
+    generation = 0
+
+    def __setattr__(cls, name, value):
+        old_value = cls.__dict__.get(name)
+        super(PropertyHolderMeta, cls).__setattr__(name, value)
+        if isinstance(value, property) or isinstance(old_value, property):
+            PropertyHolderMeta.generation += 1
+
+    def __delattr__(cls, name):
+        old_value = cls.__dict__.get(name)
+        super(PropertyHolderMeta, cls).__delattr__(name)
+        if isinstance(old_value, property):
+            PropertyHolderMeta.generation += 1
+
+
+class _PropertyTable(object):
+    '''Properties of one class, as cached by :py:class:`PropertyHolderMeta`'''
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, cls):
+        self.generation = PropertyHolderMeta.generation
+
+        props = set()
+        for class_ in cls.__mro__:
+            props.update(prop for prop in class_.__dict__.values()
+                if isinstance(prop, property))
+
+        #: all properties, sorted
+        self.props = tuple(sorted(props))
+
+        #: properties by load stage, sorted
+        self.by_stage = {}
+        for prop in self.props:
+            self.by_stage.setdefault(prop.load_stage, []).append(prop)
+        for stage in self.by_stage:
+            self.by_stage[stage] = tuple(self.by_stage[stage])
+
+        #: names of properties by load stage
+        self.names_by_stage = {stage: frozenset(prop.__name__ for prop in props)
+            for stage, props in self.by_stage.items()}
+
+        #: properties by name
+        self.by_name = {prop.__name__: prop for prop in self.props}
+
+
+class PropertyHolder(qubes.events.Emitter, metaclass=PropertyHolderMeta):
     '''Abstract class for holding :py:class:`qubes.property`
 
     Events fired by instances of this class:
@@ -483,7 +538,7 @@ class PropertyHolder(qubes.events.Emitter):
 
         propvalues = {}
 
-        all_names = set(prop.__name__ for prop in self.property_list())
+        all_names = self._property_table().by_name
         for key in list(kwargs):
             if not key in all_names:
                 continue
@@ -496,8 +551,6 @@ class PropertyHolder(qubes.events.Emitter):
 
         if self.xml is not None:
             # check if properties are appropriate
-            all_names = set(prop.__name__ for prop in self.property_list())
-
             for node in self.xml.xpath('./properties/property'):
                 name = node.get('name')
                 if name not in all_names:
@@ -505,6 +558,18 @@ class PropertyHolder(qubes.events.Emitter):
                         'property {!r} not applicable to {!r}'.format(
                             name, self.__class__.__name__))
 
+    @classmethod
+    def _property_table(cls):
+        '''Return (cached) :py:class:`_PropertyTable` of this class'''
+
+        # look only into this very class, not into its bases
+        table = cls.__dict__.get('_property_table_cache')
+        if table is None or table.generation != PropertyHolderMeta.generation:
+            table = _PropertyTable(cls)
+            # bypass the metaclass, this is not a property
+            type.__setattr__(cls, '_property_table_cache', table)
+        return table
+
     @classmethod
     def property_list(cls, load_stage=None):
         '''List all properties attached to this VM's class
@@ -513,14 +578,10 @@ class PropertyHolder(qubes.events.Emitter):
         :type load_stage: :py:func:`int` or :py:obj:`None`
         '''
 
-        props = set()
-        for class_ in cls.__mro__:
-            props.update(prop for prop in class_.__dict__.values()
-                if isinstance(prop, property))
-        if load_stage is not None:
-            props = set(prop for prop in props
-                if prop.load_stage == load_stage)
-        return sorted(props)
+        table = cls._property_table()
+        if load_stage is None:
+            return list(table.props)
+        return list(table.by_stage.get(load_stage, ()))
 
     def _property_init(self, prop, value):
         '''Initialise property to a given value, without side effects.
@@ -566,12 +627,11 @@ class PropertyHolder(qubes.events.Emitter):
         if isinstance(prop, qubes.property):
             return prop
 
-        for p in cls.property_list():
-            if p.__name__ == prop:
-                return p
-
-        raise AttributeError('No property {!r} found in {!r}'.format(
-            prop, cls))
+        try:
+            return cls._property_table().by_name[prop]
+        except KeyError:
+            raise AttributeError('No property {!r} found in {!r}'.format(
+                prop, cls))
 
 
     def load_properties(self, load_stage=None):
@@ -584,8 +644,11 @@ class PropertyHolder(qubes.events.Emitter):
 
         if self.xml is None:
             return
-        all_names = set(
-            prop.__name__ for prop in self.property_list(load_stage))
+        table = self._property_table()
+        if load_stage is None:
+            all_names = table.by_name
+        else:
+            all_names = table.names_by_stage.get(load_stage, frozenset())
         for node in self.xml.xpath('./properties/property'):
             name = node.get('name')
             value = node.get('ref') or node.text
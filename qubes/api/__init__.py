@@ -20,15 +20,20 @@
 # with this program; if not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
+import collections
 import errno
 import functools
 import io
+import math
 import os
 import shutil
 import socket
 import struct
+import time
 import traceback
 
+import qubes.api.scheduler
+import qubes.events
 import qubes.exc
 
 class ProtocolError(AssertionError):
@@ -85,6 +90,38 @@ def method(name, *, no_payload=False, endpoints=None):
     return decorator
 
 
+class StreamedResponse(object):
+    '''Reply of an API call, sent piece by piece as it is produced.
+
+    Return it from an API method instead of :py:class:`str`, to not build
+    whole (possibly big) reply in memory first. Permission checks which may
+    refuse the whole call have to be done before returning, as by the time
+    *chunks* are produced, the client was already told about success.
+
+    The next chunk is taken only when the client keeps up with receiving
+    the previous ones, so a slow client does not make qubesd buffer the
+    whole reply anyway. An item of *chunks* may also be a coroutine (or
+    a future) returning :py:class:`str`, which is waited for before taking
+    the next one. This way a generator can produce chunks which need
+    asynchronous operations, and clients get the ones which are ready::
+
+        def lines(self):
+            for vm in domains:
+                yield self.describe(vm)  # coroutine
+
+        return qubes.api.StreamedResponse(lines())
+
+    :param chunks: iterable of :py:class:`str` or of coroutines
+    '''
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+
 def apply_filters(iterable, filters):
     '''Apply filters returned by mgmt-permission:... event'''
     for selector in filters:
@@ -92,6 +129,142 @@ def apply_filters(iterable, filters):
     return iterable
 
 
+def compile_filters(filters):
+    '''Combine filters returned by mgmt-permission:... event into a single
+    predicate, to be applied to many items one by one.
+
+    :returns: callable, or :py:obj:`None` if there are no filters
+    '''
+    filters = tuple(filters)
+    if not filters:
+        return None
+    if len(filters) == 1:
+        return filters[0]
+    return lambda item: all(selector(item) for selector in filters)
+
+
+class MethodStats(object):
+    '''Statistics of calls of one API method'''
+    # pylint: disable=too-few-public-methods
+    __slots__ = ('latency', 'errors', 'payload_bytes')
+
+    def __init__(self):
+        #: :py:class:`qubes.events.HandlerStats` of the whole calls,
+        #: including sending the reply
+        self.latency = qubes.events.HandlerStats()
+        #: number of calls which failed
+        self.errors = 0
+        #: total size of payloads of the calls
+        self.payload_bytes = 0
+
+    def __str__(self):
+        return '{} errors={} payload={}'.format(self.latency, self.errors,
+            self.payload_bytes)
+
+
+class CallStats(object):
+    '''Statistics of API calls, per method.
+
+    Every call handled by :py:class:`QubesDaemonProtocol` is recorded. This
+    happens only in the thread running the event loop, so no locking is
+    needed and recording a call is just a few additions.
+
+    Calls rejected before the method was found (unknown method, source or
+    destination) are recorded under ``invalid`` name, to not let clients
+    make up new entries.
+    '''
+
+    def __init__(self):
+        #: method name -> :py:class:`MethodStats`
+        self.methods = collections.defaultdict(MethodStats)
+
+    def clear(self):
+        '''Forget all the statistics collected so far'''
+        self.methods.clear()
+
+    def record(self, method_name, elapsed, payload_size, failed):
+        '''Record single call of *method_name*, which took *elapsed*
+        seconds'''
+        stats = self.methods[method_name]
+        stats.latency.record(elapsed)
+        stats.payload_bytes += payload_size
+        if failed:
+            stats.errors += 1
+
+    def format_stats(self):
+        '''Statistics as text, one line per method, sorted by name::
+
+            method <method> count=<n> total=<seconds> histogram=<buckets> \\
+                errors=<n> payload=<bytes>
+
+        where ``<buckets>`` are like in
+        :py:meth:`qubes.events.EventProfiler.format_stats`.
+        '''
+        return ''.join('method {} {}\n'.format(name, stats)
+            for name, stats in sorted(self.methods.items()))
+
+    def format_prometheus(self):
+        '''Statistics in Prometheus text exposition format'''
+        methods = sorted(self.methods.items())
+        lines = [
+            '# HELP qubesd_calls_total Number of API calls.\n',
+            '# TYPE qubesd_calls_total counter\n',
+        ]
+        lines.extend('qubesd_calls_total{{method="{}"}} {}\n'.format(
+            name, stats.latency.count) for name, stats in methods)
+        lines.extend([
+            '# HELP qubesd_call_errors_total Number of failed API calls.\n',
+            '# TYPE qubesd_call_errors_total counter\n',
+        ])
+        lines.extend('qubesd_call_errors_total{{method="{}"}} {}\n'.format(
+            name, stats.errors) for name, stats in methods)
+        lines.extend([
+            '# HELP qubesd_call_payload_bytes_total Total size of payloads '
+                'of API calls.\n',
+            '# TYPE qubesd_call_payload_bytes_total counter\n',
+        ])
+        lines.extend(
+            'qubesd_call_payload_bytes_total{{method="{}"}} {}\n'.format(
+                name, stats.payload_bytes) for name, stats in methods)
+        lines.extend([
+            '# HELP qubesd_call_duration_seconds Duration of API calls.\n',
+            '# TYPE qubesd_call_duration_seconds histogram\n',
+        ])
+        for name, stats in methods:
+            cumulative = 0
+            for bound, count in zip(stats.latency.buckets,
+                    stats.latency.histogram):
+                cumulative += count
+                lines.append('qubesd_call_duration_seconds_bucket'
+                    '{{method="{}",le="{}"}} {}\n'.format(name,
+                        '+Inf' if bound == math.inf else bound, cumulative))
+            lines.append('qubesd_call_duration_seconds_sum{{method="{}"}} '
+                '{:.6f}\n'.format(name, stats.latency.total))
+            lines.append('qubesd_call_duration_seconds_count{{method="{}"}} '
+                '{}\n'.format(name, stats.latency.count))
+        return ''.join(lines)
+
+
+#: statistics of API calls handled by this process
+call_stats = CallStats()
+
+
+def write_prometheus(path):
+    '''Write statistics of :py:data:`call_stats` and
+    :py:data:`qubes.api.scheduler.call_scheduler` to *path*, for textfile
+    collector of Prometheus node exporter.
+
+    The file is replaced atomically, so the collector never sees it
+    half-written.
+    '''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as stats_file:
+        stats_file.write(call_stats.format_prometheus())
+        stats_file.write(
+            qubes.api.scheduler.call_scheduler.format_prometheus())
+    os.rename(tmp_path, path)
+
+
 class AbstractQubesAPI(object):
     '''Common code for Qubes Management Protocol handling
 
@@ -111,7 +284,17 @@ class AbstractQubesAPI(object):
     #: the preferred socket location (to be overridden in child's class)
     SOCKNAME = None
 
-    def __init__(self, app, src, method_name, dest, arg, send_event=None):
+    #: short name of the interface, for configuration of
+    #: :py:mod:`qubes.api.scheduler` (to be overridden in child's class)
+    API_NAME = None
+
+    #: if :py:obj:`True`, the call returns only after changes it saved are
+    #: written to :file:`qubes.xml` (see :py:meth:`qubes.Qubes.save_barrier`);
+    #: otherwise the write may happen later
+    wait_for_save = True
+
+    def __init__(self, app, src, method_name, dest, arg, send_event=None,
+            drain_events=None):
         #: :py:class:`qubes.Qubes` object
         self.app = app
 
@@ -130,6 +313,10 @@ class AbstractQubesAPI(object):
         #: callback for sending events if applicable
         self.send_event = send_event
 
+        #: coroutine function waiting until the client receives events sent
+        #: so far, if applicable
+        self.drain_events = drain_events
+
         #: is this operation cancellable?
         self.cancellable = False
 
@@ -169,10 +356,20 @@ class AbstractQubesAPI(object):
         kwargs = {}
         if endpoint is not None:
             kwargs['endpoint'] = endpoint
-        self._running_handler = asyncio.ensure_future(handler(
-            untrusted_payload=untrusted_payload, **kwargs))
+        self._running_handler = asyncio.ensure_future(self._execute_handler(
+            handler, untrusted_payload=untrusted_payload, **kwargs))
         return self._running_handler
 
+    @asyncio.coroutine
+    def _execute_handler(self, handler, **kwargs):
+        save_requests = self.app.save_requests
+        response = yield from handler(**kwargs)
+        if self.wait_for_save and self.app.save_requests != save_requests:
+            # group commit: share the write with other concurrent calls, but
+            # do not report success before the data is on disk
+            yield from self.app.save_barrier()
+        return response
+
     def cancel(self):
         '''If operation is cancellable, interrupt it'''
         if self.cancellable and self._running_handler is not None:
@@ -190,9 +387,85 @@ class AbstractQubesAPI(object):
             self.fire_event_for_permission(**kwargs))
 
 
+#: first bytes sent by a client choosing the pipelined framing (see
+#: :py:class:`QubesDaemonProtocol`), followed by a version byte; qube names
+#: never start with 0xff, so this cannot be taken for the original framing
+PIPELINED_MAGIC = b'\xffqubesd'
+
+#: version of the pipelined framing
+PIPELINED_VERSION = 1
+
+
+class PipelinedCallTransport(object):
+    '''Transport of a single call on a connection using the pipelined
+    framing.
+
+    Whatever the call writes is sent in frames tagged with its request id,
+    closing the transport sends the empty frame ending the reply. Where the
+    original framing would abort the connection without a reply, just the
+    empty frame is sent, so other calls on the connection are not affected.
+    Only a reply which failed half-way aborts the whole connection, as the
+    client would not be able to tell it is incomplete.
+    '''
+
+    def __init__(self, protocol, request_id):
+        self.protocol = protocol
+        self.request_id = request_id
+        self.data_sent = False
+        self.closed = False
+
+    def write(self, data):
+        if not data:
+            # empty frame would end the reply
+            return
+        self.data_sent = True
+        self.protocol.send_frame(self.request_id, data)
+
+    def write_eof(self):
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.protocol.send_frame(self.request_id, b'')
+        self.protocol.call_finished(self.request_id)
+
+    def abort(self):
+        if not self.data_sent:
+            self.close()
+            return
+        self.closed = True
+        self.protocol.call_finished(self.request_id)
+        if self.protocol.transport is not None:
+            self.protocol.transport.abort()
+
+    def is_closing(self):
+        return self.closed
+
+
 class QubesDaemonProtocol(asyncio.Protocol):
+    '''Protocol of qubesd sockets.
+
+    In the original framing, a connection carries a single call: the client
+    sends ``src\\0method\\0dest\\0arg\\0payload`` and EOF, then reads
+    the reply until EOF.
+
+    A client which wants to make many calls over one connection starts
+    with :py:data:`PIPELINED_MAGIC` and :py:data:`PIPELINED_VERSION` byte,
+    which the server sends back. Then each call is a frame of
+    :py:attr:`frame_header` (request id and length of the rest, both 32-bit
+    big endian), followed by the same content as in the original framing.
+    Calls are executed concurrently, so a client does not need to wait for
+    a reply before sending the next request. Replies are sent as frames
+    with the same header, tagged with id of the request; the concatenated
+    content of the frames is the reply in the original framing, and an empty
+    frame ends it. Request ids of calls in progress need to be unique.
+    '''
+
     buffer_size = 65536
     header = struct.Struct('Bx')
+    frame_header = struct.Struct('!II')
 
     def __init__(self, handler, *args, app, debug=False, **kwargs):
         super().__init__(*args, **kwargs)
@@ -204,6 +477,14 @@ class QubesDaemonProtocol(asyncio.Protocol):
         self.debug = debug
         self.event_sent = False
         self.mgmt = None
+        #: :py:class:`qubes.api.scheduler.CallSlot` of the call in progress
+        self.slot = None
+        #: calls in progress, by request id (pipelined framing only)
+        self.calls = None
+        self.untrusted_frames = None
+        self.eof = False
+        #: future done when the transport accepts data again, if paused
+        self.write_resumed = None
 
     def connection_made(self, transport):
         self.transport = transport
@@ -213,9 +494,18 @@ class QubesDaemonProtocol(asyncio.Protocol):
         # for cancellable operation, interrupt it, otherwise it will do nothing
         if self.mgmt is not None:
             self.mgmt.cancel()
+        if self.calls:
+            for call in list(self.calls.values()):
+                call.connection_lost(exc)
         self.transport = None
+        # wake up the writer, to notice the connection is gone
+        self.resume_writing()
 
     def data_received(self, untrusted_data):  # pylint: disable=arguments-differ
+        if self.calls is not None:
+            self.pipelined_data_received(untrusted_data)
+            return
+
         if self.len_untrusted_buffer + len(untrusted_data) > self.buffer_size:
             self.app.log.warning('request too long')
             self.transport.abort()
@@ -225,7 +515,88 @@ class QubesDaemonProtocol(asyncio.Protocol):
         self.len_untrusted_buffer += \
             self.untrusted_buffer.write(untrusted_data)
 
+        if self.len_untrusted_buffer - len(untrusted_data) \
+                <= len(PIPELINED_MAGIC):
+            # still within the beginning, which tells the framing
+            self.check_pipelined()
+
+    def check_pipelined(self):
+        '''Switch to the pipelined framing, if the client asks for it'''
+        untrusted_data = self.untrusted_buffer.getvalue()
+        if untrusted_data[:1] != PIPELINED_MAGIC[:1]:
+            return
+        preamble_len = len(PIPELINED_MAGIC) + 1
+        if len(untrusted_data) < preamble_len:
+            return
+        if untrusted_data[:preamble_len] != \
+                PIPELINED_MAGIC + bytes([PIPELINED_VERSION]):
+            self.app.log.warning('unsupported protocol version')
+            self.transport.abort()
+            return
+
+        self.untrusted_buffer.close()
+        self.calls = {}
+        self.untrusted_frames = bytearray()
+        self.transport.write(PIPELINED_MAGIC + bytes([PIPELINED_VERSION]))
+        self.pipelined_data_received(untrusted_data[preamble_len:])
+
+    def pipelined_data_received(self, untrusted_data):
+        self.untrusted_frames += untrusted_data
+        while self.transport is not None \
+                and len(self.untrusted_frames) >= self.frame_header.size:
+            request_id, untrusted_len = self.frame_header.unpack_from(
+                self.untrusted_frames)
+            if untrusted_len > self.buffer_size:
+                self.app.log.warning('request too long')
+                self.transport.abort()
+                return
+            frame_len = self.frame_header.size + untrusted_len
+            if len(self.untrusted_frames) < frame_len:
+                return
+            untrusted_request = bytes(
+                self.untrusted_frames[self.frame_header.size:frame_len])
+            del self.untrusted_frames[:frame_len]
+
+            if request_id in self.calls:
+                self.app.log.warning('duplicate request id')
+                self.transport.abort()
+                return
+            try:
+                src, meth, dest, arg, untrusted_payload = \
+                    untrusted_request.split(b'\0', 4)
+            except ValueError:
+                self.app.log.warning('framing error')
+                self.transport.abort()
+                return
+
+            call = QubesDaemonProtocol(self.handler,
+                app=self.app, debug=self.debug)
+            call.connection_made(PipelinedCallTransport(self, request_id))
+            if self.write_resumed is not None:
+                call.pause_writing()
+            self.calls[request_id] = call
+            asyncio.ensure_future(call.respond(
+                src, meth, dest, arg, untrusted_payload=untrusted_payload))
+
+    def send_frame(self, request_id, data):
+        if self.transport is None:
+            return
+        self.transport.write(
+            self.frame_header.pack(request_id, len(data)) + data)
+
+    def call_finished(self, request_id):
+        del self.calls[request_id]
+        if self.eof and not self.calls and self.transport is not None:
+            self.transport.close()
+
     def eof_received(self):
+        if self.calls is not None:
+            # finish calls in progress, then close
+            self.eof = True
+            if not self.calls:
+                self.transport.close()
+            return True
+
         try:
             src, meth, dest, arg, untrusted_payload = \
                 self.untrusted_buffer.getvalue().split(b'\0', 4)
@@ -243,14 +614,41 @@ class QubesDaemonProtocol(asyncio.Protocol):
 
     @asyncio.coroutine
     def respond(self, src, meth, dest, arg, *, untrusted_payload):
+        # the source is not verified yet, but it is used only as a key (and
+        # qrexec is who sets it anyway)
+        self.slot = yield from qubes.api.scheduler.call_scheduler.acquire(
+            src.decode('ascii', 'replace'), self.handler.API_NAME)
+        if self.transport is None:
+            # the client has gone while the call was waiting for its turn
+            self.slot.release()
+            return
+
+        start = time.perf_counter()
+        failed = True
+        try:
+            failed = not (yield from self._respond(src, meth, dest, arg,
+                untrusted_payload=untrusted_payload))
+        finally:
+            self.slot.release()
+            # the method name is trusted only if the handler accepted it
+            call_stats.record(
+                'invalid' if self.mgmt is None else meth.decode('ascii'),
+                time.perf_counter() - start, len(untrusted_payload), failed)
+
+    @asyncio.coroutine
+    def _respond(self, src, meth, dest, arg, *, untrusted_payload):
+        '''Handle the call and send the reply
+
+        :returns: :py:obj:`True` if the call succeeded
+        '''
         try:
             self.mgmt = self.handler(self.app, src, meth, dest, arg,
-                self.send_event)
+                self.send_event, drain_events=self.drain)
             response = yield from self.mgmt.execute(
                 untrusted_payload=untrusted_payload)
             assert not (self.event_sent and response)
             if self.transport is None:
-                return
+                return True
 
         # except clauses will fall through to transport.abort() below
 
@@ -280,7 +678,7 @@ class QubesDaemonProtocol(asyncio.Protocol):
                 self.send_exception(err)
                 self.transport.write_eof()
                 self.transport.close()
-            return
+            return False
 
         except Exception:  # pylint: disable=broad-except
             self.app.log.exception(
@@ -290,40 +688,119 @@ class QubesDaemonProtocol(asyncio.Protocol):
 
         else:
             if not self.event_sent:
-                self.send_response(response)
+                try:
+                    yield from self.send_response(response)
+                except Exception:  # pylint: disable=broad-except
+                    # streamed reply failed half-way, the client has no way
+                    # to tell, other than by the connection being aborted
+                    self.app.log.exception(
+                        'unhandled exception while sending reply of '
+                        'src=%r meth=%r dest=%r arg=%r', src, meth, dest, arg)
+                    if self.transport is not None:
+                        self.transport.abort()
+                    return False
+                if self.transport is None:
+                    return True
             try:
                 self.transport.write_eof()
             except NotImplementedError:
                 pass
             self.transport.close()
-            return
+            return True
 
         # this is reached if from except: blocks; do not put it in finally:,
         # because this will prevent the good case from sending the reply
         self.transport.abort()
+        return False
 
     def send_header(self, *args):
         self.transport.write(self.header.pack(*args))
 
+    def pause_writing(self):
+        if self.write_resumed is None:
+            self.write_resumed = asyncio.get_event_loop().create_future()
+        if self.calls:
+            for call in self.calls.values():
+                call.pause_writing()
+
+    def resume_writing(self):
+        if self.write_resumed is not None:
+            self.write_resumed.set_result(None)
+            self.write_resumed = None
+        if self.calls:
+            for call in list(self.calls.values()):
+                call.resume_writing()
+
+    @asyncio.coroutine
+    def drain(self):
+        '''Wait until the client catches up with the data sent so far'''
+        if self.write_resumed is not None:
+            yield from asyncio.shield(self.write_resumed)
+
+    @asyncio.coroutine
     def send_response(self, content):
+        '''Send successful reply.
+
+        This method is a coroutine.
+
+        :param content: :py:class:`str` or :py:class:`StreamedResponse`
+        '''
         assert not self.event_sent
-        self.send_header(0x30)
-        if content is not None:
-            self.transport.write(content.encode('utf-8'))
+        if content is None:
+            self.send_header(0x30)
+            return
+        if not isinstance(content, StreamedResponse):
+            self.transport.write(
+                self.header.pack(0x30) + content.encode('utf-8'))
+            return
+        # small chunks are joined, to not make a syscall for each of them
+        pending = [self.header.pack(0x30)]
+        pending_size = 0
+        for chunk in content:
+            if not isinstance(chunk, str):
+                # let the client have what is ready before waiting
+                yield from self._send_chunks(pending)
+                pending, pending_size = [], 0
+                chunk = yield from chunk
+            if self.transport is None:
+                # connection lost in the meantime
+                return
+            data = chunk.encode('utf-8')
+            pending.append(data)
+            pending_size += len(data)
+            if pending_size >= self.buffer_size:
+                yield from self._send_chunks(pending)
+                pending, pending_size = [], 0
+        yield from self._send_chunks(pending)
+
+    @asyncio.coroutine
+    def _send_chunks(self, chunks):
+        if chunks and self.transport is not None:
+            self.transport.write(b''.join(chunks))
+            yield from self.drain()
 
     def send_event(self, subject, event, **kwargs):
+        if not self.event_sent and self.slot is not None:
+            # the call lasts until the client disconnects, do not count it
+            # as executing all that time
+            self.slot.release()
         self.event_sent = True
-        self.send_header(0x31)
+        if self.transport is None:
+            # connection lost in the meantime
+            return
 
+        # written at once, to not split it into many frames when pipelined
+        data = [self.header.pack(0x31)]
         if subject is not self.app:
-            self.transport.write(subject.name.encode('ascii'))
-        self.transport.write(b'\0')
+            data.append(subject.name.encode('ascii'))
+        data.append(b'\0')
 
-        self.transport.write(event.encode('ascii') + b'\0')
+        data.append(event.encode('ascii') + b'\0')
 
         for k, v in kwargs.items():
-            self.transport.write('{}\0{}\0'.format(k, str(v)).encode('ascii'))
-        self.transport.write(b'\0')
+            data.append('{}\0{}\0'.format(k, str(v)).encode('ascii'))
+        data.append(b'\0')
+        self.transport.write(b''.join(data))
 
     def send_exception(self, exc):
         self.send_header(0x32)
@@ -23,45 +23,331 @@ Qubes OS Management API
 '''
 
 import asyncio
+import binascii
+import collections
+import fnmatch
+import re
 import string
 import itertools
-import pkg_resources
+import os
+import weakref
 import libvirt
 
 import qubes.api
 import qubes.devices
+import qubes.events
+import qubes.exc
 import qubes.storage
 import qubes.utils
 import qubes.vm
 import qubes.vm.qubesvm
 
 
-class QubesMgmtEventsDispatcher(object):
-    def __init__(self, filters, send_event):
-        self.filters = filters
+class EventSubscriber(object):
+    '''Single ``admin.Events`` call, receiving events from
+    :py:class:`EventBus`.
+
+    Events are queued and sent by :py:meth:`run`, which waits for the client
+    to receive them, so a slow client does not make qubesd buffer unlimited
+    amount of data. When the queue is full, :py:attr:`EventBus.overflow`
+    policy applies.
+
+    :param EventBus bus: the bus
+    :param dest: qube to receive events of, or :py:obj:`None` for all of \
+        them and of the app
+    :param filters: filters returned by ``mgmt-permission:admin.Events``
+    :param send_event: callback sending an event to the client
+    :param drain_events: coroutine function waiting until the client \
+        receives events sent so far
+    :param bool send_seq: add position of each event in the stream (see \
+        :py:attr:`EventBus.token`) as ``seq`` argument
+    '''
+
+    def __init__(self, bus, dest, filters, send_event, drain_events=None,
+            send_seq=False):
+        self.bus = bus
+        self.dest = dest
+        self.accepts = qubes.api.compile_filters(filters)
         self.send_event = send_event
+        self.drain_events = drain_events
+        self.send_seq = send_seq
+        #: queued events, as lists [subject, event, kwargs, seq]
+        self.queue = collections.deque()
+        #: the last queued event of given subject and name (for coalescing)
+        self.queued = {}
+        #: number of events dropped since the last report to the client
+        self.dropped = 0
+        self.disconnected = False
+        self.wakeup = None
+
+    def deliver(self, subject, event, kwargs, seq=None):
+        '''Queue an event, if the subscriber is interested in it'''
+        if self.disconnected:
+            return
+        if self.accepts is not None \
+                and not self.accepts((subject, event, kwargs)):
+            return
 
-    def vm_handler(self, subject, event, **kwargs):
-        if event.startswith('mgmt-permission:'):
+        if len(self.queue) >= self.bus.queue_size:
+            self.on_overflow(subject, event, kwargs, seq)
             return
-        if not list(qubes.api.apply_filters([(subject, event, kwargs)],
-                self.filters)):
+
+        entry = [subject, event, kwargs, seq]
+        self.queue.append(entry)
+        self.queued[subject, event] = entry
+        self.wake()
+
+    def on_overflow(self, subject, event, kwargs, seq):
+        if self.bus.overflow == 'coalesce':
+            try:
+                entry = self.queued[subject, event]
+            except KeyError:
+                # nothing to coalesce with, drop it
+                pass
+            else:
+                if self.send_seq:
+                    # keep events sent in order of their sequence numbers,
+                    # the client resumes after the last one it got
+                    self.queue.remove(entry)
+                    entry = [subject, event, kwargs, seq]
+                    self.queue.append(entry)
+                    self.queued[subject, event] = entry
+                else:
+                    entry[2:] = kwargs, seq
+                return
+
+        if self.bus.overflow == 'disconnect':
+            self.bus.app.log.warning(
+                'admin.Events client too slow, disconnecting it')
+            self.disconnected = True
+            self.queue.clear()
+            self.queued.clear()
+            self.wake()
             return
-        self.send_event(subject, event, **kwargs)
 
-    def app_handler(self, subject, event, **kwargs):
-        if not list(qubes.api.apply_filters([(subject, event, kwargs)],
-                self.filters)):
+        self.dropped += 1
+
+    def wake(self):
+        if self.wakeup is not None and not self.wakeup.done():
+            self.wakeup.set_result(None)
+
+    def pop(self):
+        entry = self.queue.popleft()
+        subject, event, kwargs, seq = entry
+        if self.queued.get((subject, event)) is entry:
+            del self.queued[subject, event]
+        if self.send_seq and seq is not None:
+            kwargs = dict(kwargs, seq='{}-{}'.format(self.bus.epoch, seq))
+        return subject, event, kwargs
+
+    @asyncio.coroutine
+    def run(self):
+        '''Send events, until the subscriber gets disconnected because of
+        overflowing its queue.
+
+        This method is a coroutine. When cancelled, events queued so far are
+        still sent.
+        '''
+        try:
+            while not self.disconnected:
+                while self.queue:
+                    subject, event, kwargs = self.pop()
+                    self.send_event(subject, event, **kwargs)
+                    if self.drain_events is not None:
+                        yield from self.drain_events()
+                if self.dropped:
+                    if self.send_seq:
+                        # the dropped events cannot be replayed after
+                        # resuming past them
+                        self.send_event(self.bus.app, 'events-resync')
+                    else:
+                        self.send_event(self.bus.app, 'events-dropped',
+                            count=self.dropped)
+                    self.dropped = 0
+                    continue
+                self.wakeup = asyncio.get_event_loop().create_future()
+                yield from self.wakeup
+        except asyncio.CancelledError:
+            while self.queue:
+                subject, event, kwargs = self.pop()
+                self.send_event(subject, event, **kwargs)
+            raise
+
+
+class EventBus(object):
+    '''Dispatcher of events to ``admin.Events`` subscribers.
+
+    Events are received once, by a single handler on the app and each of
+    the qubes, regardless of the number of subscribers, and passed to those
+    interested in them (see :py:class:`EventSubscriber`). The handlers are
+    registered only while there are any subscribers.
+
+    Each event gets a sequence number and, if enabled, the last
+    :py:attr:`history_size` of them are kept, so a client reconnecting after
+    losing its connection can get the events it has missed instead of
+    listing everything again (see :py:meth:`replay`). To not miss any events
+    for such clients, the handlers stay registered after the last
+    subscriber is gone, so then every event of every qube is recorded for
+    the rest of the process, even with no subscribers. Without the history,
+    tokens issued before the handlers were unregistered are not valid
+    anymore.
+
+    Use :py:meth:`for_app` to get the bus of an app.
+    '''
+
+    #: maximum number of events queued for a single subscriber
+    queue_size = 10000
+
+    #: what to do with an event for subscriber with full queue:
+    #: ``'drop'`` it (the client is told about number of dropped events with
+    #: ``events-dropped`` event later, or with ``events-resync`` if it gets
+    #: sequence numbers of events), ``'coalesce'`` it with the queued
+    #: event of the same subject and name, if any (otherwise drop it),
+    #: or ``'disconnect'`` the client
+    overflow = 'disconnect'
+
+    overflow_policies = ('drop', 'coalesce', 'disconnect')
+
+    #: number of recent events kept for :py:meth:`replay`; ``0`` disables
+    #: the history
+    history_size = 0
+
+    _buses = weakref.WeakKeyDictionary()
+
+    def __init__(self, app):
+        self.app = app
+        #: subscribers by qube, those of all qubes under :py:obj:`None`
+        self.subscribers = {}
+        self.handlers_registered = False
+        #: identifier of this bus, to not take sequence numbers issued by
+        #: another qubesd instance as ours
+        self.epoch = self._new_epoch()
+        #: sequence number of the last event
+        self.seq = 0
+        #: recent events, as tuples (seq, subject name, event, kwargs);
+        #: the subject name is :py:obj:`None` for the app and values of
+        #: kwargs are converted to :py:class:`str`, as when sent to the
+        #: client, to not keep the objects alive
+        self.history = collections.deque(maxlen=self.history_size)
+
+    @classmethod
+    def for_app(cls, app):
+        '''Get the event bus of *app*, creating it if needed'''
+        try:
+            return cls._buses[app]
+        except KeyError:
+            bus = cls._buses[app] = cls(app)
+            return bus
+
+    @staticmethod
+    def _new_epoch():
+        return binascii.hexlify(os.urandom(4)).decode('ascii')
+
+    @property
+    def token(self):
+        '''Token of the current position in the event stream, to be passed
+        to :py:meth:`replay`'''
+        return '{}-{}'.format(self.epoch, self.seq)
+
+    def subscribe(self, subscriber):
+        if not self.handlers_registered:
+            self.app.add_handler('*', self.on_app_event)
+            self.app.add_handler('domain-add', self.on_domain_add)
+            self.app.add_handler('domain-delete', self.on_domain_delete)
+            for vm in self.app.domains:
+                vm.add_handler('*', self.on_vm_event)
+            self.handlers_registered = True
+        self.subscribers.setdefault(subscriber.dest, []).append(subscriber)
+
+    def unsubscribe(self, subscriber):
+        subscribers = self.subscribers[subscriber.dest]
+        subscribers.remove(subscriber)
+        if not subscribers:
+            del self.subscribers[subscriber.dest]
+        if not self.subscribers and not self.history_size:
+            self.app.remove_handler('*', self.on_app_event)
+            self.app.remove_handler('domain-add', self.on_domain_add)
+            self.app.remove_handler('domain-delete', self.on_domain_delete)
+            for vm in self.app.domains:
+                vm.remove_handler('*', self.on_vm_event)
+            self.handlers_registered = False
+            # events are not counted from now on, so tokens issued so far
+            # cannot tell whether any were missed
+            self.epoch = self._new_epoch()
+
+    def record(self, subject, event, kwargs):
+        '''Give the event a sequence number and store it in the history
+
+        :returns: the sequence number
+        '''
+        self.seq += 1
+        if self.history.maxlen != self.history_size:
+            self.history = collections.deque(self.history,
+                maxlen=self.history_size)
+        if self.history_size:
+            self.history.append((self.seq,
+                None if subject is self.app else subject.name, event,
+                {key: str(value) for key, value in kwargs.items()}))
+        return self.seq
+
+    def replay(self, subscriber, token):
+        '''Deliver to *subscriber* events recorded after *token* was
+        obtained (from :py:attr:`token`, or ``seq`` argument of an event
+        sent to a subscriber).
+
+        Events of qubes removed in the meantime are skipped, and values of
+        arguments are delivered as strings.
+
+        :returns: :py:obj:`False` if some of those events are not available
+            (the history has wrapped, or the token was issued by another
+            qubesd instance), :py:obj:`True` otherwise
+        '''
+        epoch, _, seq = token.partition('-')
+        if epoch != self.epoch or not seq.isdigit():
+            return False
+        seq = int(seq)
+        if seq > self.seq:
+            return False
+        if seq == self.seq:
+            return True
+        if not self.history or self.history[0][0] > seq + 1:
+            return False
+        start = seq + 1 - self.history[0][0]
+        for entry_seq, name, event, kwargs in itertools.islice(
+                self.history, start, None):
+            if name is None:
+                subject = self.app
+            else:
+                try:
+                    subject = self.app.domains[name]
+                except KeyError:
+                    continue
+            if subscriber.dest is not None and subject is not subscriber.dest:
+                continue
+            subscriber.deliver(subject, event, kwargs, entry_seq)
+        return True
+
+    def on_vm_event(self, subject, event, **kwargs):
+        if event.startswith('mgmt-permission:'):
             return
-        self.send_event(subject, event, **kwargs)
+        seq = self.record(subject, event, kwargs)
+        for subscriber in self.subscribers.get(subject, ()):
+            subscriber.deliver(subject, event, kwargs, seq)
+        for subscriber in self.subscribers.get(None, ()):
+            subscriber.deliver(subject, event, kwargs, seq)
+
+    def on_app_event(self, subject, event, **kwargs):
+        seq = self.record(subject, event, kwargs)
+        for subscriber in self.subscribers.get(None, ()):
+            subscriber.deliver(subject, event, kwargs, seq)
 
     def on_domain_add(self, subject, event, vm):
         # pylint: disable=unused-argument
-        vm.add_handler('*', self.vm_handler)
+        vm.add_handler('*', self.on_vm_event)
 
     def on_domain_delete(self, subject, event, vm):
         # pylint: disable=unused-argument
-        vm.remove_handler('*', self.vm_handler)
+        vm.remove_handler('*', self.on_vm_event)
 
 
 class QubesAdminAPI(qubes.api.AbstractQubesAPI):
@@ -74,6 +360,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
     '''
 
     SOCKNAME = '/var/run/qubesd.sock'
+    API_NAME = 'admin'
 
     @qubes.api.method('admin.vmclass.List', no_payload=True)
     @asyncio.coroutine
@@ -83,7 +370,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         assert self.dest.name == 'dom0'
 
         entrypoints = self.fire_event_for_filter(
-            pkg_resources.iter_entry_points(qubes.vm.VM_ENTRY_POINT))
+            qubes.utils.iter_entry_points(qubes.vm.VM_ENTRY_POINT))
 
         return ''.join('{}\n'.format(ep.name)
             for ep in entrypoints)
@@ -99,11 +386,13 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         else:
             domains = self.fire_event_for_filter([self.dest])
 
-        return ''.join('{} class={} state={}\n'.format(
+        domains = sorted(domains)
+        power_states = self.app.domains.get_power_states(domains)
+        return qubes.api.StreamedResponse('{} class={} state={}\n'.format(
                 vm.name,
                 vm.__class__.__name__,
-                vm.get_power_state())
-            for vm in sorted(domains))
+                power_states[vm])
+            for vm in domains)
 
     @qubes.api.method('admin.vm.property.List', no_payload=True)
     @asyncio.coroutine
@@ -121,9 +410,10 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
     def _property_list(self, dest):
         assert not self.arg
 
-        properties = self.fire_event_for_filter(dest.property_list())
+        properties = list(self.fire_event_for_filter(dest.property_list()))
 
-        return ''.join('{}\n'.format(prop.__name__) for prop in properties)
+        return qubes.api.StreamedResponse(
+            '{}\n'.format(prop.__name__) for prop in properties)
 
     @qubes.api.method('admin.vm.property.Get', no_payload=True)
     @asyncio.coroutine
@@ -144,7 +434,16 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
         self.fire_event_for_permission()
 
-        property_def = dest.property_get_def(self.arg)
+        return self._format_property(dest, self.arg)
+
+    @staticmethod
+    def _format_property(dest, name, escape=False):
+        '''Format property *name* of *dest* for ``property.Get`` reply.
+
+        :param bool escape: escape backslashes and newlines in the value, so
+            that it fits on a single line
+        '''
+        property_def = dest.property_get_def(name)
         # explicit list to be sure that it matches protocol spec
         if isinstance(property_def, qubes.vm.VMProperty):
             property_type = 'vm'
@@ -152,20 +451,78 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             property_type = 'int'
         elif property_def.type is bool:
             property_type = 'bool'
-        elif self.arg == 'label':
+        elif name == 'label':
             property_type = 'label'
         else:
             property_type = 'str'
 
         try:
-            value = getattr(dest, self.arg)
+            value = getattr(dest, name)
         except AttributeError:
             return 'default=True type={} '.format(property_type)
         else:
+            value = str(value) if value is not None else ''
+            if escape:
+                value = value.replace('\\', '\\\\').replace('\n', '\\n')
             return 'default={} type={} {}'.format(
-                str(dest.property_is_default(self.arg)),
+                str(dest.property_is_default(name)),
                 property_type,
-                str(value) if value is not None else '')
+                value)
+
+    def _property_get_allowed(self, dest, name):
+        '''Check if ``admin.vm.property.Get`` of *name* on *dest* would be
+        allowed, as signalled by its ``mgmt-permission:`` event'''
+        try:
+            self.src.fire_event_pre('mgmt-permission:admin.vm.property.Get',
+                dest=dest, arg=name)
+        except qubes.api.PermissionDenied:
+            return False
+        return True
+
+    def _property_get_all(self, dest, properties, prefix=''):
+        '''Lines of ``property.GetAll`` reply for *properties* of *dest*,
+        skipping those which ``admin.vm.property.Get`` would refuse'''
+        for prop in properties:
+            name = prop.__name__
+            if not self._property_get_allowed(dest, name):
+                continue
+            yield '{}{} {}\n'.format(prefix, name,
+                self._format_property(dest, name, escape=True))
+
+    @qubes.api.method('admin.vm.property.GetAll', no_payload=True)
+    @asyncio.coroutine
+    def vm_property_get_all(self):
+        '''Get values of all properties of a qube.
+
+        One line per property, ``<name> <reply of admin.vm.property.Get>``,
+        with backslashes and newlines in values escaped. The reply is
+        streamed.
+        '''
+        assert not self.arg
+
+        properties = list(self.fire_event_for_filter(
+            self.dest.property_list()))
+
+        return qubes.api.StreamedResponse(
+            self._property_get_all(self.dest, properties))
+
+    @qubes.api.method('admin.vm.property.GetAllDomains', no_payload=True)
+    @asyncio.coroutine
+    def vm_property_get_all_domains(self):
+        '''Get values of all properties of all the qubes.
+
+        Like ``admin.vm.property.GetAll``, but each line is prefixed with
+        qube name and a space. Qubes are filtered like in ``admin.vm.List``.
+        '''
+        assert not self.arg
+        assert self.dest.name == 'dom0'
+
+        domains = list(self.fire_event_for_filter(self.app.domains))
+
+        return qubes.api.StreamedResponse(itertools.chain.from_iterable(
+            self._property_get_all(vm, vm.property_list(),
+                prefix=vm.name + ' ')
+            for vm in domains))
 
     @qubes.api.method('admin.vm.property.Set')
     @asyncio.coroutine
@@ -290,7 +647,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
         self.fire_event_for_permission(revision=revision)
 
-        self.dest.storage.get_pool(volume).revert(revision)
+        yield from self.dest.storage.revert(self.arg, revision)
         self.app.save()
 
     @qubes.api.method('admin.vm.volume.Clone')
@@ -324,7 +681,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
         self.fire_event_for_permission(size=size)
 
-        self.dest.storage.resize(self.arg, size)
+        yield from self.dest.storage.resize(self.arg, size)
         self.app.save()
 
     @qubes.api.method('admin.vm.volume.Import', no_payload=True)
@@ -617,53 +974,186 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         self.fire_event_for_permission()
         yield from self.dest.kill()
 
-    @qubes.api.method('admin.Events', no_payload=True)
+    @qubes.api.method('admin.Events')
     @asyncio.coroutine
-    def events(self):
+    def events(self, untrusted_payload):
+        '''Send events of the qube (or of all of them and of the app, if
+        called on dom0), until the client disconnects.
+
+        The payload may select the events to send, see
+        :py:meth:`_parse_events_selector`; others are dropped before being
+        serialized.
+
+        With ``since=<token>`` in the payload, each event has ``seq``
+        argument with its position in the stream, and so does
+        ``connection-established`` event. When reconnecting, pass the last
+        received one as the token, to get the events sent in the meantime
+        first; ``connection-established`` then carries the same token, and
+        the replayed events advance it. If they are not available anymore
+        (or qubesd has been restarted), ``connection-established`` carries
+        the current position and artificial ``events-resync`` event follows,
+        so the client needs to get the current state again. The same event
+        is sent instead of ``events-dropped``, when the client is too slow
+        and some events are dropped. Use ``since=now`` on the first
+        connection.
+        '''
         assert not self.arg
 
+        selector, since = self._parse_events_selector(untrusted_payload)
+        del untrusted_payload
+
         # run until client connection is terminated
         self.cancellable = True
-        wait_for_cancel = asyncio.get_event_loop().create_future()
 
         # cache event filters, to not call an event each time an event arrives
         event_filters = self.fire_event_for_permission()
+        if selector is not None:
+            # cheaper than permission filters, so check it first
+            event_filters = [selector] + list(event_filters)
 
-        dispatcher = QubesMgmtEventsDispatcher(event_filters, self.send_event)
-        if self.dest.name == 'dom0':
-            self.app.add_handler('*', dispatcher.app_handler)
-            self.app.add_handler('domain-add', dispatcher.on_domain_add)
-            self.app.add_handler('domain-delete', dispatcher.on_domain_delete)
-            for vm in self.app.domains:
-                vm.add_handler('*', dispatcher.vm_handler)
-        else:
-            self.dest.add_handler('*', dispatcher.vm_handler)
+        bus = EventBus.for_app(self.app)
+        subscriber = EventSubscriber(bus,
+            None if self.dest.name == 'dom0' else self.dest,
+            event_filters, self.send_event, self.drain_events,
+            send_seq=since is not None)
+        bus.subscribe(subscriber)
 
         # send artificial event as a confirmation that connection is established
-        self.send_event(self.app, 'connection-established')
+        if since is None:
+            self.send_event(self.app, 'connection-established')
+        elif since != 'now' and bus.replay(subscriber, since):
+            # replayed events are queued, so they are sent after this one;
+            # do not let the client skip them
+            self.send_event(self.app, 'connection-established', seq=since)
+        else:
+            self.send_event(self.app, 'connection-established', seq=bus.token)
+            if since != 'now':
+                self.send_event(self.app, 'events-resync')
 
         try:
-            yield from wait_for_cancel
+            yield from subscriber.run()
         except asyncio.CancelledError:
-            # the above waiting was already interrupted, this is all we need
+            # the client has gone, this is all we need
             pass
+        finally:
+            bus.unsubscribe(subscriber)
+
+    @staticmethod
+    def _parse_events_selector(untrusted_payload):
+        '''Parse selection of events for ``admin.Events``.
+
+        The payload is a space separated list of ``event=<pattern>``,
+        ``vm=<name>`` and ``tag=<name>`` items, where patterns may contain
+        ``*`` and ``?`` wildcards. An event is selected if its name matches
+        any of the patterns (if given) and its subject is any of the qubes or
+        has any of the tags (if given; events of the app are not selected
+        then). Artificial events, like ``connection-established``, are sent
+        anyway. Additionally, a single ``since=<token>`` item may be given,
+        see :py:meth:`events`.
+
+        :returns: tuple of predicate for (subject, event, kwargs) tuples \
+            (or :py:obj:`None` when everything is selected) and the token \
+            (or :py:obj:`None`)
+        '''
+        allowed_chars = string.ascii_letters + string.digits + '-_.'
+        allowed_chars_pattern = allowed_chars + ':*?'
+        patterns = []
+        names = set()
+        tags = set()
+        since = None
+        for untrusted_item in untrusted_payload.decode('ascii').split():
+            try:
+                untrusted_key, untrusted_value = untrusted_item.split('=', 1)
+            except ValueError:
+                raise qubes.api.ProtocolError('Invalid selector format')
+            if not untrusted_value:
+                raise qubes.api.ProtocolError('Empty selector')
+            if untrusted_key == 'event':
+                if any(c not in allowed_chars_pattern
+                        for c in untrusted_value):
+                    raise qubes.api.ProtocolError(
+                        'Invalid chars in event pattern')
+                patterns.append(untrusted_value)
+            elif untrusted_key in ('vm', 'tag'):
+                if any(c not in allowed_chars for c in untrusted_value):
+                    raise qubes.api.ProtocolError(
+                        'Invalid chars in {} selector'.format(untrusted_key))
+                (names if untrusted_key == 'vm' else tags).add(
+                    untrusted_value)
+            elif untrusted_key == 'since':
+                if since is not None:
+                    raise qubes.api.ProtocolError('Duplicated since selector')
+                if any(c not in allowed_chars for c in untrusted_value):
+                    raise qubes.api.ProtocolError('Invalid chars in token')
+                since = untrusted_value
+            else:
+                raise qubes.api.ProtocolError('Invalid selector name')
+
+        if not (patterns or names or tags):
+            return None, since
+
+        event_re = None
+        if patterns:
+            event_re = re.compile('|'.join(
+                fnmatch.translate(pattern) for pattern in patterns))
+
+        def selector(item):
+            subject, event, _ = item
+            if event_re is not None and not event_re.match(event):
+                return False
+            if names or tags:
+                if not isinstance(subject, qubes.vm.BaseVM):
+                    return False
+                return subject.name in names \
+                    or not tags.isdisjoint(subject.tags)
+            return True
+
+        return selector, since
+
+    @qubes.api.method('admin.EventStats', no_payload=True)
+    @asyncio.coroutine
+    def event_stats(self):
+        '''Statistics of event handlers, see
+        :py:meth:`qubes.events.EventProfiler.format_stats`.
 
-        if self.dest.name == 'dom0':
-            self.app.remove_handler('*', dispatcher.app_handler)
-            self.app.remove_handler('domain-add', dispatcher.on_domain_add)
-            self.app.remove_handler('domain-delete',
-                dispatcher.on_domain_delete)
-            for vm in self.app.domains:
-                vm.remove_handler('*', dispatcher.vm_handler)
-        else:
-            self.dest.remove_handler('*', dispatcher.vm_handler)
+        Available only when profiling of events is enabled (``qubesd
+        --profile-events``).
+        '''
+        assert not self.arg
+        assert self.dest.name == 'dom0'
+
+        self.fire_event_for_permission()
+
+        profiler = qubes.events.get_profiler()
+        if profiler is None:
+            raise qubes.exc.QubesException('Event profiling is not enabled')
+
+        return profiler.format_stats()
+
+    @qubes.api.method('admin.Stats', no_payload=True)
+    @asyncio.coroutine
+    def stats(self):
+        '''Statistics of API calls handled by qubesd, see
+        :py:meth:`qubes.api.CallStats.format_stats`, followed by state of
+        their scheduling, see
+        :py:meth:`qubes.api.scheduler.CallScheduler.format_stats`.
+        '''
+        assert not self.arg
+        assert self.dest.name == 'dom0'
+
+        self.fire_event_for_permission()
+
+        return qubes.api.call_stats.format_stats() \
+            + qubes.api.scheduler.call_scheduler.format_stats()
 
     @qubes.api.method('admin.vm.feature.List', no_payload=True)
     @asyncio.coroutine
     def vm_feature_list(self):
         assert not self.arg
-        features = self.fire_event_for_filter(self.dest.features.keys())
-        return ''.join('{}\n'.format(feature) for feature in features)
+        features = list(self.fire_event_for_filter(
+            self.dest.features.keys()))
+        return qubes.api.StreamedResponse(
+            '{}\n'.format(feature) for feature in features)
 
     @qubes.api.method('admin.vm.feature.Get', no_payload=True)
     @asyncio.coroutine
@@ -713,14 +1203,14 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         self.app.save()
 
     @qubes.api.method('admin.vm.Create.{endpoint}', endpoints=(ep.name
-            for ep in pkg_resources.iter_entry_points(qubes.vm.VM_ENTRY_POINT)))
+            for ep in qubes.utils.iter_entry_points(qubes.vm.VM_ENTRY_POINT)))
     @asyncio.coroutine
     def vm_create(self, endpoint, untrusted_payload=None):
         return self._vm_create(endpoint, allow_pool=False,
             untrusted_payload=untrusted_payload)
 
     @qubes.api.method('admin.vm.CreateInPool.{endpoint}', endpoints=(ep.name
-            for ep in pkg_resources.iter_entry_points(qubes.vm.VM_ENTRY_POINT)))
+            for ep in qubes.utils.iter_entry_points(qubes.vm.VM_ENTRY_POINT)))
     @asyncio.coroutine
     def vm_create_in_pool(self, endpoint, untrusted_payload=None):
         return self._vm_create(endpoint, allow_pool=True,
@@ -864,7 +1354,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         self.app.save()
 
     @qubes.api.method('admin.vm.device.{endpoint}.Available', endpoints=(ep.name
-            for ep in pkg_resources.iter_entry_points('qubes.devices')),
+            for ep in qubes.utils.iter_entry_points('qubes.devices')),
             no_payload=True)
     @asyncio.coroutine
     def vm_device_available(self, endpoint):
@@ -876,29 +1366,34 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             #  the list is empty
             assert len(devices) <= 1
         devices = self.fire_event_for_filter(devices, devclass=devclass)
-
-        dev_info = {}
-        for dev in devices:
-            non_default_attrs = set(attr for attr in dir(dev) if
-                not attr.startswith('_')).difference((
-                    'backend_domain', 'ident', 'frontend_domain',
-                    'description', 'options'))
-            properties_txt = ' '.join(
-                '{}={!s}'.format(prop, value) for prop, value
-                in itertools.chain(
-                    ((key, getattr(dev, key)) for key in non_default_attrs),
-                    # keep description as the last one, according to API
-                    # specification
-                    (('description', dev.description),)
-                ))
-            assert '\n' not in properties_txt
-            dev_info[dev.ident] = properties_txt
-
-        return ''.join('{} {}\n'.format(ident, dev_info[ident])
-            for ident in sorted(dev_info))
+        devices = {dev.ident: dev for dev in devices}
+
+        # formatted before replying, so a device which cannot be described
+        # fails the call instead of the already started reply
+        return qubes.api.StreamedResponse([
+            '{} {}\n'.format(ident, self._format_device_info(devices[ident]))
+            for ident in sorted(devices)])
+
+    @staticmethod
+    def _format_device_info(dev):
+        '''Properties of device, as in ``admin.vm.device.*.Available``'''
+        non_default_attrs = set(attr for attr in dir(dev) if
+            not attr.startswith('_')).difference((
+                'backend_domain', 'ident', 'frontend_domain',
+                'description', 'options'))
+        properties_txt = ' '.join(
+            '{}={!s}'.format(prop, value) for prop, value
+            in itertools.chain(
+                ((key, getattr(dev, key)) for key in non_default_attrs),
+                # keep description as the last one, according to API
+                # specification
+                (('description', dev.description),)
+            ))
+        assert '\n' not in properties_txt
+        return properties_txt
 
     @qubes.api.method('admin.vm.device.{endpoint}.List', endpoints=(ep.name
-            for ep in pkg_resources.iter_entry_points('qubes.devices')),
+            for ep in qubes.utils.iter_entry_points('qubes.devices')),
             no_payload=True)
     @asyncio.coroutine
     def vm_device_list(self, endpoint):
@@ -931,7 +1426,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             for ident in sorted(dev_info))
 
     @qubes.api.method('admin.vm.device.{endpoint}.Attach', endpoints=(ep.name
-            for ep in pkg_resources.iter_entry_points('qubes.devices')))
+            for ep in qubes.utils.iter_entry_points('qubes.devices')))
     @asyncio.coroutine
     def vm_device_attach(self, endpoint, untrusted_payload):
         devclass = endpoint
@@ -971,7 +1466,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         self.app.save()
 
     @qubes.api.method('admin.vm.device.{endpoint}.Detach', endpoints=(ep.name
-            for ep in pkg_resources.iter_entry_points('qubes.devices')),
+            for ep in qubes.utils.iter_entry_points('qubes.devices')),
             no_payload=True)
     @asyncio.coroutine
     def vm_device_detach(self, endpoint):
@@ -35,6 +35,7 @@ class QubesInternalAPI(qubes.api.AbstractQubesAPI):
     by design the input here is trusted.'''
 
     SOCKNAME = '/var/run/qubesd.internal.sock'
+    API_NAME = 'internal'
 
     @qubes.api.method('internal.GetSystemInfo', no_payload=True)
     @asyncio.coroutine
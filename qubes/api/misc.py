@@ -31,6 +31,11 @@ import qubes.vm.dispvm
 
 class QubesMiscAPI(qubes.api.AbstractQubesAPI):
     SOCKNAME = '/var/run/qubesd.misc.sock'
+    API_NAME = 'misc'
+
+    # notifications from VMs come in bursts (for example after updating
+    # many templates) and the caller does not care when they are written
+    wait_for_save = False
 
     @qubes.api.method('qubes.FeaturesRequest', no_payload=True)
     @asyncio.coroutine
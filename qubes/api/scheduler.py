@@ -0,0 +1,400 @@
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+'''Scheduling of API calls, fair between their sources.
+
+Without any configuration, every call is started right away. Limits are
+configured per source qube and API (``admin``, ``internal`` or ``misc``),
+in a file of lines::
+
+    <source> <api> [<option>=<value> ...]
+
+where *source* and *api* may be ``*`` to match any, and options are:
+
+``rate``
+    sustained number of calls per second (token bucket)
+
+``burst``
+    number of calls which may be made at once above the *rate* (bucket
+    size), default: *rate*, at least 1
+
+``max-in-flight``
+    maximum number of calls executed at the same time
+
+``weight``
+    share of call slots when they are scarce (see below), default: 1
+
+Options of all the matching lines apply, later ones overriding earlier
+ones, so put general lines first. Calls above the limits wait for their
+turn. Additionally, a ``@global max-in-flight=<n>`` line limits number of
+all the calls executed at the same time; when the limit is reached, calls
+waiting for a free slot are taken from sources in weighted fair order
+(start-time fair queuing), so a source flooding qubesd with calls gets
+only its share of the slots. Comments start with ``#``.
+
+Calls sending events (``admin.Events``) give their slot back when they
+start sending them, as they last until the client disconnects.
+'''
+
+import asyncio
+import collections
+import math
+
+import qubes.exc
+
+
+class CallSlot(object):
+    '''Permission to execute a call, given by :py:meth:`CallScheduler.acquire`.
+    Release it when the call finishes.'''
+    # pylint: disable=too-few-public-methods
+    __slots__ = ('scheduler', 'queue')
+
+    def __init__(self, scheduler, queue):
+        self.scheduler = scheduler
+        self.queue = queue
+
+    def release(self):
+        '''Give the slot back; subsequent calls do nothing'''
+        if self.queue is None:
+            return
+        queue, self.queue = self.queue, None
+        self.scheduler.release(queue)
+
+
+class CallQueue(object):
+    '''Calls of a single source and API'''
+    # pylint: disable=too-few-public-methods
+    __slots__ = ('key', 'rate', 'burst', 'max_in_flight', 'weight',
+        'waiters', 'in_flight', 'tokens', 'refilled', 'vtime', 'order')
+
+    def __init__(self, key, options):
+        self.key = key
+        #: futures of calls waiting for a slot
+        self.waiters = collections.deque()
+        self.in_flight = 0
+        self.tokens = None
+        self.refilled = None
+        #: virtual time of the next call, for fair queuing
+        self.vtime = 0.0
+        #: when the queue got backlogged, to break ties of :py:attr:`vtime`
+        self.order = 0
+        self.configure(options)
+
+    def configure(self, options):
+        self.rate = options.get('rate')
+        self.max_in_flight = options.get('max-in-flight')
+        self.weight = options.get('weight', 1)
+        if self.rate is None:
+            self.burst = self.tokens = self.refilled = None
+            return
+        self.burst = options.get('burst', max(1, int(self.rate)))
+        if self.tokens is None:
+            self.tokens = self.burst
+        else:
+            self.tokens = min(self.tokens, self.burst)
+
+    def refill(self, now):
+        '''Add tokens for the time since the last refill'''
+        if self.rate is None:
+            return
+        if self.refilled is not None:
+            self.tokens = min(self.burst,
+                self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    def ready(self):
+        '''Can a call of this queue be started now (ignoring the global
+        limit)? Tokens need to be refilled first.'''
+        if self.max_in_flight is not None \
+                and self.in_flight >= self.max_in_flight:
+            return False
+        return self.rate is None or self.tokens >= 1
+
+    def token_delay(self):
+        '''Time until the next token is available, if waiting only for it'''
+        if self.rate is None or self.tokens >= 1:
+            return None
+        if self.max_in_flight is not None \
+                and self.in_flight >= self.max_in_flight:
+            return None
+        return (1 - self.tokens) / self.rate
+
+    @property
+    def idle(self):
+        '''No state worth keeping'''
+        return not self.waiters and not self.in_flight \
+            and (self.rate is None or self.tokens >= self.burst)
+
+
+class CallScheduler(object):
+    '''Scheduler of API calls, see the module documentation.
+
+    :py:meth:`acquire` has to be called for each call before executing it.
+    When the call is not limited, this is just a few dictionary lookups and
+    additions, so it is cheap enough to do unconditionally.
+    '''
+
+    #: options of a line, with their types
+    options = {
+        'rate': float,
+        'burst': int,
+        'max-in-flight': int,
+        'weight': float,
+    }
+
+    def __init__(self):
+        #: configuration: list of (source, api, options)
+        self.rules = []
+        #: maximum number of all the calls executing at the same time
+        self.max_in_flight = None
+        #: (source, api) -> :py:class:`CallQueue`; idle ones are removed
+        self.queues = {}
+        #: queues with waiting calls
+        self.backlogged = set()
+        self.in_flight = 0
+        #: (source, api) -> number of calls which could not start right away
+        self.delayed = collections.Counter()
+        self.vtime = 0.0
+        self.backlogged_count = 0
+        self.timer = None
+
+    def configure(self, rules, max_in_flight=None):
+        '''Replace the configuration; it applies to waiting calls too.
+
+        :param rules: list of (source, api, options) tuples
+        :param max_in_flight: global limit of calls executing at once
+        '''
+        self.rules = list(rules)
+        self.max_in_flight = max_in_flight
+        for key, queue in list(self.queues.items()):
+            queue.configure(self.get_options(*key))
+            if queue.idle:
+                del self.queues[key]
+        self.dispatch()
+
+    def load_config(self, path):
+        '''Load configuration from a file, see the module documentation.
+
+        A missing file means no limits.
+
+        :raises qubes.exc.QubesException: when the file is invalid; the \
+            current configuration is kept then
+        '''
+        try:
+            with open(path) as config_file:
+                lines = list(config_file)
+        except FileNotFoundError:
+            lines = []
+
+        rules = []
+        max_in_flight = None
+        for lineno, line in enumerate(lines, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            try:
+                words = line.split()
+                if words[0] == '@global':
+                    options = self.parse_options(words[1:])
+                    if set(options) - {'max-in-flight'}:
+                        raise ValueError('only max-in-flight is supported')
+                    max_in_flight = options.get('max-in-flight')
+                    continue
+                if len(words) < 2:
+                    raise ValueError('api missing')
+                rules.append((words[0], words[1],
+                    self.parse_options(words[2:])))
+            except ValueError as e:
+                raise qubes.exc.QubesException(
+                    '{}:{}: invalid line: {}'.format(path, lineno, e))
+
+        self.configure(rules, max_in_flight)
+
+    def parse_options(self, words):
+        options = {}
+        for word in words:
+            name, sep, value = word.partition('=')
+            if not sep or name not in self.options:
+                raise ValueError('invalid option {!r}'.format(word))
+            value = self.options[name](value)
+            if not value > 0 or math.isinf(value):
+                raise ValueError('invalid value of {}'.format(name))
+            options[name] = value
+        return options
+
+    def get_options(self, source, api):
+        '''Options applying to calls from *source* to *api*'''
+        options = {}
+        for rule_source, rule_api, rule_options in self.rules:
+            if rule_source in ('*', source) and rule_api in ('*', api):
+                options.update(rule_options)
+        return options
+
+    @asyncio.coroutine
+    def acquire(self, source, api):
+        '''Wait until a call from *source* to *api* may be executed.
+
+        This method is a coroutine.
+
+        :returns: :py:class:`CallSlot`, to be released when the call \
+            finishes
+        '''
+        key = (source, api)
+        try:
+            queue = self.queues[key]
+        except KeyError:
+            queue = self.queues[key] = CallQueue(key,
+                self.get_options(source, api))
+
+        if not queue.waiters and self.has_free_slot():
+            queue.refill(asyncio.get_event_loop().time())
+            if queue.ready():
+                return self.start(queue)
+
+        self.delayed[key] += 1
+        if not queue.waiters:
+            # do not let a source save up virtual time while idle
+            queue.vtime = max(queue.vtime, self.vtime)
+            self.backlogged_count += 1
+            queue.order = self.backlogged_count
+            self.backlogged.add(queue)
+        future = asyncio.get_event_loop().create_future()
+        queue.waiters.append(future)
+        self.dispatch()
+        try:
+            return (yield from future)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # got the slot, but will not use it
+                future.result().release()
+            else:
+                self.forget_cancelled(queue)
+            raise
+
+    def has_free_slot(self):
+        return self.max_in_flight is None \
+            or self.in_flight < self.max_in_flight
+
+    def start(self, queue):
+        if queue.rate is not None:
+            queue.tokens -= 1
+        queue.in_flight += 1
+        self.in_flight += 1
+        self.vtime = max(self.vtime, queue.vtime)
+        queue.vtime = self.vtime + 1 / queue.weight
+        return CallSlot(self, queue)
+
+    def release(self, queue):
+        '''Called by :py:meth:`CallSlot.release`'''
+        queue.in_flight -= 1
+        self.in_flight -= 1
+        queue.refill(asyncio.get_event_loop().time())
+        if queue.idle and self.queues.get(queue.key) is queue:
+            del self.queues[queue.key]
+        self.dispatch()
+
+    def forget_cancelled(self, queue):
+        while queue.waiters and queue.waiters[0].cancelled():
+            queue.waiters.popleft()
+        if not queue.waiters:
+            self.backlogged.discard(queue)
+            if queue.idle and self.queues.get(queue.key) is queue:
+                del self.queues[queue.key]
+
+    def dispatch(self):
+        '''Start waiting calls, as far as limits allow'''
+        if not self.backlogged:
+            return
+        now = asyncio.get_event_loop().time()
+        for queue in self.backlogged:
+            queue.refill(now)
+        while self.has_free_slot():
+            ready = [queue for queue in self.backlogged if queue.ready()]
+            if not ready:
+                break
+            queue = min(ready, key=lambda q: (q.vtime, q.order))
+            future = queue.waiters.popleft()
+            if not future.cancelled():
+                future.set_result(self.start(queue))
+            self.forget_cancelled(queue)
+
+        delays = [delay for delay in
+            (queue.token_delay() for queue in self.backlogged)
+            if delay is not None]
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if delays and self.has_free_slot():
+            self.timer = asyncio.get_event_loop().call_later(
+                min(delays), self.dispatch)
+
+    def format_stats(self):
+        '''Statistics as text, one line per source and API, sorted::
+
+            queue <source> <api> queued=<n> in_flight=<n> delayed=<n>
+
+        where *delayed* is number of calls which waited for their turn.
+        Sources with nothing going on and no delayed calls are omitted.
+        '''
+        return ''.join(
+            'queue {} {} queued={} in_flight={} delayed={}\n'.format(
+                source, api, queued, in_flight, delayed)
+            for (source, api), queued, in_flight, delayed in self.counts())
+
+    def counts(self):
+        '''Numbers of queued, executing and delayed calls, as tuples
+        ((source, api), queued, in_flight, delayed), sorted'''
+        for key in sorted(set(self.queues) | set(self.delayed)):
+            queue = self.queues.get(key)
+            if queue is None:
+                yield key, 0, 0, self.delayed[key]
+            else:
+                yield key, len(queue.waiters), queue.in_flight, \
+                    self.delayed[key]
+
+    def format_prometheus(self):
+        '''Statistics in Prometheus text exposition format'''
+        counts = list(self.counts())
+        metrics = (
+            ('queued', 'gauge', 'Number of API calls waiting for their turn.'),
+            ('in_flight', 'gauge', 'Number of API calls executing.'),
+            ('delayed_total', 'counter',
+                'Number of API calls which waited for their turn.'),
+        )
+        lines = []
+        for i, (name, metric_type, description) in enumerate(metrics, 1):
+            lines.append('# HELP qubesd_scheduler_{} {}\n'.format(
+                name, description))
+            lines.append('# TYPE qubesd_scheduler_{} {}\n'.format(
+                name, metric_type))
+            for count in counts:
+                source, api = count[0]
+                lines.append(
+                    'qubesd_scheduler_{}{{source="{}",api="{}"}} {}\n'.format(
+                        name, escape_label(source), escape_label(api),
+                        count[i]))
+        return ''.join(lines)
+
+
+def escape_label(value):
+    '''Escape label value for Prometheus text format'''
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+#: scheduler of API calls handled by this process
+call_scheduler = CallScheduler()
@@ -21,17 +21,24 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import asyncio
 import collections
+import concurrent.futures
+import copy
 import errno
 import functools
 import grp
+import hashlib
+import json
 import logging
 import os
+import pickle
 import random
 import sys
 import tempfile
 import time
 import uuid
+import weakref
 
 import lxml.etree
 
@@ -96,18 +103,43 @@ class VirDomainWrapper(object):
                 raise
         return wrapper
 
+    @asyncio.coroutine
+    def call_async(self, attrname, *args):
+        '''Call *attrname* method of the domain in a thread, see
+        :py:meth:`VirConnectWrapper.call_async`.
+
+        This method is a coroutine.
+        '''
+        # pylint: disable=protected-access
+        with (yield from self._connection.domain_lock(self._vm.UUID())):
+            try:
+                return (yield from self._connection._run_in_executor(
+                    getattr(self._vm, attrname), *args))
+            except libvirt.libvirtError:
+                if self._reconnect_if_dead():
+                    return (yield from self._connection._run_in_executor(
+                        getattr(self._vm, attrname), *args))
+                raise
+
 
 class VirConnectWrapper(object):
     # pylint: disable=too-few-public-methods
 
-    def __init__(self, uri):
+    #: number of threads making libvirt calls for :py:meth:`call_async`
+    max_workers = 4
+
+    def __init__(self, uri, reconnect_cb=None):
         self._conn = libvirt.open(uri)
+        self._reconnect_cb = reconnect_cb
+        self._executor = None
+        self._domain_locks = weakref.WeakValueDictionary()
 
     def _reconnect_if_dead(self):
         is_dead = not self._conn.isAlive()
         if is_dead:
             self._conn = libvirt.open(self._conn.getURI())
-            # TODO: re-register event handlers
+            if self._reconnect_cb is not None:
+                self._reconnect_cb()
         return is_dead
 
     def _wrap_domain(self, ret):
@@ -131,6 +163,52 @@ class VirConnectWrapper(object):
                 raise
         return wrapper
 
+    def domain_lock(self, uuid):
+        '''Lock serializing :py:meth:`call_async` calls concerning the domain
+        of given UUID (bytes)'''
+        try:
+            return self._domain_locks[uuid]
+        except KeyError:
+            lock = self._domain_locks[uuid] = asyncio.Lock()
+            return lock
+
+    @asyncio.coroutine
+    def _run_in_executor(self, func, *args):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                self.max_workers)
+        return (yield from asyncio.get_event_loop().run_in_executor(
+            self._executor, func, *args))
+
+    @asyncio.coroutine
+    def call_async(self, uuid, attrname, *args):
+        '''Call *attrname* method of the connection in a thread, to not
+        block the event loop while libvirt (or the hypervisor) is busy.
+
+        Calls concerning the same domain (see also
+        :py:meth:`VirDomainWrapper.call_async`) are made one at a time, in
+        order, while calls for different domains may run in parallel, up to
+        :py:attr:`max_workers` of them.
+
+        This method is a coroutine.
+
+        :param bytes uuid: UUID of the domain the call concerns, or \
+            :py:obj:`None` to not serialize it
+        '''
+        if uuid is None:
+            lock = asyncio.Lock()
+        else:
+            lock = self.domain_lock(uuid)
+        with (yield from lock):
+            try:
+                return self._wrap_domain((yield from self._run_in_executor(
+                    getattr(self._conn, attrname), *args)))
+            except libvirt.libvirtError:
+                if self._reconnect_if_dead():
+                    return self._wrap_domain((yield from self._run_in_executor(
+                        getattr(self._conn, attrname), *args)))
+                raise
+
 
 class VMMConnection(object):
     '''Connection to Virtual Machine Manager (libvirt)'''
@@ -144,6 +222,7 @@ class VMMConnection(object):
         self._libvirt_conn = None
         self._xs = None
         self._xc = None
+        self._events_app = None
         if offline_mode is None:
             offline_mode = bool(os.getuid() == 0 and
                 os.stat('/') != os.stat('/proc/1/root/.'))
@@ -174,7 +253,8 @@ class VMMConnection(object):
         if 'xen.lowlevel.cs' in sys.modules:
             self._xc = xen.lowlevel.xc.xc()
         self._libvirt_conn = VirConnectWrapper(
-            qubes.config.defaults['libvirt_uri'])
+            qubes.config.defaults['libvirt_uri'],
+            reconnect_cb=self._on_reconnect)
         libvirt.registerErrorHandler(self._libvirt_error_handler, None)
 
     @property
@@ -219,13 +299,32 @@ class VMMConnection(object):
         '''Register libvirt event handlers, which will translate libvirt
         events into qubes.events. This function should be called only in
         'qubesd' process and only when mainloop has been already set.
+
+        Since then, power state of domains is cached and kept up to date by
+        those events (see :py:meth:`VMCollection.refresh_power_states`).
+        Handlers are registered again after reconnecting to libvirt.
         '''
+        self._events_app = app
+        self._register_domain_events()
+
+    def _register_domain_events(self):
+        app = self._events_app
         self.libvirt_conn.domainEventRegisterAny(
             None,  # any domain
             libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
             self._domain_event_callback,
             app
         )
+        # events might have been missed before registering
+        try:
+            app.domains.refresh_power_states()
+        except libvirt.libvirtError:
+            app.log.warning('Cannot get state of domains, not caching it',
+                exc_info=1)
+
+    def _on_reconnect(self):
+        if self._events_app is not None:
+            self._register_domain_events()
 
     @staticmethod
     def _domain_event_callback(_conn, domain, event, _detail, opaque):
@@ -239,6 +338,12 @@ class VMMConnection(object):
             # ignore events for unknown domains
             return
 
+        try:
+            # pylint: disable=protected-access
+            vm._refresh_libvirt_state()
+        except libvirt.libvirtError:
+            vm.log.warning('Cannot get domain state', exc_info=1)
+
         if event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
             vm.fire_event('domain-shutdown')
 
@@ -366,6 +471,80 @@ class QubesHost(object):
         return (current_time, current)
 
 
+class IdAllocator(object):
+    '''Allocator of integer identifiers (qid, netid, dispid).
+
+    Identifiers are kept in bitmaps (Python :py:class:`int`), so finding the
+    lowest unused one does not depend on the number of identifiers in use.
+
+    An identifier handed out by :py:meth:`allocate` or
+    :py:meth:`allocate_random` is reserved, so it will not be handed out
+    again, even if the caller yields to other coroutines before using it.
+    The reservation ends when the identifier is taken by :py:meth:`add`, or
+    given back with :py:meth:`release`.
+
+    :param int first: lowest identifier to hand out by :py:meth:`allocate`
+    '''
+
+    def __init__(self, first=1):
+        self._first = first
+        # bits of identifiers in use; those below *first* are never
+        # handed out by allocate()
+        self._used = (1 << first) - 1
+        # bits of identifiers handed out, but not used yet
+        self._reserved = 0
+
+    def __contains__(self, ident):
+        return bool((self._used | self._reserved) >> ident & 1)
+
+    def add(self, ident):
+        '''Mark *ident* as used, ending its reservation (if any)'''
+        self._used |= 1 << ident
+        self._reserved &= ~(1 << ident)
+
+    def remove(self, ident):
+        '''Mark *ident* as no longer used'''
+        if ident >= self._first:
+            self._used &= ~(1 << ident)
+
+    def release(self, ident):
+        '''Give back *ident* reserved by :py:meth:`allocate` and not used'''
+        self._reserved &= ~(1 << ident)
+
+    def _reserve(self, ident):
+        self._reserved |= 1 << ident
+        return ident
+
+    def allocate(self, limit):
+        '''Reserve the lowest identifier, which is neither used nor reserved.
+
+        :param int limit: identifiers must be lower than this
+        :raises LookupError: when there is no such identifier
+        '''
+        taken = self._used | self._reserved
+        # lowest zero bit
+        ident = (~taken & (taken + 1)).bit_length() - 1
+        if ident >= limit:
+            raise LookupError
+        return self._reserve(ident)
+
+    def allocate_random(self, limit, attempts):
+        '''Reserve random identifier, which is neither used nor reserved.
+
+        :param int limit: identifiers must be lower than this (and not lower
+            than zero)
+        :param int attempts: how many random identifiers to try
+        :raises LookupError: when all the attempts hit identifier taken
+            already
+        '''
+        rand = random.SystemRandom()
+        for _ in range(attempts):
+            ident = rand.randrange(limit)
+            if ident not in self:
+                return self._reserve(ident)
+        raise LookupError
+
+
 class VMCollection(object):
     '''A collection of Qubes VMs
 
@@ -373,12 +552,70 @@ class VMCollection(object):
     and whole VM object's presence.
 
     Iterating over VMCollection will yield machine objects.
+
+    Besides the main ``qid`` → VM mapping, the collection maintains indexes of
+    names and UUIDs, so that lookups do not depend on the number of VMs. Those
+    are kept up to date on :py:meth:`add`, on deletion and when ``name`` or
+    ``uuid`` property of a member VM changes. Sorted order used for iteration is
+    cached and recomputed only after the collection changes.
+
+    Identifiers in use are tracked by :py:class:`IdAllocator`-s, so new ones
+    are found without scanning all the VMs. Trackers of ``netid`` and
+    ``dispid`` are built on first use, as getting those may load domains
+    loaded lazily.
+
+    The collection also keeps reverse dependency index: for ``netvm``,
+    ``template`` and ``default_dispvm`` it knows which VMs point at given VM.
+    It is built on first use after loading all the VMs (so domains loaded
+    lazily are not loaded just for it) and then updated from
+    ``property-set:*`` and ``property-del:*`` events of member VMs.
     '''
 
+    #: properties tracked in reverse dependency index
+    _dependency_properties = ('netvm', 'template', 'default_dispvm')
+
+    #: events of member VMs, which may change what the VM depends on
+    _dependency_events = (
+        'property-set:netvm',
+        'property-del:netvm',
+        'property-set:provides_network',
+        'property-del:provides_network',
+        'property-set:template',
+        'property-del:template',
+        'property-set:default_dispvm',
+        'property-del:default_dispvm',
+        'clone-properties',
+    )
+
     def __init__(self, app):
         self.app = app
         self._dict = dict()
 
+        #: name -> qid index
+        self._name_index = dict()
+
+        #: uuid -> qid index
+        self._uuid_index = dict()
+
+        # cached sorted lists, invalidated on any change of the collection
+        self._sorted_qids = None
+        self._sorted_vms = None
+
+        # False while VMs are loaded with events disabled, when the
+        # dependency index cannot be maintained
+        self._dependency_tracking = False
+        # reverse dependency index: property name -> {target: set of vms};
+        # None until built on first use
+        self._dependents = None
+        # property name -> {vm: target}, needed to remove stale entries
+        self._dependencies = None
+        self.enable_dependency_tracking()
+
+        self._qids = IdAllocator()
+        # None until first use
+        self._netids = None
+        self._dispids = None
+
 
     def __repr__(self):
         return '<{} {!r}>'.format(
@@ -397,7 +634,9 @@ class VMCollection(object):
         qids are sorted by numerical order.
         '''
 
-        return iter(sorted(self._dict.keys()))
+        if self._sorted_qids is None:
+            self._sorted_qids = sorted(self._dict.keys())
+        return iter(self._sorted_qids)
 
     keys = qids
 
@@ -408,7 +647,7 @@ class VMCollection(object):
         names are sorted by lexical order.
         '''
 
-        return iter(sorted(vm.name for vm in self._dict.values()))
+        return iter(sorted(self._name_index.keys()))
 
 
     def vms(self):
@@ -417,11 +656,156 @@ class VMCollection(object):
         vms are sorted by qid.
         '''
 
-        return iter(sorted(self._dict.values()))
+        # the cached list is never modified in place, only replaced, so
+        # iterating over it while the collection changes is safe
+        if self._sorted_vms is None:
+            self._sorted_vms = sorted(self._dict.values())
+        return iter(self._sorted_vms)
 
     __iter__ = vms
     values = vms
 
+    def _invalidate_order(self):
+        self._sorted_qids = None
+        self._sorted_vms = None
+
+    def _index_add(self, vm):
+        self._name_index[vm.name] = vm.qid
+        vm_uuid = getattr(vm, 'uuid', None)
+        if vm_uuid is not None:
+            self._uuid_index[vm_uuid] = vm.qid
+
+    def _index_remove(self, vm):
+        if self._name_index.get(vm.name) == vm.qid:
+            del self._name_index[vm.name]
+        vm_uuid = getattr(vm, 'uuid', None)
+        if vm_uuid is not None and self._uuid_index.get(vm_uuid) == vm.qid:
+            del self._uuid_index[vm_uuid]
+
+    def _on_vm_property_set_name(self, vm, event, name, newvalue,
+            oldvalue=None):
+        '''Keep name index in sync when member VM gets renamed'''
+        # pylint: disable=unused-argument
+        if oldvalue is not None and \
+                self._name_index.get(oldvalue) == vm.qid:
+            del self._name_index[oldvalue]
+        self._name_index[newvalue] = vm.qid
+        self._invalidate_order()
+
+    def _on_vm_property_set_uuid(self, vm, event, name, newvalue,
+            oldvalue=None):
+        '''Keep uuid index in sync when member VM gets its UUID'''
+        # pylint: disable=unused-argument
+        if oldvalue is not None and \
+                self._uuid_index.get(oldvalue) == vm.qid:
+            del self._uuid_index[oldvalue]
+        self._uuid_index[newvalue] = vm.qid
+
+    def _index_dependencies(self, vm):
+        for prop in self._dependency_properties:
+            target = getattr(vm, prop, None)
+            self._dependencies[prop][vm] = target
+            self._dependents[prop].setdefault(target, set()).add(vm)
+
+    def _unindex_dependencies(self, vm):
+        for prop in self._dependency_properties:
+            try:
+                target = self._dependencies[prop].pop(vm)
+            except KeyError:
+                continue
+            dependents = self._dependents[prop][target]
+            dependents.discard(vm)
+            if not dependents:
+                del self._dependents[prop][target]
+
+    def _on_vm_dependency_changed(self, vm, event, **kwargs):
+        '''Refresh dependency index after relevant member VM change'''
+        # pylint: disable=unused-argument
+        self.update_dependencies(vm)
+
+    def update_dependencies(self, vm):
+        '''Refresh reverse dependency index entries of given VM.
+
+        This needs to be called only when effective value of ``netvm``,
+        ``template`` or ``default_dispvm`` of the VM changes without firing
+        events on the VM itself, for example when global default changes.
+        '''
+
+        if self._dependents is None:
+            return
+        self._unindex_dependencies(vm)
+        self._index_dependencies(vm)
+
+    @staticmethod
+    def _get_id(vm, attr):
+        '''Get *attr* (``netid`` or ``dispid``) of *vm*, or :py:obj:`None`
+        if its class does not have it at all'''
+        if not hasattr(type(vm), attr):
+            return None
+        return getattr(vm, attr, None)
+
+    def _ids_add(self, vm):
+        self._qids.add(vm.qid)
+        for attr in ('netid', 'dispid'):
+            allocator = getattr(self, '_' + attr + 's')
+            if allocator is None:
+                continue
+            ident = self._get_id(vm, attr)
+            if ident is not None:
+                allocator.add(ident)
+
+    def _ids_remove(self, vm):
+        self._qids.remove(vm.qid)
+        for attr in ('netid', 'dispid'):
+            allocator = getattr(self, '_' + attr + 's')
+            if allocator is None:
+                continue
+            ident = self._get_id(vm, attr)
+            if ident is not None:
+                allocator.remove(ident)
+
+    def _build_id_allocator(self, attr, first):
+        allocator = IdAllocator(first)
+        for vm in self._dict.values():
+            ident = self._get_id(vm, attr)
+            if ident is not None:
+                allocator.add(ident)
+        return allocator
+
+    def enable_dependency_tracking(self):
+        '''Start maintaining reverse dependency index.
+
+        Called when loading is finished. The index is (re)built on first use.
+        '''
+
+        self._dependency_tracking = True
+        self._dependents = None
+        self._dependencies = None
+
+    def _build_dependency_index(self):
+        self._dependents = {prop: {} for prop in self._dependency_properties}
+        self._dependencies = {prop: {}
+            for prop in self._dependency_properties}
+        for vm in self._dict.values():
+            self._index_dependencies(vm)
+
+    def get_dependents(self, prop, vm):
+        '''Get VMs which have property *prop* pointing to *vm*.
+
+        :param str prop: one of ``netvm``, ``template``, ``default_dispvm``
+        :param qubes.vm.BaseVM vm: target VM (or :py:obj:`None`)
+        :rtype: set
+        '''
+
+        if not self._dependency_tracking:
+            # loading in progress
+            return set(dep for dep in self._dict.values()
+                if getattr(dep, prop, None) is vm)
+
+        if self._dependents is None:
+            self._build_dependency_index()
+        return set(self._dependents[prop].get(vm, ()))
+
     def add(self, value, _enable_events=True):
         '''Add VM to collection
 
@@ -445,6 +829,19 @@ class VMCollection(object):
                 .format(value.name))
 
         self._dict[value.qid] = value
+        self._index_add(value)
+        self._ids_add(value)
+        self._invalidate_order()
+        value.add_handler('property-set:name', self._on_vm_property_set_name)
+        value.add_handler('property-set:uuid', self._on_vm_property_set_uuid)
+        for event in self._dependency_events:
+            value.add_handler(event, self._on_vm_dependency_changed)
+        if not _enable_events:
+            self._dependency_tracking = False
+            self._dependents = None
+            self._dependencies = None
+        elif self._dependents is not None:
+            self._index_dependencies(value)
         if _enable_events:
             value.events_enabled = True
             self.app.fire_event('domain-add', vm=value)
@@ -456,19 +853,19 @@ class VMCollection(object):
             return self._dict[key]
 
         if isinstance(key, str):
-            for vm in self:
-                if vm.name == key:
-                    return vm
-            raise KeyError(key)
+            try:
+                return self._dict[self._name_index[key]]
+            except KeyError:
+                raise KeyError(key)
 
         if isinstance(key, qubes.vm.BaseVM):
             key = key.uuid
 
         if isinstance(key, uuid.UUID):
-            for vm in self:
-                if vm.uuid == key:
-                    return vm
-            raise KeyError(key)
+            try:
+                return self._dict[self._uuid_index[key]]
+            except KeyError:
+                raise KeyError(key)
 
         raise KeyError(key)
 
@@ -484,21 +881,124 @@ class VMCollection(object):
                 # already undefined
                 pass
         del self._dict[vm.qid]
+        self._index_remove(vm)
+        self._ids_remove(vm)
+        self._invalidate_order()
+        vm.remove_handler('property-set:name', self._on_vm_property_set_name)
+        vm.remove_handler('property-set:uuid', self._on_vm_property_set_uuid)
+        for event in self._dependency_events:
+            vm.remove_handler(event, self._on_vm_dependency_changed)
+        if self._dependents is not None:
+            self._unindex_dependencies(vm)
         self.app.fire_event('domain-delete', vm=vm)
 
     def __contains__(self, key):
-        return any((key == vm or key == vm.qid or key == vm.name)
-                   for vm in self)
+        if isinstance(key, int):
+            return key in self._dict
+        if isinstance(key, str):
+            return key in self._name_index
+        if isinstance(key, qubes.vm.BaseVM):
+            return self._dict.get(getattr(key, 'qid', None)) is key
+        return False
 
 
     def __len__(self):
         return len(self._dict)
 
 
+    def get_power_states(self, vms=None):
+        '''Get power states of many domains at once.
+
+        Instead of asking libvirt about each domain separately (see
+        :py:meth:`qubes.vm.qubesvm.QubesVM.get_power_state`), states of all
+        the domains are retrieved with a single call.
+
+        :param vms: domains to check (default: all)
+        :returns: dict VM -> power state
+        '''
+
+        if vms is None:
+            vms = self
+        vms = list(vms)
+        # pylint: disable=protected-access
+        if self.app.vmm.offline_mode or all(
+                not isinstance(vm, qubes.vm.qubesvm.QubesVM)
+                or vm._libvirt_state is not None for vm in vms):
+            return {vm: vm.get_power_state() for vm in vms}
+
+        try:
+            libvirt_states = self._get_libvirt_states()
+        except libvirt.libvirtError:
+            self.app.log.warning('Cannot get state of all domains at once',
+                exc_info=1)
+            return {vm: vm.get_power_state() for vm in vms}
+
+        power_states = {}
+        for vm in vms:
+            if not isinstance(vm, qubes.vm.qubesvm.QubesVM) \
+                    or vm._libvirt_state is not None:
+                power_states[vm] = vm.get_power_state()
+                continue
+            try:
+                libvirt_domain, is_active, state = \
+                    libvirt_states[vm.uuid.bytes]
+            except KeyError:
+                power_states[vm] = 'Halted'
+                continue
+            if vm._libvirt_domain is None:
+                vm._libvirt_domain = libvirt_domain
+            if is_active:
+                power_states[vm] = vm._power_state_of_active(state)
+            else:
+                power_states[vm] = 'Halted'
+        return power_states
+
+    def refresh_power_states(self):
+        '''Refresh cached power state of all the domains with a single call
+        to libvirt.
+
+        This is needed whenever libvirt events might have been missed, that
+        is before starting to listen for them and after reconnecting to
+        libvirt. Domains which were running according to the cache, but are
+        not anymore, get ``domain-shutdown`` event, as libvirt will not
+        send it again.
+        '''
+        libvirt_states = self._get_libvirt_states()
+        # pylint: disable=protected-access
+        for vm in list(self):
+            if not isinstance(vm, qubes.vm.qubesvm.QubesVM):
+                continue
+            was_active = vm._libvirt_state is not None \
+                and vm._libvirt_state[0]
+            try:
+                libvirt_domain, is_active, state = \
+                    libvirt_states[vm.uuid.bytes]
+            except KeyError:
+                vm._libvirt_state = (False, libvirt.VIR_DOMAIN_SHUTOFF)
+            else:
+                if vm._libvirt_domain is None:
+                    vm._libvirt_domain = libvirt_domain
+                vm._libvirt_state = (is_active, state)
+            if was_active and not vm._libvirt_state[0]:
+                vm.fire_event('domain-shutdown')
+
+    def _get_libvirt_states(self):
+        '''Get state of all libvirt domains at once.
+
+        :returns: dict uuid -> (libvirt domain, is active, libvirt state)
+        '''
+        all_stats = self.app.vmm.libvirt_conn.getAllDomainStats(
+            libvirt.VIR_DOMAIN_STATS_STATE)
+        # ID of a domain is known without asking libvirt again,
+        # inactive domains have none
+        return {libvirt_domain.UUID():
+                (libvirt_domain, libvirt_domain.ID() >= 0,
+                    stats['state.state'])
+            for libvirt_domain, stats in all_stats}
+
     def get_vms_based_on(self, template):
         template = self[template]
-        return set(vm for vm in self
-            if hasattr(vm, 'template') and vm.template == template)
+        return self.get_dependents('template', template)
 
 
     def get_vms_connected_to(self, netvm):
@@ -511,7 +1011,7 @@ class VMCollection(object):
 
         while new_vms:
             cur_vm = new_vms.pop()
-            for vm in cur_vm.connected_vms:
+            for vm in self.get_dependents('netvm', cur_vm):
                 if vm in dependent_vms:
                     continue
                 dependent_vms.add(vm)
@@ -521,32 +1021,627 @@ class VMCollection(object):
         return dependent_vms
 
 
-    # XXX with Qubes Admin Api this will probably lead to race condition
-    # whole process of creating and adding should be synchronised
     def get_new_unused_qid(self):
-        used_ids = set(self.qids())
-        for i in range(1, qubes.config.max_qid):
-            if i not in used_ids:
-                return i
-        raise LookupError("Cannot find unused qid!")
+        '''Reserve the lowest unused qid.
+
+        The qid is not handed out again until VM with it is added and
+        removed, or it is given back with :py:meth:`release_qid`.
+        '''
+        try:
+            return self._qids.allocate(qubes.config.max_qid)
+        except LookupError:
+            raise LookupError("Cannot find unused qid!")
 
+    def release_qid(self, qid):
+        '''Give back qid from :py:meth:`get_new_unused_qid`, not used for
+        a VM'''
+        self._qids.release(qid)
 
     def get_new_unused_netid(self):
-        used_ids = set([vm.netid for vm in self])  # if vm.is_netvm()])
-        for i in range(1, qubes.config.max_netid):
-            if i not in used_ids:
-                return i
-        raise LookupError("Cannot find unused netid!")
+        '''Reserve the lowest unused netid, see :py:meth:`get_new_unused_qid`
+        '''
+        if self._netids is None:
+            self._netids = self._build_id_allocator('netid', 1)
+        try:
+            return self._netids.allocate(qubes.config.max_netid)
+        except LookupError:
+            raise LookupError("Cannot find unused netid!")
 
+    def release_netid(self, netid):
+        '''Give back netid from :py:meth:`get_new_unused_netid`, not used for
+        a VM'''
+        if self._netids is not None:
+            self._netids.release(netid)
 
     def get_new_unused_dispid(self):
-        for _ in range(int(qubes.config.max_dispid ** 0.5)):
-            dispid = random.SystemRandom().randrange(qubes.config.max_dispid)
-            if not any(getattr(vm, 'dispid', None) == dispid for vm in self):
-                return dispid
-        raise LookupError((
-            'https://xkcd.com/221/',
-            'http://dilbert.com/strip/2001-10-25')[random.randint(0, 1)])
+        '''Reserve random unused dispid, see :py:meth:`get_new_unused_qid`
+        '''
+        if self._dispids is None:
+            self._dispids = self._build_id_allocator('dispid', 0)
+        try:
+            return self._dispids.allocate_random(qubes.config.max_dispid,
+                int(qubes.config.max_dispid ** 0.5))
+        except LookupError:
+            raise LookupError((
+                'https://xkcd.com/221/',
+                'http://dilbert.com/strip/2001-10-25')[random.randint(0, 1)])
+
+    def release_dispid(self, dispid):
+        '''Give back dispid from :py:meth:`get_new_unused_dispid`, not used
+        for a VM'''
+        if self._dispids is not None:
+            self._dispids.release(dispid)
+
+
+def _same_items(items, other_items):
+    '''Check if two snapshots of ``dict.items()`` refer to the same objects'''
+    return len(items) == len(other_items) and all(
+        key == other_key and value is other_value
+        for (key, value), (other_key, other_value) in zip(items, other_items))
+
+
+class StoreJournal(object):
+    '''Append-only journal of changes to :file:`qubes.xml`
+
+    :param qubes.Qubes app: application, which changes should be recorded
+
+    Instead of writing the whole store on each :py:meth:`Qubes.save`, only
+    changed parts are appended to the journal file (next to the store) as
+    single-line JSON records. Each record replaces one element of the XML
+    tree::
+
+        {"domain": 3, "section": "properties", "key": "netvm",
+            "xml": "<property name=\\"netvm\\">sys-firewall</property>"}
+
+    *domain* is the qid (:py:obj:`None` for global properties), *section*
+    and *key* identify the element (see :py:attr:`sections`), *section* being
+    :py:obj:`None` for the whole domain; *xml* is :py:obj:`None` if the
+    element was removed. Which elements changed is learned from events on the
+    app and domains; what is written is taken from the current state at the
+    time of save, so multiple changes of the same thing result in a single
+    record.
+
+    The first line of the journal identifies the full snapshot (the store
+    file) it applies to; journal for a different snapshot is ignored.
+    :py:meth:`Qubes.load` replays the journal on top of the snapshot. When
+    the journal grows too big (see :py:attr:`max_size_ratio`), it is
+    compacted: new full snapshot is written and the journal is started over.
+    The same happens when something not covered by records (labels, pools)
+    changes.
+    '''
+
+    #: how elements of each section are found: container element (relative to
+    #: the domain or the root), element tag and attribute holding the key
+    sections = {
+        'properties': ('properties', 'property', 'name'),
+        'features': ('features', 'feature', 'name'),
+        'tags': ('tags', 'tag', 'name'),
+        'devices': (None, 'devices', 'class'),
+        'volume-config': (None, 'volume-config', None),
+    }
+
+    #: compact the journal when it is bigger than this fraction of the store
+    max_size_ratio = 0.5
+
+    def __init__(self, app):
+        self.app = app
+
+        #: path to the journal file
+        self.path = self.get_path(app.store)
+
+        # changed elements since last write: (qid, section, key) -> None
+        self._pending = collections.OrderedDict()
+        # identity of the store file the journal applies to, None if the
+        # journal cannot be appended (no full snapshot written yet)
+        self._base = None
+        self._base_size = 0
+        self._size = 0
+        # labels and pools at the time of the last full write
+        self._labels = ()
+        self._pools = ()
+        # serialised volume-config of each domain, as last written
+        self._volume_config = {}
+
+        app.add_handler('*', self._on_app_event)
+        for vm in app.domains:
+            vm.add_handler('*', self._on_vm_event)
+
+    @staticmethod
+    def get_path(store):
+        '''Get journal path for given store path'''
+        return store + '.journal'
+
+    @staticmethod
+    def _snapshot_id(stat):
+        return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+    @classmethod
+    def get_id(cls, path):
+        '''Identify current version of the journal at *path*.
+
+        Appending to the journal does not touch the store, so this is needed
+        to tell whether anyone else has saved changes.
+
+        :returns: :py:class:`list`, or :py:obj:`None` if there is no journal
+        '''
+        try:
+            return cls._snapshot_id(os.stat(path))
+        except FileNotFoundError:
+            return None
+
+    def close(self):
+        '''Stop recording changes'''
+        self.app.remove_handler('*', self._on_app_event)
+        for vm in self.app.domains:
+            vm.remove_handler('*', self._on_vm_event)
+
+    #
+    # recording changes
+    #
+
+    def _record(self, qid, section=None, key=None):
+        self._pending[(qid, section, key)] = None
+
+    def _on_app_event(self, app, event, **kwargs):
+        # pylint: disable=unused-argument
+        if event == 'domain-add':
+            kwargs['vm'].add_handler('*', self._on_vm_event)
+            self._record(kwargs['vm'].qid)
+        elif event == 'domain-delete':
+            kwargs['vm'].remove_handler('*', self._on_vm_event)
+            self._record(kwargs['vm'].qid)
+        elif event.startswith(('property-set:', 'property-del:')):
+            self._record(None, 'properties', kwargs['name'])
+
+    def _on_vm_event(self, vm, event, **kwargs):
+        if event.startswith(('property-set:', 'property-del:')):
+            self._record(vm.qid, 'properties', kwargs['name'])
+        elif event in ('domain-feature-set', 'domain-feature-delete'):
+            self._record(vm.qid, 'features', kwargs['feature'])
+        elif event in ('domain-tag-add', 'domain-tag-delete'):
+            self._record(vm.qid, 'tags', kwargs['tag'])
+        elif event.startswith(('device-attach:', 'device-detach:')):
+            self._record(vm.qid, 'devices', event.split(':', 1)[1])
+        elif event == 'domain-volume-config-changed':
+            self._record(vm.qid, 'volume-config')
+        elif event == 'clone-properties':
+            self._record(vm.qid)
+
+    #
+    # writing
+    #
+
+    def can_append(self):
+        '''Check if pending changes can be appended to the journal.
+
+        If not, full store needs to be written instead (see :py:meth:`reset`).
+        '''
+
+        return (self._base is not None
+            and self._size <= self._base_size * self.max_size_ratio
+            and _same_items(tuple(self.app.labels.items()), self._labels)
+            and _same_items(tuple(self.app.pools.items()), self._pools))
+
+    def needs_compaction(self):
+        '''Check if the journal grew big enough to be folded into snapshot'''
+        return self._size > self._base_size * self.max_size_ratio
+
+    def reset(self, store_fh):
+        '''Start new journal after writing full store.
+
+        :param store_fh: file object of just written store
+        '''
+
+        stat = os.fstat(store_fh.fileno())
+        self._base = self._snapshot_id(stat)
+        self._base_size = stat.st_size
+        self._labels = tuple(self.app.labels.items())
+        self._pools = tuple(self.app.pools.items())
+        self._pending.clear()
+        self._volume_config = {vm.qid: self._get_volume_config(vm)
+            for vm in self.app.domains}
+
+        header = (json.dumps({'snapshot': self._base}) + '\n').encode()
+        with tempfile.NamedTemporaryFile(prefix=self.path, delete=False) \
+                as fh_new:
+            fh_new.write(header)
+        try:
+            os.chown(fh_new.name, -1, grp.getgrnam('qubes').gr_gid)
+            os.chmod(fh_new.name, 0o660)
+        except KeyError:  # group 'qubes' not found
+            pass
+        os.rename(fh_new.name, self.path)
+        self._size = len(header)
+
+    def commit(self):
+        '''Append pending changes to the journal'''
+
+        records = []
+        whole_domains = set(qid for (qid, section, _) in self._pending
+            if section is None)
+
+        for qid, section, key in self._pending:
+            if section is None:
+                node = self.app.domains[qid].xml_fragment() \
+                    if qid in self.app.domains else None
+                self._volume_config.pop(qid, None)
+            elif qid in whole_domains:
+                # the whole domain is written anyway
+                continue
+            elif qid is None:
+                root = lxml.etree.Element('qubes')
+                root.append(self.app.xml_properties())
+                _, node = self._find(root, section, key)
+            elif qid in self.app.domains:
+                _, node = self._find(self.app.domains[qid].xml_fragment(),
+                    section, key)
+                if section == 'volume-config':
+                    # storage operations do not always change it, do not
+                    # repeat the last written one
+                    volume_config = None if node is None \
+                        else lxml.etree.tostring(node)
+                    if volume_config == self._volume_config.get(qid):
+                        continue
+                    self._volume_config[qid] = volume_config
+            else:
+                continue
+            records.append(self._format_record(qid, section, key, node))
+
+        self._pending.clear()
+        if not records:
+            return
+
+        data = b''.join(
+            (json.dumps(record, sort_keys=True) + '\n').encode()
+            for record in records)
+        with open(self.path, 'ab') as fh:
+            fh.write(data)
+        self._size += len(data)
+
+    @staticmethod
+    def _get_volume_config(vm):
+        node = vm.xml_fragment().find('volume-config')
+        return None if node is None else lxml.etree.tostring(node)
+
+    @classmethod
+    def _find(cls, parent, section, key, create=False):
+        '''Find element identified by *section* and *key*.
+
+        :param lxml.etree._Element parent: domain element or the root
+        :param bool create: create missing container element
+        :returns: tuple of container element and found element (either may \
+            be :py:obj:`None`)
+        '''
+
+        container, tag, attr = cls.sections[section]
+        if container is not None:
+            node = parent.find(container)
+            if node is None:
+                if not create:
+                    return None, None
+                node = lxml.etree.SubElement(parent, container)
+            parent = node
+        for node in parent.iterfind(tag):
+            if attr is None or node.get(attr) == key:
+                return parent, node
+        return parent, None
+
+    @staticmethod
+    def _format_record(qid, section, key, node):
+        return {
+            'domain': qid,
+            'section': section,
+            'key': key,
+            'xml': None if node is None
+                else lxml.etree.tostring(node, encoding='unicode'),
+        }
+
+    #
+    # reading
+    #
+
+    @classmethod
+    def replay(cls, path, root, store_stat, log=None):
+        '''Apply journal to the tree loaded from the store.
+
+        :param str path: path to the journal
+        :param lxml.etree._Element root: root element of loaded store
+        :param os.stat_result store_stat: stat of the store file
+        :returns: number of applied records
+        '''
+
+        try:
+            fh = open(path, 'rb')
+        except FileNotFoundError:
+            return 0
+
+        count = 0
+        with fh:
+            try:
+                header = json.loads(fh.readline().decode())
+            except ValueError:
+                header = None
+            if not header or header.get('snapshot') != \
+                    cls._snapshot_id(store_stat):
+                if log is not None:
+                    log.warning('Ignoring stale journal %s', path)
+                return 0
+
+            for line in fh:
+                if not line.endswith(b'\n'):
+                    # partially written record, there cannot be anything
+                    # after it
+                    break
+                cls._apply(root, json.loads(line.decode()))
+                count += 1
+
+        return count
+
+    @classmethod
+    def _apply(cls, root, record):
+        qid, section, key, xml = (record['domain'], record['section'],
+            record['key'], record['xml'])
+        node = None if xml is None else lxml.etree.fromstring(xml)
+
+        if qid is None:
+            parent = root
+        else:
+            domains = root.find('domains')
+            if domains is None:
+                domains = lxml.etree.SubElement(root, 'domains')
+            domain_id = 'domain-{}'.format(qid)
+            parent = None
+            for domain in domains.iterfind('domain'):
+                if domain.get('id') == domain_id:
+                    parent = domain
+                    break
+            if section is None:
+                if parent is not None:
+                    domains.remove(parent)
+                if node is not None:
+                    domains.append(node)
+                return
+            if parent is None:
+                return
+
+        parent, old_node = cls._find(parent, section, key, create=True)
+        if old_node is not None:
+            parent.remove(old_node)
+        if node is not None:
+            parent.append(node)
+
+
+class _CacheUnpickler(pickle.Unpickler):
+    '''Unpickler refusing anything but builtin containers and scalars'''
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(
+            'global {}.{} not allowed in store cache'.format(module, name))
+
+
+class StoreCache(object):
+    '''Binary cache of the state loaded from :file:`qubes.xml`
+
+    :param qubes.Qubes app: application
+
+    The cache holds labels, pools, and properties, features, tags, device
+    assignments and volume configuration of all domains, as they are after
+    the fourth stage of :py:meth:`Qubes.load`. Property values are stored
+    already converted by their setters, so loading from the cache skips both
+    parsing XML and the setters (and their validation); the fifth stage and
+    ``domain-load`` events are the same as when loading from XML.
+
+    The cache is keyed by content of the store and the journal (see
+    :py:class:`StoreJournal`) and by :py:attr:`version`.
+    Stale or broken cache is ignored and rewritten after loading the store.
+    Only builtin types are allowed in the cache file, it is never trusted more
+    than the store itself.
+    '''
+
+    #: version of the cache format; needs to be bumped whenever format or
+    #: meaning of the cached data changes
+    version = 1
+
+    def __init__(self, app):
+        self.app = app
+
+        #: path to the cache file
+        self.path = self.get_path(app.store)
+
+    @staticmethod
+    def get_path(store):
+        '''Get cache path for given store path'''
+        return store + '.cache'
+
+    @staticmethod
+    def get_key(store, store_fh):
+        '''Identify current content of the store and its journal.
+
+        Content is hashed rather than compared by modification time, inode and
+        size, as those may all stay the same when the store is rewritten
+        quickly enough. *store_fh* is rewound afterwards.
+        '''
+        key = [hashlib.sha256(store_fh.read()).hexdigest()]
+        store_fh.seek(0)
+        try:
+            with open(StoreJournal.get_path(store), 'rb') as fh:
+                key.append(hashlib.sha256(fh.read()).hexdigest())
+        except FileNotFoundError:
+            key.append(None)
+        return key
+
+    #
+    # dumping
+    #
+
+    def dump(self, key):
+        '''Collect data for the cache from the app loaded up to stage 4.
+
+        :param list key: key returned by :py:meth:`get_key`
+        :rtype: dict
+        '''
+
+        domains = []
+        for vm in self.app.domains:
+            devices = []
+            for devclass in vm.devices:
+                for assignment in vm.devices[devclass].assignments(
+                        persistent=True):
+                    devices.append((devclass, assignment.backend_domain.qid,
+                        assignment.ident, dict(assignment.options)))
+            domains.append({
+                'class': vm.__class__.__name__,
+                'properties': {stage: self._dump_properties(vm, stage)
+                    for stage in (2, 4)},
+                'volume_config': copy.deepcopy(vm.volume_config)
+                    if hasattr(vm, 'volume_config') else None,
+                'features': dict(vm.features),
+                'tags': sorted(vm.tags),
+                'devices': devices,
+            })
+
+        return {
+            'version': self.version,
+            'key': key,
+            'labels': [(label.index, label.color, label.name)
+                for label in self.app.labels.values()],
+            'pools': [dict(node.attrib) for node in self.app.xml_pools()],
+            'properties': self._dump_properties(self.app, 3),
+            'domains': domains,
+        }
+
+    @staticmethod
+    def _dump_properties(holder, load_stage):
+        properties = {}
+        for prop in holder.property_list(load_stage):
+            # pylint: disable=protected-access
+            try:
+                value = getattr(holder, prop._attr_name)
+            except AttributeError:
+                continue
+
+            if isinstance(value, qubes.Label):
+                properties[prop.__name__] = ('label', value.index)
+            elif isinstance(value, qubes.vm.BaseVM):
+                properties[prop.__name__] = ('vm', value.qid)
+            elif isinstance(value, uuid.UUID):
+                properties[prop.__name__] = ('uuid', str(value))
+            elif value is None or type(value) in (str, int, bool, float):
+                # exact types only, subclasses would not unpickle
+                properties[prop.__name__] = ('value', value)
+            else:
+                # unknown type, go through the setter on load
+                try:
+                    properties[prop.__name__] = (
+                        'str', prop._saver(holder, prop, value))
+                except qubes.property.DontSave:
+                    continue
+        return properties
+
+    def write(self, data):
+        '''Write the cache file; failures are only logged'''
+        try:
+            with tempfile.NamedTemporaryFile(prefix=self.path, delete=False) \
+                    as fh_new:
+                pickle.dump(data, fh_new, pickle.HIGHEST_PROTOCOL)
+            try:
+                os.chown(fh_new.name, -1, grp.getgrnam('qubes').gr_gid)
+                os.chmod(fh_new.name, 0o660)
+            except KeyError:  # group 'qubes' not found
+                pass
+            os.rename(fh_new.name, self.path)
+        except OSError as e:
+            self.app.log.debug('Failed to write store cache %s: %s',
+                self.path, e)
+
+    #
+    # loading
+    #
+
+    def read(self, key):
+        '''Read the cache, if it is fresh.
+
+        :param list key: key returned by :py:meth:`get_key`
+        :returns: cached data or :py:obj:`None`
+        '''
+
+        try:
+            with open(self.path, 'rb') as fh:
+                data = _CacheUnpickler(fh).load()
+        except FileNotFoundError:
+            return None
+        except Exception as e:  # pylint: disable=broad-except
+            self.app.log.warning('Ignoring broken store cache %s: %s',
+                self.path, e)
+            return None
+
+        if not isinstance(data, dict) or data.get('version') != self.version \
+                or data.get('key') != key:
+            return None
+        return data
+
+    def load(self, data):
+        '''Fill the app with cached data, as stages 1 to 4 of
+        :py:meth:`Qubes.load` would'''
+
+        # pylint: disable=protected-access
+        app = self.app
+
+        # stage 1: labels and pools
+        for index, color, name in data['labels']:
+            app.labels[index] = qubes.Label(index, color, name)
+        for config in data['pools']:
+            try:
+                app.pools[config['name']] = app._get_pool(**config)
+            except qubes.exc.QubesException as e:
+                app.log.error(str(e))
+
+        # stage 2: domains; the (empty) element tells them they are being
+        # loaded, not created
+        domains = []
+        classes = {}
+        for domain in data['domains']:
+            try:
+                cls = classes[domain['class']]
+            except KeyError:
+                cls = classes[domain['class']] = \
+                    app.get_vm_class(domain['class'])
+            kwargs = {}
+            if domain['volume_config'] is not None:
+                kwargs['volume_config'] = domain['volume_config']
+            vm = cls(app, lxml.etree.Element('domain'), **kwargs)
+            self._load_properties(vm, domain['properties'][2])
+            vm.init_log()
+            app.domains.add(vm, _enable_events=False)
+            domains.append((vm, domain))
+
+        # stage 3: global properties
+        self._load_properties(app, data['properties'])
+
+        # stage 4: remaining properties and extras
+        for vm, domain in domains:
+            self._load_properties(vm, domain['properties'][4])
+            for feature, value in domain['features'].items():
+                vm.features[feature] = value
+            for devclass, backend_qid, ident, options in domain['devices']:
+                vm.devices[devclass].attach(qubes.devices.DeviceAssignment(
+                    app.domains[backend_qid], ident, options,
+                    persistent=True))
+            for tag in domain['tags']:
+                vm.tags.add(tag)
+
+    def _load_properties(self, holder, properties):
+        for name, (kind, value) in properties.items():
+            if kind == 'str':
+                setattr(holder, name, value)
+                continue
+            if kind == 'label':
+                value = self.app.labels[value]
+            elif kind == 'vm':
+                value = self.app.domains[value]
+            elif kind == 'uuid':
+                value = uuid.UUID(value)
+            # pylint: disable=protected-access
+            holder._property_init(holder.property_get_def(name), value)
 
 
 class Qubes(qubes.PropertyHolder):
@@ -636,7 +1731,7 @@ class Qubes(qubes.PropertyHolder):
         doc='check for updates inside qubes')
 
     def __init__(self, store=None, load=True, offline_mode=None, lock=False,
-            **kwargs):
+            cache=False, lazy=False, **kwargs):
         #: logger instance for logging global messages
         self.log = logging.getLogger('app')
 
@@ -670,6 +1765,37 @@ class Qubes(qubes.PropertyHolder):
         self.__load_timestamp = None
         self.__locked_fh = None
 
+        #: when not :py:obj:`None`, :py:meth:`save` only schedules writing
+        #: :file:`qubes.xml` this many seconds later, so changes made in the
+        #: meantime are written at once; used by :program:`qubesd`
+        self.save_flush_window = None
+
+        # pending scheduled save: future, loop handle and lock argument
+        self._save_scheduled = None
+        self._save_handle = None
+        self._save_lock = False
+        # number of save() calls, see save_requests
+        self._save_requests = 0
+
+        #: :py:class:`StoreJournal` used by :py:meth:`save`, if enabled with
+        #: :py:meth:`enable_journal`
+        self.journal = None
+
+        #: :py:class:`StoreCache` used by :py:meth:`load`, if enabled with
+        #: *cache* argument
+        self.cache = StoreCache(self) if cache else None
+
+        #: when loading from :file:`qubes.xml`, load only identity of domains
+        #: and the rest when needed (see
+        #: :py:meth:`qubes.vm.BaseVM.defer_load`); useful for short-lived
+        #: tools, which use only few of the domains
+        self.lazy = lazy
+
+        # serialised labels and pools, see _xml_cached_collection()
+        self._xml_cache = {}
+        # serialised global properties, None when they need to be regenerated
+        self._xml_properties = None
+
         #: jinja2 environment for libvirt XML templates
         self.env = jinja2.Environment(
             loader=jinja2.FileSystemLoader([
@@ -690,13 +1816,78 @@ class Qubes(qubes.PropertyHolder):
     def load(self, lock=False):
         '''Open qubes.xml
 
+        When :py:attr:`cache` is enabled and up to date, stages 1 to 4 are
+        loaded from it instead of the store. Otherwise, when :py:attr:`lazy`
+        is set, loading of each domain (except its identity) is deferred
+        until the domain is used.
+
         :throws EnvironmentError: failure on parsing store
         :throws xml.parsers.expat.ExpatError: failure on parsing store
         :raises lxml.etree.XMLSyntaxError: on syntax error in qubes.xml
         '''
 
         fh = self._acquire_lock()
+
+        cache_data = None
+        if self.cache is not None:
+            cache_key = self.cache.get_key(self._store, fh)
+            cache_data = self.cache.read(cache_key)
+        if cache_data is not None:
+            try:
+                self.cache.load(cache_data)
+            except Exception:  # pylint: disable=broad-except
+                self.log.exception('Failed to load %s, loading %s instead',
+                    self.cache.path, self._store)
+                self._unload()
+                cache_data = None
+
+        if cache_data is None:
+            self._load_xml(fh)
+            # dumping would need loading all the domains
+            if self.cache is not None and not self.lazy:
+                self.cache.write(self.cache.dump(cache_key))
+
+        # stage 5: misc fixups
+
+        self.property_require('default_fw_netvm', allow_none=True)
+        self.property_require('default_netvm', allow_none=True)
+        self.property_require('default_template')
+        self.property_require('clockvm', allow_none=True)
+        self.property_require('updatevm', allow_none=True)
+
+        # Disable ntpd in ClockVM - to not conflict with ntpdate (both are
+        # using 123/udp port)
+        if hasattr(self, 'clockvm') and self.clockvm is not None:
+            if self.clockvm.features.get('service/ntpd', False):
+                self.log.warning(
+                    'VM set as clockvm (%r) has enabled \'ntpd\' service! '
+                    'Expect failure when syncing time in dom0.',
+                    self.clockvm)
+            else:
+                self.clockvm.features['service/ntpd'] = ''
+
+        for vm in self.domains:
+            if vm.is_load_deferred():
+                continue
+            vm.events_enabled = True
+            vm.fire_event('domain-load')
+
+        self.domains.enable_dependency_tracking()
+
+        # get a file timestamp (before closing it - still holding the lock!),
+        #  to detect whether anyone else have modified it in the meantime
+        self.__load_timestamp = self._get_store_timestamp()
+
+        if not lock:
+            self._release_lock()
+
+
+    def _load_xml(self, fh):
+        '''Load stages 1 to 4 from the store (and its journal)'''
+
         self.xml = lxml.etree.parse(fh)
+        StoreJournal.replay(StoreJournal.get_path(self._store),
+            self.xml.getroot(), os.fstat(fh.fileno()), log=self.log)
 
         # stage 1: load labels and pools
         for node in self.xml.xpath('./labels/label'):
@@ -716,7 +1907,10 @@ class Qubes(qubes.PropertyHolder):
             # pylint: disable=no-member
             cls = self.get_vm_class(node.get('class'))
             vm = cls(self, node)
-            vm.load_properties(load_stage=2)
+            if self.lazy:
+                vm.defer_load()
+            else:
+                vm.load_properties(load_stage=2)
             vm.init_log()
             self.domains.add(vm, _enable_events=False)
 
@@ -730,62 +1924,69 @@ class Qubes(qubes.PropertyHolder):
 
         # stage 4: fill all remaining VM properties
         for vm in self.domains:
+            if vm.is_load_deferred():
+                continue
             vm.load_properties(load_stage=4)
             vm.load_extras()
 
-        # stage 5: misc fixups
-
-        self.property_require('default_fw_netvm', allow_none=True)
-        self.property_require('default_netvm', allow_none=True)
-        self.property_require('default_template')
-        self.property_require('clockvm', allow_none=True)
-        self.property_require('updatevm', allow_none=True)
-
-        # Disable ntpd in ClockVM - to not conflict with ntpdate (both are
-        # using 123/udp port)
-        if hasattr(self, 'clockvm') and self.clockvm is not None:
-            if self.clockvm.features.get('service/ntpd', False):
-                self.log.warning(
-                    'VM set as clockvm (%r) has enabled \'ntpd\' service! '
-                    'Expect failure when syncing time in dom0.',
-                    self.clockvm)
-            else:
-                self.clockvm.features['service/ntpd'] = ''
-
-        for vm in self.domains:
-            vm.events_enabled = True
-            vm.fire_event('domain-load')
-
-        # get a file timestamp (before closing it - still holding the lock!),
-        #  to detect whether anyone else have modified it in the meantime
-        self.__load_timestamp = os.path.getmtime(self._store)
-
-        if not lock:
-            self._release_lock()
+    def _unload(self):
+        '''Forget everything loaded by a failed (partial) load'''
 
+        self.domains = VMCollection(self)
+        self.labels = {}
+        self.pools = {}
+        for prop in self.property_list():
+            # pylint: disable=protected-access
+            try:
+                delattr(self, prop._attr_name)
+            except AttributeError:
+                pass
 
     def __xml__(self):
+        # Parts of the tree are cached between calls and regenerated only
+        # when changed: domains track their changes themselves (see
+        # :py:meth:`qubes.vm.BaseVM.xml_fragment`), global properties are
+        # invalidated by events and labels and pools are compared with the
+        # set serialised last time, as they are modified directly.
         element = lxml.etree.Element('qubes')
 
-        element.append(self.xml_labels())
+        element.append(self._xml_cached_collection(
+            'labels', self.labels, self.xml_labels))
+        element.append(self._xml_cached_collection(
+            'pools', self.pools, self.xml_pools))
 
-        pools_xml = lxml.etree.Element('pools')
-        for pool in self.pools.values():
-            xml = pool.__xml__()
-            if xml is not None:
-                pools_xml.append(xml)
-
-        element.append(pools_xml)
-
-        element.append(self.xml_properties())
+        if self._xml_properties is None:
+            self._xml_properties = self.xml_properties()
+        element.append(self._xml_properties)
 
         domains = lxml.etree.Element('domains')
         for vm in self.domains:
-            domains.append(vm.__xml__())
+            domains.append(vm.xml_fragment())
         element.append(domains)
 
         return element
 
+    def _xml_cached_collection(self, key, collection, serialise):
+        '''Return cached serialisation of *collection*, unless it has changed.
+
+        :param str key: cache key
+        :param dict collection: collection to serialise
+        :param serialise: function returning serialised *collection*
+        '''
+
+        snapshot = tuple(collection.items())
+        try:
+            cached_snapshot, element = self._xml_cache[key]
+        except KeyError:
+            pass
+        else:
+            if _same_items(snapshot, cached_snapshot):
+                return element
+
+        element = serialise()
+        self._xml_cache[key] = (snapshot, element)
+        return element
+
 
     def save(self, lock=True):
         '''Save all data to qubes.xml
@@ -798,13 +1999,123 @@ class Qubes(qubes.PropertyHolder):
         - Attempts to write two or more files concurrently. This is done by
           sophisticated locking.
 
+        If :py:attr:`save_flush_window` is set, the file is not written
+        immediately. Instead, the write is scheduled in the event loop after
+        that many seconds and shared by all :py:meth:`save` calls made until
+        then. Use :py:meth:`save_barrier` to wait for it.
+
         :param bool lock: keep file locked after saving
         :throws EnvironmentError: failure on saving
+        :returns: :py:class:`asyncio.Future` of the scheduled write, if it \
+            was only scheduled
+        '''
+
+        self._save_requests += 1
+
+        if self.save_flush_window is None:
+            self._write_store(lock)
+            return None
+
+        self._save_lock = self._save_lock or lock
+        if self._save_scheduled is None:
+            loop = asyncio.get_event_loop()
+            self._save_scheduled = asyncio.Future(loop=loop)
+            self._save_handle = loop.call_later(self.save_flush_window,
+                self.flush_save)
+        return self._save_scheduled
+
+    @property
+    def save_requests(self):
+        '''Number of :py:meth:`save` calls so far.
+
+        This can be used to check whether some operation changed anything
+        (and therefore may want to wait on :py:meth:`save_barrier`).
+        '''
+
+        return self._save_requests
+
+    def flush_save(self):
+        '''Write scheduled save immediately.
+
+        Errors are logged and reported to those waiting on
+        :py:meth:`save_barrier`. It is a no-op if no save is scheduled.
+        '''
+
+        future = self._save_scheduled
+        if future is None:
+            return
+        self._save_handle.cancel()
+        lock = self._save_lock
+        self._save_scheduled = None
+        self._save_handle = None
+        self._save_lock = False
+
+        try:
+            self._write_store(lock)
+        except Exception as e:  # pylint: disable=broad-except
+            self.log.exception('failed to save %s', self._store)
+            future.set_exception(e)
+            # already logged, do not complain if nobody waits for the result
+            future.exception()
+        else:
+            future.set_result(None)
+
+    @asyncio.coroutine
+    def save_barrier(self, flush=False):
+        '''Wait until all changes saved with :py:meth:`save` are written.
+
+        This method is a coroutine.
+
+        :param bool flush: write them now, instead of at the end of the \
+            flush window
+        :throws EnvironmentError: failure on saving
+        '''
+
+        future = self._save_scheduled
+        if future is None:
+            return
+        if flush:
+            self.flush_save()
+        yield from asyncio.shield(future)
+
+    def enable_journal(self):
+        '''Write changes to :py:class:`StoreJournal` instead of rewriting
+        the whole :file:`qubes.xml` on every :py:meth:`save`.
+
+        The first save after enabling it still writes the full store.
+        '''
+
+        if self.journal is None:
+            self.journal = StoreJournal(self)
+
+    def compact_journal(self):
+        '''Fold the journal into a new full :file:`qubes.xml`'''
+
+        self._write_store(lock=self.__locked_fh is not None, full=True)
+
+    def _write_store(self, lock, full=False):
+        '''Actually write :file:`qubes.xml`, see :py:meth:`save`
+
+        :param bool full: write full store, even if journal is enabled
         '''
 
         if not self.__locked_fh:
             self._acquire_lock(for_save=True)
 
+        if not full and self.journal is not None \
+                and self.journal.can_append():
+            self.journal.commit()
+            self.__load_timestamp = self._get_store_timestamp()
+            if self.journal.needs_compaction():
+                if self.save_flush_window is not None:
+                    # in qubesd, do not delay current caller
+                    asyncio.get_event_loop().call_soon(self.compact_journal)
+                else:
+                    self._write_store(lock=True, full=True)
+            if not lock:
+                self._release_lock()
+            return
+
         fh_new = tempfile.NamedTemporaryFile(
             prefix=self._store, delete=False)
         lxml.etree.ElementTree(self.__xml__()).write(
@@ -818,9 +2129,22 @@ class Qubes(qubes.PropertyHolder):
             pass
         os.rename(fh_new.name, self._store)
 
+        # the journal applied to the old store
+        if self.journal is not None:
+            self.journal.reset(fh_new)
+        elif self.__load_timestamp is not None and self.__load_timestamp[1] \
+                == StoreJournal.get_id(StoreJournal.get_path(self._store)):
+            # its changes were loaded, so they are in the new store too;
+            # other journal (if any) is left alone, it does not apply to the
+            # new store anyway
+            try:
+                os.unlink(StoreJournal.get_path(self._store))
+            except FileNotFoundError:
+                pass
+
         # update stored mtime, in case of multiple save() calls without
         # loading qubes.xml again
-        self.__load_timestamp = os.path.getmtime(self._store)
+        self.__load_timestamp = self._get_store_timestamp()
 
         # this releases lock for all other processes,
         # but they should instantly block on the new descriptor
@@ -854,7 +2178,7 @@ class Qubes(qubes.PropertyHolder):
                 continue
 
             if self.__load_timestamp and \
-                    os.path.getmtime(self._store) != self.__load_timestamp:
+                    self._get_store_timestamp() != self.__load_timestamp:
                 os.close(fd)
                 raise qubes.exc.QubesException(
                     'Someone else modified qubes.xml in the meantime')
@@ -874,6 +2198,11 @@ class Qubes(qubes.PropertyHolder):
         return self.__locked_fh
 
 
+    def _get_store_timestamp(self):
+        '''Identify current version of the store and its journal'''
+        return (os.path.getmtime(self._store),
+            StoreJournal.get_id(StoreJournal.get_path(self._store)))
+
     def _release_lock(self):
         assert self.__locked_fh is not None, 'double release'
 
@@ -934,6 +2263,19 @@ class Qubes(qubes.PropertyHolder):
             labels.append(label.__xml__())
         return labels
 
+    def xml_pools(self):
+        '''Serialise pools
+
+        :rtype: lxml.etree._Element
+        '''
+
+        pools = lxml.etree.Element('pools')
+        for pool in self.pools.values():
+            xml = pool.__xml__()
+            if xml is not None:
+                pools.append(xml)
+        return pools
+
     @staticmethod
     def get_vm_class(clsname):
         '''Find the class for a domain.
@@ -960,17 +2302,25 @@ class Qubes(qubes.PropertyHolder):
 
         if qid is None:
             qid = self.domains.get_new_unused_qid()
+            release_qid = True
+        else:
+            release_qid = False
 
-        if isinstance(cls, str):
-            cls = self.get_vm_class(cls)
-        # handle default template; specifically allow template=None (do not
-        # override it with default template)
-        if 'template' not in kwargs and hasattr(cls, 'template'):
-            kwargs['template'] = self.default_template
-        elif 'template' in kwargs and isinstance(kwargs['template'], str):
-            kwargs['template'] = self.domains[kwargs['template']]
-
-        return self.domains.add(cls(self, None, qid=qid, **kwargs))
+        try:
+            if isinstance(cls, str):
+                cls = self.get_vm_class(cls)
+            # handle default template; specifically allow template=None (do
+            # not override it with default template)
+            if 'template' not in kwargs and hasattr(cls, 'template'):
+                kwargs['template'] = self.default_template
+            elif 'template' in kwargs and isinstance(kwargs['template'], str):
+                kwargs['template'] = self.domains[kwargs['template']]
+
+            return self.domains.add(cls(self, None, qid=qid, **kwargs))
+        finally:
+            # no-op if the VM was added
+            if release_qid:
+                self.domains.release_qid(qid)
 
     def get_label(self, label):
         '''Get label as identified by index or name
@@ -1080,6 +2430,13 @@ class Qubes(qubes.PropertyHolder):
                 pass
 
 
+    @qubes.events.handler('*')
+    def on_event_invalidate_xml(self, event, **kwargs):
+        '''Drop cached XML representation of global properties'''
+        # pylint: disable=unused-argument
+        if event.startswith(('property-set:', 'property-del:')):
+            self._xml_properties = None
+
     @qubes.events.handler('property-pre-set:clockvm')
     def on_property_pre_set_clockvm(self, event, name, newvalue, oldvalue=None):
         # pylint: disable=unused-argument,no-self-use
@@ -1111,21 +2468,39 @@ class Qubes(qubes.PropertyHolder):
     def on_property_set_default_fw_netvm(self, event, name, newvalue,
             oldvalue=None):
         # pylint: disable=unused-argument,invalid-name
-        for vm in self.domains:
-            if not vm.provides_network and vm.property_is_default('netvm'):
+        # only domains which used the old default can be affected
+        for vm in self.domains.get_dependents('netvm', oldvalue):
+            if hasattr(vm, 'netvm') and vm.provides_network \
+                    and vm.property_is_default('netvm'):
                 # fire property-del:netvm as it is responsible for resetting
                 # netvm to it's default value
                 vm.fire_event('property-del:netvm',
-                    name='netvm', newvalue=newvalue, oldvalue=oldvalue)
+                    name='netvm', oldvalue=oldvalue)
 
 
     @qubes.events.handler('property-set:default_netvm')
     def on_property_set_default_netvm(self, event, name, newvalue,
             oldvalue=None):
         # pylint: disable=unused-argument
-        for vm in self.domains:
-            if hasattr(vm, 'netvm') and vm.property_is_default('netvm'):
+        # only domains which used the old default can be affected
+        for vm in self.domains.get_dependents('netvm', oldvalue):
+            if hasattr(vm, 'netvm') and not vm.provides_network \
+                    and vm.property_is_default('netvm'):
                 # fire property-del:netvm as it is responsible for resetting
                 # netvm to it's default value
                 vm.fire_event('property-del:netvm',
                     name='netvm', oldvalue=oldvalue)
+
+
+    @qubes.events.handler(
+        'property-del:default_netvm',
+        'property-del:default_fw_netvm',
+        'property-set:default_dispvm',
+        'property-del:default_dispvm')
+    def on_property_default_vm_changed(self, event, name, newvalue=None,
+            oldvalue=None):
+        '''Refresh dependency index of domains using changed default'''
+        # pylint: disable=unused-argument
+        prop = 'default_dispvm' if name == 'default_dispvm' else 'netvm'
+        for vm in self.domains.get_dependents(prop, oldvalue):
+            self.domains.update_dependencies(vm)
@@ -25,9 +25,13 @@ Events are fired when something happens, like VM start or stop, property change
 etc.
 '''
 
+import asyncio
 import collections
-
 import itertools
+import math
+import time
+
+import qubes.exc
 
 
 def handler(*events):
@@ -37,8 +41,13 @@ def handler(*events):
     decorator.
 
     It probably makes no sense to specify more than one handler for specific
-    event in one class, because handlers are not run concurrently and there is
-    no guarantee of the order of execution.
+    event in one class, because there is no guarantee of the order of
+    execution.
+
+    Handler may be a coroutine function (decorate it with
+    :py:func:`asyncio.coroutine` *before* this decorator). Such events have to
+    be fired with :py:meth:`Emitter.fire_event_async` or
+    :py:meth:`Emitter.fire_event_pre_async`.
 
     .. note::
         For hooking events from extensions, see :py:func:`qubes.ext.handler`.
@@ -69,10 +78,22 @@ def ishandler(obj):
 
 
 class EmitterMeta(type):
-    '''Metaclass for :py:class:`Emitter`'''
+    '''Metaclass for :py:class:`Emitter`
+
+    Handlers of a class, including those inherited from its bases, are put in
+    order once per event and cached (see :py:meth:`Emitter._class_handlers`).
+    Adding or removing a handler of any class invalidates caches of all
+    classes, as subclasses inherit handlers.
+    '''
+
+    #: incremented on each change of handlers of any class
+    generation = 0
+
     def __init__(cls, name, bases, dict_):
         super(EmitterMeta, cls).__init__(name, bases, dict_)
         cls.__handlers__ = collections.defaultdict(set)
+        # (event, pre) -> (generation, ordered handlers)
+        cls._class_handler_chains = {}
 
         try:
             propnames = set(prop.__name__ for prop in cls.property_list())
@@ -93,6 +114,179 @@ class EmitterMeta(type):
                 cls.__handlers__[event].add(attr)
 
 
+class HandlerChain(collections.namedtuple('HandlerChain',
+        ('handlers', 'groups', 'has_coroutines'))):
+    '''Handlers for one event, in order of invocation.
+
+    :param tuple handlers: all the handlers
+    :param tuple groups: *handlers* split into groups (bound or extension
+        handlers of one class or instance), which may be run concurrently
+        by :py:meth:`Emitter.fire_event_async`
+    :param bool has_coroutines: whether any of the handlers is a coroutine
+        function
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def from_groups(cls, groups):
+        '''Make chain of handlers from an iterable of groups'''
+        groups = tuple(groups)
+        handlers = tuple(itertools.chain.from_iterable(groups))
+        return cls(handlers, groups,
+            any(asyncio.iscoroutinefunction(func) for func in handlers))
+
+
+def _handlers_changed(subject):
+    '''Invalidate cached handler chains after change of *subject*'s handlers
+
+    :param subject: :py:class:`Emitter` instance or subclass
+    '''
+    if isinstance(subject, type):
+        EmitterMeta.generation += 1
+    else:
+        subject._handler_chains.clear()  # pylint: disable=protected-access
+
+
+class HandlerStats(object):
+    '''Call count and histogram of latencies of one handler or event'''
+    # pylint: disable=too-few-public-methods
+    __slots__ = ('count', 'total', 'histogram')
+
+    #: upper bounds of histogram buckets, in seconds
+    buckets = (0.0001, 0.001, 0.01, 0.1, 1, 10, math.inf)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.histogram = [0] * len(self.buckets)
+
+    def record(self, elapsed):
+        '''Record single call which took *elapsed* seconds'''
+        self.count += 1
+        self.total += elapsed
+        for i, bound in enumerate(self.buckets):
+            if elapsed <= bound:
+                self.histogram[i] += 1
+                break
+
+    def __str__(self):
+        return 'count={} total={:.6f} histogram={}'.format(self.count,
+            self.total, ','.join('{}:{}'.format(bound, count)
+                for bound, count in zip(self.buckets, self.histogram)))
+
+
+class EventProfiler(object):
+    '''Statistics of event dispatch.
+
+    When enabled (see :py:func:`enable_profiling`), calls of all the handlers
+    are timed, per event and handler. Total time of firing each event is
+    recorded too.
+    '''
+
+    def __init__(self):
+        #: event -> :py:class:`HandlerStats` of whole event
+        self.events = collections.defaultdict(HandlerStats)
+        #: (event, handler) -> :py:class:`HandlerStats`
+        self.handlers = collections.defaultdict(HandlerStats)
+
+    def clear(self):
+        '''Forget all the statistics collected so far'''
+        self.events.clear()
+        self.handlers.clear()
+
+    def fire_event(self, subject, event, handlers, kwargs):
+        '''Call *handlers* like :py:meth:`Emitter.fire_event` does, timing
+        them'''
+        effects = []
+        event_start = time.perf_counter()
+        try:
+            for func in handlers:
+                effect = self.call_handler(subject, event, func, kwargs)
+                if effect is not None:
+                    effects.extend(effect)
+        finally:
+            self.events[event].record(time.perf_counter() - event_start)
+        return effects
+
+    def call_handler(self, subject, event, func, kwargs):
+        '''Call synchronous handler *func*, timing it'''
+        start = time.perf_counter()
+        try:
+            return func(subject, event, **kwargs)
+        finally:
+            self.handlers[(event, func)].record(time.perf_counter() - start)
+
+    @asyncio.coroutine
+    def run_coroutine(self, event, func, coro):
+        '''Run coroutine *coro* of handler *func*, timing it'''
+        start = time.perf_counter()
+        try:
+            return (yield from coro)
+        finally:
+            self.handlers[(event, func)].record(time.perf_counter() - start)
+
+    @staticmethod
+    def handler_name(func):
+        '''Qualified name of a handler'''
+        return '{}.{}'.format(getattr(func, '__module__', None),
+            getattr(func, '__qualname__', repr(func)))
+
+    def format_stats(self):
+        '''Statistics as text, sorted by event and handler name.
+
+        For each event there is one line with totals for the event, followed
+        by lines for its handlers::
+
+            event <event> count=<n> total=<seconds> histogram=<buckets>
+            handler <event> <handler> count=<n> total=<seconds> \\
+                histogram=<buckets>
+
+        where ``<buckets>`` is a comma-separated list of ``<bound>:<count>``,
+        counting calls which took more than the previous *bound*, and at most
+        this *bound* seconds.
+        '''
+
+        handlers = collections.defaultdict(list)
+        for (event, func), stats in list(self.handlers.items()):
+            handlers[event].append((self.handler_name(func), stats))
+
+        lines = []
+        for event in sorted(set(self.events) | set(handlers)):
+            if event in self.events:
+                lines.append('event {} {}\n'.format(event,
+                    self.events[event]))
+            for name, stats in sorted(handlers[event], key=lambda x: x[0]):
+                lines.append('handler {} {} {}\n'.format(event, name, stats))
+        return ''.join(lines)
+
+
+#: the active :py:class:`EventProfiler`, or :py:obj:`None`
+_profiler = None
+
+
+def enable_profiling():
+    '''Start timing event handlers.
+
+    :returns: the active :py:class:`EventProfiler`
+    '''
+    global _profiler  # pylint: disable=global-statement
+    if _profiler is None:
+        _profiler = EventProfiler()
+    return _profiler
+
+
+def disable_profiling():
+    '''Stop timing event handlers and drop statistics collected so far'''
+    global _profiler  # pylint: disable=global-statement
+    _profiler = None
+
+
+def get_profiler():
+    '''The active :py:class:`EventProfiler`, or :py:obj:`None` when profiling
+    is disabled'''
+    return _profiler
+
+
 class Emitter(object, metaclass=EmitterMeta):
     '''Subject that can emit events.
 
@@ -105,12 +299,17 @@ class Emitter(object, metaclass=EmitterMeta):
         if not hasattr(self, 'events_enabled'):
             self.events_enabled = False
         self.__handlers__ = collections.defaultdict(set)
+        # (event, pre) -> (generation, handlers including those of this very
+        # instance), used only if there are any
+        self._handler_chains = {}
 
 
     def add_handler(self, event, func):
-        '''Add event handler to subject's class.
+        '''Add event handler to subject.
 
-        This is class method, it is invalid to call it on object instance.
+        This is usually called on instance. To add handler to a class (and
+        all its instances), call it as ``Emitter.add_handler(cls, event,
+        func)``.
 
         :param str event: event identificator
         :param collections.Callable handler: handler callable
@@ -118,13 +317,12 @@ class Emitter(object, metaclass=EmitterMeta):
 
         # pylint: disable=no-member
         self.__handlers__[event].add(func)
+        _handlers_changed(self)
 
     def remove_handler(self, event, func):
-        '''Remove event handler from subject's class.
-
-        This is class method, it is invalid to call it on object instance.
+        '''Remove event handler from subject.
 
-        This method must be called on the same class as
+        This method must be called on the same object (class or instance) as
         :py:meth:`add_handler` was called to register the handler.
 
         :param str event: event identificator
@@ -133,9 +331,84 @@ class Emitter(object, metaclass=EmitterMeta):
 
         # pylint: disable=no-member
         self.__handlers__[event].remove(func)
+        _handlers_changed(self)
+
+    @staticmethod
+    def _grouped_handlers(handlers_dict, event):
+        '''Handlers for *event* from one class or instance, grouped: bound
+        handlers (specified in class definition) first, then the rest'''
+        handlers = handlers_dict.get(event, set())
+        if '*' in handlers_dict:
+            handlers = handlers_dict['*'] | handlers
+        bound = tuple(func for func in handlers if hasattr(func, 'ha_bound'))
+        unbound = tuple(func for func in handlers
+            if not hasattr(func, 'ha_bound'))
+        return tuple(group for group in (bound, unbound) if group)
+
+    @classmethod
+    def _class_handlers(cls, event, pre):
+        '''Handlers for *event* of this class and all parent classes.
+
+        Classes are in reversed method resolution order, or in true order
+        when *pre* is :py:obj:`True`.
+
+        :rtype: HandlerChain
+        '''
+
+        key = (event, pre)
+        try:
+            generation, chain = cls._class_handler_chains[key]
+            if generation == EmitterMeta.generation:
+                return chain
+        except KeyError:
+            pass
+
+        groups = []
+        for i in (cls.__mro__ if pre else reversed(cls.__mro__)):
+            try:
+                handlers_dict = i.__handlers__
+            except AttributeError:
+                continue
+            groups.extend(cls._grouped_handlers(handlers_dict, event))
+        chain = HandlerChain.from_groups(groups)
+        cls._class_handler_chains[key] = (EmitterMeta.generation, chain)
+        return chain
 
-    def _fire_event_in_order(self, order, event, kwargs):
-        '''Fire event for classes in given order.
+    def _get_handlers(self, event, pre):
+        '''All handlers for *event*, in order of invocation.
+
+        Do not use this method. Use :py:meth:`fire_event` or
+        :py:meth:`fire_event_pre`.
+
+        :rtype: HandlerChain
+        '''
+
+        class_chain = self._class_handlers(event, pre)
+        if not self.__handlers__:
+            return class_chain
+
+        key = (event, pre)
+        try:
+            generation, chain = self._handler_chains[key]
+            if generation == EmitterMeta.generation:
+                return chain
+        except KeyError:
+            pass
+
+        instance_groups = self._grouped_handlers(self.__handlers__, event)
+        if not instance_groups:
+            chain = class_chain
+        elif pre:
+            chain = HandlerChain.from_groups(
+                instance_groups + class_chain.groups)
+        else:
+            chain = HandlerChain.from_groups(
+                class_chain.groups + instance_groups)
+        self._handler_chains[key] = (EmitterMeta.generation, chain)
+        return chain
+
+    def _fire_event(self, event, kwargs, pre=False):
+        '''Fire event.
 
         Do not use this method. Use :py:meth:`fire_event` or
         :py:meth:`fire_event_pre`.
@@ -144,21 +417,69 @@ class Emitter(object, metaclass=EmitterMeta):
         if not self.events_enabled:
             return []
 
+        chain = self._get_handlers(event, pre)
+        if chain.has_coroutines:
+            raise qubes.exc.QubesException(
+                'Event {!r} has coroutine handlers, fire it with '
+                'fire_event_async()'.format(event))
+
+        if _profiler is not None:
+            return _profiler.fire_event(self, event, chain.handlers, kwargs)
+
         effects = []
-        for i in order:
-            try:
-                handlers_dict = i.__handlers__
-            except AttributeError:
-                continue
-            handlers = handlers_dict.get(event, set())
-            if '*' in handlers_dict:
-                handlers = handlers_dict['*'] | handlers
-            for func in sorted(handlers,
-                    key=(lambda handler: hasattr(handler, 'ha_bound')),
-                    reverse=True):
-                effect = func(self, event, **kwargs)
-                if effect is not None:
-                    effects.extend(effect)
+        for func in chain.handlers:
+            effect = func(self, event, **kwargs)
+            if effect is not None:
+                effects.extend(effect)
+        return effects
+
+    @asyncio.coroutine
+    def _fire_event_async(self, event, kwargs, pre=False):
+        '''Fire event, running coroutine handlers concurrently.
+
+        Do not use this method. Use :py:meth:`fire_event_async` or
+        :py:meth:`fire_event_pre_async`.
+        '''
+
+        if not self.events_enabled:
+            return []
+
+        profiler = _profiler
+        if profiler is not None:
+            event_start = time.perf_counter()
+
+        effects = []
+        try:
+            for group in self._get_handlers(event, pre).groups:
+                tasks = []
+                for func in group:
+                    if asyncio.iscoroutinefunction(func):
+                        coro = func(self, event, **kwargs)
+                        if profiler is not None:
+                            coro = profiler.run_coroutine(event, func, coro)
+                        tasks.append(asyncio.ensure_future(coro))
+                        continue
+                    if profiler is not None:
+                        effect = profiler.call_handler(self, event, func,
+                            kwargs)
+                    else:
+                        effect = func(self, event, **kwargs)
+                    if effect is not None:
+                        effects.extend(effect)
+
+                if not tasks:
+                    continue
+                # let all of them finish, even if one fails, then raise the
+                # first exception in order of invocation
+                yield from asyncio.wait(tasks)
+                for task in tasks:
+                    effect = task.result()
+                    if effect is not None:
+                        effects.extend(effect)
+        finally:
+            if profiler is not None:
+                profiler.events[event].record(
+                    time.perf_counter() - event_start)
         return effects
 
     def fire_event(self, event, **kwargs):
@@ -174,14 +495,14 @@ class Emitter(object, metaclass=EmitterMeta):
 
         :param str event: event identificator
         :returns: list of effects
+        :raises qubes.exc.QubesException: when any of the handlers is \
+            a coroutine function
 
         All *kwargs* are passed verbatim. They are different for different
         events.
         '''
 
-        return self._fire_event_in_order(
-            itertools.chain(reversed(self.__class__.__mro__), (self,)),
-            event, kwargs)
+        return self._fire_event(event, kwargs)
 
 
     def fire_event_pre(self, event, **kwargs):
@@ -201,6 +522,43 @@ class Emitter(object, metaclass=EmitterMeta):
         events.
         '''
 
-        return self._fire_event_in_order(
-            itertools.chain((self,), self.__class__.__mro__),
-            event, kwargs)
+        return self._fire_event(event, kwargs, pre=True)
+
+    @asyncio.coroutine
+    def fire_event_async(self, event, **kwargs):
+        '''Call all handlers for an event, allowing coroutines.
+
+        Handlers are called in the same order as in :py:meth:`fire_event`.
+        Coroutine handlers of one group (that is bound handlers of one class,
+        or handlers from extensions for one class) are run concurrently, and
+        all of them are finished before any handler of the next group is
+        called. Synchronous handlers are just called in order.
+
+        If any handler raises an exception, the other handlers of its group
+        are still finished, but no further group is run.
+
+        This method is a coroutine.
+
+        .. seealso::
+            :py:meth:`fire_event_pre_async`
+
+        :param str event: event identificator
+        :returns: list of effects
+        '''
+
+        return (yield from self._fire_event_async(event, kwargs))
+
+    @asyncio.coroutine
+    def fire_event_pre_async(self, event, **kwargs):
+        '''Call all handlers for an event, allowing coroutines.
+
+        Handlers are called in the same order as in :py:meth:`fire_event_pre`,
+        see :py:meth:`fire_event_async` for how coroutines are run.
+
+        This method is a coroutine.
+
+        :param str event: event identificator
+        :returns: list of effects
+        '''
+
+        return (yield from self._fire_event_async(event, kwargs, pre=True))
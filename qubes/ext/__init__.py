@@ -26,8 +26,8 @@ some systems. They may be OS- or architecture-dependent or custom-developed for
 particular customer.
 '''
 
-import pkg_resources
 import qubes.events
+import qubes.utils
 
 
 class Extension(object):
@@ -45,19 +45,20 @@ class Extension(object):
 
                 if attr.ha_vm is not None:
                     for event in attr.ha_events:
-                        attr.ha_vm.__handlers__[event].add(attr)
+                        qubes.events.Emitter.add_handler(attr.ha_vm, event,
+                            attr)
                 else:
                     # global hook
                     for event in attr.ha_events:
-                        # pylint: disable=no-member
-                        qubes.Qubes.__handlers__[event].add(attr)
+                        qubes.events.Emitter.add_handler(qubes.Qubes, event,
+                            attr)
 
         return cls._instance
 
 
 def get_extensions():
-    return set(ext.load()()
-        for ext in pkg_resources.iter_entry_points('qubes.ext'))
+    return set(qubes.utils.load_entry_point(ext)()
+        for ext in qubes.utils.iter_entry_points('qubes.ext'))
 
 
 def handler(*events, **kwargs):
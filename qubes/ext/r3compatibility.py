@@ -20,6 +20,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import asyncio
 import datetime
 import qubes.ext
 import qubes.firewall
@@ -44,6 +45,12 @@ class R3Compatibility(qubes.ext.Extension):
 
     }
 
+    def __init__(self):
+        super(R3Compatibility, self).__init__()
+        #: firewall VM -> pending rewrite of its iptables rules, see
+        #: :py:meth:`update_iptables_qubesdb_entry`
+        self._pending_iptables = {}
+
     # noinspection PyUnusedLocal
     @qubes.ext.handler('domain-qdb-create')
     def on_domain_qdb_create(self, vm, event):
@@ -68,10 +75,35 @@ class R3Compatibility(qubes.ext.Extension):
         self.write_services(vm)
 
     @qubes.ext.handler('domain-spawn')
+    @asyncio.coroutine
     def on_domain_started(self, vm, event, **kwargs):
         # pylint: disable=unused-argument
         if vm.netvm:
-            self.write_iptables_qubesdb_entry(vm.netvm)
+            yield from self.update_iptables_qubesdb_entry(vm.netvm)
+
+    @asyncio.coroutine
+    def update_iptables_qubesdb_entry(self, firewallvm):
+        '''Rewrite iptables rules in QubesDB of *firewallvm*.
+
+        Rules of all the connected domains are rewritten, so when several of
+        them are starting at the same time, they share a single rewrite.
+
+        This method is a coroutine.
+        '''
+        try:
+            pending = self._pending_iptables[firewallvm]
+        except KeyError:
+            pending = asyncio.ensure_future(
+                self._write_iptables_qubesdb_entry_soon(firewallvm))
+            self._pending_iptables[firewallvm] = pending
+        yield from asyncio.shield(pending)
+
+    @asyncio.coroutine
+    def _write_iptables_qubesdb_entry_soon(self, firewallvm):
+        # let the other domains starting now join this write
+        yield from asyncio.sleep(0)
+        del self._pending_iptables[firewallvm]
+        self.write_iptables_qubesdb_entry(firewallvm)
 
     @qubes.ext.handler('firewall-changed')
     def on_firewall_changed(self, vm, event):
@@ -34,7 +34,6 @@ from datetime import datetime
 
 import asyncio
 import lxml.etree
-import pkg_resources
 import qubes
 import qubes.exc
 import qubes.utils
@@ -408,11 +407,22 @@ class Storage(object):
         ret = volume.resize(size)
         if asyncio.iscoroutine(ret):
             yield from ret
+        self.vm.fire_event('domain-volume-config-changed')
         if self.vm.is_running():
             yield from self.vm.run_service_for_stdio('qubes.ResizeDisk',
                 input=volume.name.encode(),
                 user='root')
 
+    @asyncio.coroutine
+    def revert(self, volume, revision=None):
+        ''' Revert volume to previous revision '''
+        if isinstance(volume, str):
+            volume = self.vm.volumes[volume]
+        ret = volume.revert(revision)
+        if asyncio.iscoroutine(ret):
+            yield from ret
+        self.vm.fire_event('domain-volume-config-changed')
+
     @asyncio.coroutine
     def create(self):
         ''' Creates volumes on disk '''
@@ -429,6 +439,7 @@ class Storage(object):
             yield from asyncio.wait(coros)
 
         os.umask(old_umask)
+        self.vm.fire_event('domain-volume-config-changed')
 
     @asyncio.coroutine
     def clone_volume(self, src_vm, name):
@@ -458,6 +469,7 @@ class Storage(object):
         if asyncio.iscoroutine(clone_op_ret):
             clone_op_ret = yield from clone_op_ret
         self.vm.volumes[name] = clone_op_ret
+        self.vm.fire_event('domain-volume-config-changed')
         return self.vm.volumes[name]
 
     @asyncio.coroutine
@@ -489,6 +501,7 @@ class Storage(object):
         for name, volume in volumes.items():
             pool = volume.pool
             volumes[name] = pool.rename(volume, old_name, new_name)
+        self.vm.fire_event('domain-volume-config-changed')
 
     @asyncio.coroutine
     def verify(self):
@@ -543,6 +556,7 @@ class Storage(object):
 
         if futures:
             yield from asyncio.wait(futures)
+        self.vm.fire_event('domain-volume-config-changed')
 
     @asyncio.coroutine
     def stop(self):
@@ -555,6 +569,7 @@ class Storage(object):
 
         if futures:
             yield from asyncio.wait(futures)
+        self.vm.fire_event('domain-volume-config-changed')
 
     @asyncio.coroutine
     def commit(self):
@@ -568,6 +583,7 @@ class Storage(object):
 
         if futures:
             yield asyncio.wait(futures)
+        self.vm.fire_event('domain-volume-config-changed')
 
     def unused_frontend(self):
         ''' Find an unused device name '''
@@ -608,10 +624,11 @@ class Storage(object):
         assert isinstance(volume, (Volume, str)), \
             "You need to pass a Volume or pool name as str"
         if isinstance(volume, Volume):
-            return volume.import_data_end(volume,
-                success=success)
-
-        return self.vm.volumes[volume].import_data_end(success=success)
+            ret = volume.import_data_end(volume, success=success)
+        else:
+            ret = self.vm.volumes[volume].import_data_end(success=success)
+        self.vm.fire_event('domain-volume-config-changed')
+        return ret
 
 
 class Pool(object):
@@ -710,7 +727,7 @@ def _sanitize_config(config):
 def pool_drivers():
     """ Return a list of EntryPoints names """
     return [ep.name
-            for ep in pkg_resources.iter_entry_points(STORAGE_ENTRY_POINT)]
+            for ep in qubes.utils.iter_entry_points(STORAGE_ENTRY_POINT)]
 
 
 def driver_parameters(name):
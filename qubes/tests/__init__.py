@@ -58,6 +58,7 @@ import qubes.config
 import qubes.devices
 import qubes.events
 import qubes.exc
+import qubes.utils
 import qubes.vm.standalonevm
 
 XMLPATH = '/var/lib/qubes/qubes-test.xml'
@@ -147,24 +148,36 @@ class TestEmitter(qubes.events.Emitter):
         #: :py:class:`collections.Counter` instance
         self.fired_events = collections.Counter()
 
-    def fire_event(self, event, **kwargs):
-        effects = super(TestEmitter, self).fire_event(event, **kwargs)
+    def _record_event(self, event, kwargs):
         ev_kwargs = frozenset(
             (key,
                 frozenset(value.items()) if isinstance(value, dict) else value)
             for key, value in kwargs.items()
         )
         self.fired_events[(event, ev_kwargs)] += 1
+
+    def fire_event(self, event, **kwargs):
+        effects = super(TestEmitter, self).fire_event(event, **kwargs)
+        self._record_event(event, kwargs)
         return effects
 
     def fire_event_pre(self, event, **kwargs):
         effects = super(TestEmitter, self).fire_event_pre(event, **kwargs)
-        ev_kwargs = frozenset(
-            (key,
-                frozenset(value.items()) if isinstance(value, dict) else value)
-            for key, value in kwargs.items()
-        )
-        self.fired_events[(event, ev_kwargs)] += 1
+        self._record_event(event, kwargs)
+        return effects
+
+    @asyncio.coroutine
+    def fire_event_async(self, event, **kwargs):
+        effects = yield from super(TestEmitter, self).fire_event_async(event,
+            **kwargs)
+        self._record_event(event, kwargs)
+        return effects
+
+    @asyncio.coroutine
+    def fire_event_pre_async(self, event, **kwargs):
+        effects = yield from super(TestEmitter, self).fire_event_pre_async(
+            event, **kwargs)
+        self._record_event(event, kwargs)
         return effects
 
 def expectedFailureIfTemplate(templates):
@@ -297,7 +310,9 @@ class substitute_entry_points(object):
     :param str tempgroup: The substitute group.
 
     Inside this context, if one iterates over entry points in overloaded group,
-    the iteration actually happens over the other group.
+    the iteration actually happens over the other group. Entry point registry
+    of :py:func:`qubes.utils.iter_entry_points` is cleared on both entering
+    and leaving the context.
 
     This context manager is stackable. To substitute more than one entry point
     group, just nest two contexts.
@@ -316,11 +331,13 @@ class substitute_entry_points(object):
     def __enter__(self):
         self._orig_iter_entry_points = pkg_resources.iter_entry_points
         pkg_resources.iter_entry_points = self._iter_entry_points
+        qubes.utils.clear_entry_points_cache()
         return self
 
     def __exit__(self, exc_type, exc_value, tb):
         pkg_resources.iter_entry_points = self._orig_iter_entry_points
         self._orig_iter_entry_points = None
+        qubes.utils.clear_entry_points_cache()
 
 
 class BeforeCleanExit(BaseException):
@@ -19,15 +19,22 @@
 # with this program; if not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
+import os
 import socket
+import tempfile
 import unittest.mock
 
 import qubes.api
+import qubes.api.scheduler
+import qubes.exc
 import qubes.tests
 
 
 class TestMgmt(object):
-    def __init__(self, app, src, method, dest, arg, send_event=None):
+    API_NAME = 'test'
+
+    def __init__(self, app, src, method, dest, arg, send_event=None,
+            drain_events=None):
         self.app = app
         self.src = src
         self.method = method
@@ -41,6 +48,10 @@ class TestMgmt(object):
                 'mgmt.qubesexception': self.qubesexception,
                 'mgmt.exception': self.exception,
                 'mgmt.event': self.event,
+                'mgmt.stream': self.stream,
+                'mgmt.stream_exception': self.stream_exception,
+                'mgmt.stream_async': self.stream_async,
+                'mgmt.stream_big': self.stream_big,
             }[self.method.decode()]
         except KeyError:
             raise qubes.api.ProtocolError('Invalid method')
@@ -88,6 +99,35 @@ class TestMgmt(object):
         except asyncio.CancelledError:
             pass
 
+    @asyncio.coroutine
+    def stream(self, untrusted_payload):
+        return qubes.api.StreamedResponse(
+            'line {}\n'.format(i) for i in range(3))
+
+    @asyncio.coroutine
+    def stream_exception(self, untrusted_payload):
+        def lines():
+            yield 'line 0\n'
+            raise Exception('exception')
+        return qubes.api.StreamedResponse(lines())
+
+    @asyncio.coroutine
+    def stream_async(self, untrusted_payload):
+        @asyncio.coroutine
+        def line(i):
+            yield from asyncio.sleep(0)
+            return 'line {}\n'.format(i)
+        return qubes.api.StreamedResponse(line(i) for i in range(3))
+
+    @asyncio.coroutine
+    def stream_big(self, untrusted_payload):
+        self.produced = 0
+        def chunks():
+            for _ in range(4):
+                self.produced += 1
+                yield 'x' * 65536
+        return qubes.api.StreamedResponse(chunks())
+
 class TC_00_QubesDaemonProtocol(qubes.tests.QubesTestCase):
     def setUp(self):
         super(TC_00_QubesDaemonProtocol, self).setUp()
@@ -171,3 +211,423 @@ class TC_00_QubesDaemonProtocol(qubes.tests.QubesTestCase):
         with self.assertNotRaises(asyncio.TimeoutError):
             self.loop.run_until_complete(
                 asyncio.wait_for(self.protocol.mgmt.task, 1))
+
+    def test_006_stream(self):
+        self.writer.write(b'dom0\0mgmt.stream\0dom0\0arg\0payload')
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(response, b"0\0line 0\nline 1\nline 2\n")
+
+    def test_007_stream_exception(self):
+        self.writer.write(
+            b'dom0\0mgmt.stream_exception\0dom0\0arg\0payload')
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        # connection aborted, the (partial) reply cannot be trusted
+        self.assertTrue(self.protocol.transport is None or
+            self.protocol.transport.is_closing())
+
+    def test_008_stream_async(self):
+        self.writer.write(b'dom0\0mgmt.stream_async\0dom0\0arg\0payload')
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(response, b"0\0line 0\nline 1\nline 2\n")
+
+    def test_009_stream_paused(self):
+        self.protocol.pause_writing()
+        self.writer.write(b'dom0\0mgmt.stream_big\0dom0\0arg\0payload')
+        self.writer.write_eof()
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        # waits for the client before producing more
+        self.assertEqual(self.protocol.mgmt.produced, 1)
+        self.protocol.resume_writing()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(response, b'0\0' + b'x' * 65536 * 4)
+        self.assertEqual(self.protocol.mgmt.produced, 4)
+
+    def pipelined_request(self, request_id, request):
+        return qubes.api.QubesDaemonProtocol.frame_header.pack(
+            request_id, len(request)) + request
+
+    def read_frame(self):
+        header = self.loop.run_until_complete(asyncio.wait_for(
+            self.reader.readexactly(
+                qubes.api.QubesDaemonProtocol.frame_header.size), 1))
+        request_id, length = \
+            qubes.api.QubesDaemonProtocol.frame_header.unpack(header)
+        data = self.loop.run_until_complete(asyncio.wait_for(
+            self.reader.readexactly(length), 1))
+        return request_id, data
+
+    def read_replies(self, count):
+        replies = {}
+        complete = {}
+        while len(complete) < count:
+            request_id, data = self.read_frame()
+            if data:
+                replies[request_id] = replies.get(request_id, b'') + data
+            else:
+                complete[request_id] = replies.pop(request_id, b'')
+        return complete
+
+    def test_010_pipelined(self):
+        self.writer.write(qubes.api.PIPELINED_MAGIC + b'\x01')
+        self.writer.write(self.pipelined_request(1,
+            b'dom0\0mgmt.success\0dom0\0arg\0payload'))
+        self.writer.write(self.pipelined_request(2,
+            b'dom0\0mgmt.stream\0dom0\0arg\0'))
+        self.writer.write(self.pipelined_request(3,
+            b'dom0\0mgmt.qubesexception\0dom0\0arg\0'))
+        with self.assertNotRaises(asyncio.TimeoutError):
+            preamble = self.loop.run_until_complete(asyncio.wait_for(
+                self.reader.readexactly(len(qubes.api.PIPELINED_MAGIC) + 1),
+                1))
+            replies = self.read_replies(3)
+        self.assertEqual(preamble, qubes.api.PIPELINED_MAGIC + b'\x01')
+        self.assertEqual(replies, {
+            1: b"0\0src: b'dom0', dest: b'dom0', arg: b'arg', "
+               b"payload: b'payload'",
+            2: b"0\0line 0\nline 1\nline 2\n",
+            3: b"2\0QubesException\0\0qubes-exception\0",
+        })
+
+        # the connection is still usable
+        self.writer.write(self.pipelined_request(4,
+            b'dom0\0mgmt.success_none\0dom0\0arg\0'))
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            replies = self.read_replies(1)
+            rest = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(replies, {4: b'0\0'})
+        self.assertEqual(rest, b'')
+
+    def test_011_pipelined_error(self):
+        self.writer.write(qubes.api.PIPELINED_MAGIC + b'\x01')
+        self.writer.write(self.pipelined_request(1,
+            b'dom0\0mgmt.exception\0dom0\0arg\0'))
+        self.writer.write(self.pipelined_request(2,
+            b'dom0\0mgmt.no_such_method\0dom0\0arg\0'))
+        self.writer.write(self.pipelined_request(3,
+            b'dom0\0mgmt.success_none\0dom0\0arg\0'))
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(asyncio.wait_for(
+                self.reader.readexactly(len(qubes.api.PIPELINED_MAGIC) + 1),
+                1))
+            replies = self.read_replies(3)
+        # failed calls get empty reply, instead of aborted connection
+        self.assertEqual(replies, {1: b'', 2: b'', 3: b'0\0'})
+
+    def test_012_pipelined_split_preamble(self):
+        self.writer.write(qubes.api.PIPELINED_MAGIC[:3])
+        self.loop.run_until_complete(self.writer.drain())
+        self.writer.write(qubes.api.PIPELINED_MAGIC[3:] + b'\x01' +
+            self.pipelined_request(7,
+                b'dom0\0mgmt.success_none\0dom0\0arg\0')[:5])
+        self.loop.run_until_complete(self.writer.drain())
+        self.writer.write(self.pipelined_request(7,
+            b'dom0\0mgmt.success_none\0dom0\0arg\0')[5:])
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(asyncio.wait_for(
+                self.reader.readexactly(len(qubes.api.PIPELINED_MAGIC) + 1),
+                1))
+            replies = self.read_replies(1)
+        self.assertEqual(replies, {7: b'0\0'})
+
+    def test_013_pipelined_bad_version(self):
+        self.writer.write(qubes.api.PIPELINED_MAGIC + b'\x7f')
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(response, b'')
+
+    def test_014_pipelined_too_long(self):
+        self.writer.write(qubes.api.PIPELINED_MAGIC + b'\x01')
+        self.writer.write(qubes.api.QubesDaemonProtocol.frame_header.pack(
+            1, qubes.api.QubesDaemonProtocol.buffer_size + 1))
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(response, qubes.api.PIPELINED_MAGIC + b'\x01')
+
+    def test_015_call_stats(self):
+        qubes.api.call_stats.clear()
+        self.addCleanup(qubes.api.call_stats.clear)
+        self.writer.write(b'dom0\0mgmt.success\0dom0\0arg\0payload')
+        self.writer.write_eof()
+        self.loop.run_until_complete(asyncio.wait_for(self.reader.read(), 1))
+        stats = qubes.api.call_stats.methods['mgmt.success']
+        self.assertEqual(stats.latency.count, 1)
+        self.assertEqual(stats.errors, 0)
+        self.assertEqual(stats.payload_bytes, 7)
+
+    def test_016_call_stats_error(self):
+        qubes.api.call_stats.clear()
+        self.addCleanup(qubes.api.call_stats.clear)
+        self.writer.write(b'dom0\0mgmt.qubesexception\0dom0\0arg\0')
+        self.writer.write_eof()
+        self.loop.run_until_complete(asyncio.wait_for(self.reader.read(), 1))
+        stats = qubes.api.call_stats.methods['mgmt.qubesexception']
+        self.assertEqual(stats.latency.count, 1)
+        self.assertEqual(stats.errors, 1)
+
+    def test_017_call_stats_invalid(self):
+        qubes.api.call_stats.clear()
+        self.addCleanup(qubes.api.call_stats.clear)
+        self.writer.write(b'dom0\0mgmt.no_such_method\0dom0\0arg\0')
+        self.writer.write_eof()
+        self.loop.run_until_complete(asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(list(qubes.api.call_stats.methods), ['invalid'])
+        self.assertEqual(qubes.api.call_stats.methods['invalid'].errors, 1)
+
+    def test_018_scheduled_events(self):
+        scheduler = qubes.api.scheduler.CallScheduler()
+        scheduler.configure([], max_in_flight=1)
+        patch = unittest.mock.patch.object(qubes.api.scheduler,
+            'call_scheduler', scheduler)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.writer.write(qubes.api.PIPELINED_MAGIC + b'\x01')
+        self.writer.write(self.pipelined_request(1,
+            b'dom0\0mgmt.event\0dom0\0arg\0payload'))
+        self.writer.write(self.pipelined_request(2,
+            b'dom0\0mgmt.success_none\0dom0\0arg\0'))
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(asyncio.wait_for(
+                self.reader.readexactly(len(qubes.api.PIPELINED_MAGIC) + 1),
+                1))
+            # the call sending events does not hold its slot
+            replies = self.read_replies(1)
+        self.assertEqual(replies, {2: b'0\0'})
+        self.assertEqual(scheduler.in_flight, 0)
+
+
+class TC_10_CallStats(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.stats = qubes.api.CallStats()
+        self.stats.record('admin.vm.List', 0.002, 0, False)
+        self.stats.record('admin.vm.List', 20, 0, True)
+        self.stats.record('admin.vm.Create.AppVM', 0.00001, 20, False)
+
+    def test_000_format_stats(self):
+        self.assertEqual(self.stats.format_stats(),
+            'method admin.vm.Create.AppVM count=1 total=0.000010 '
+                'histogram=0.0001:1,0.001:0,0.01:0,0.1:0,1:0,10:0,inf:0 '
+                'errors=0 payload=20\n'
+            'method admin.vm.List count=2 total=20.002000 '
+                'histogram=0.0001:0,0.001:0,0.01:1,0.1:0,1:0,10:0,inf:1 '
+                'errors=1 payload=0\n')
+
+    def test_001_format_prometheus(self):
+        lines = self.stats.format_prometheus().splitlines()
+        self.assertIn('# TYPE qubesd_calls_total counter', lines)
+        self.assertIn('qubesd_calls_total{method="admin.vm.List"} 2', lines)
+        self.assertIn(
+            'qubesd_call_errors_total{method="admin.vm.List"} 1', lines)
+        self.assertIn('qubesd_call_payload_bytes_total'
+            '{method="admin.vm.Create.AppVM"} 20', lines)
+        # buckets are cumulative
+        self.assertIn('qubesd_call_duration_seconds_bucket'
+            '{method="admin.vm.List",le="0.01"} 1', lines)
+        self.assertIn('qubesd_call_duration_seconds_bucket'
+            '{method="admin.vm.List",le="10"} 1', lines)
+        self.assertIn('qubesd_call_duration_seconds_bucket'
+            '{method="admin.vm.List",le="+Inf"} 2', lines)
+        self.assertIn('qubesd_call_duration_seconds_sum'
+            '{method="admin.vm.List"} 20.002000', lines)
+        self.assertIn('qubesd_call_duration_seconds_count'
+            '{method="admin.vm.List"} 2', lines)
+
+    def test_002_write_prometheus(self):
+        scheduler = qubes.api.scheduler.CallScheduler()
+        scheduler.delayed['sys-net', 'admin'] = 2
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'qubesd.prom')
+            with unittest.mock.patch.object(qubes.api, 'call_stats',
+                    self.stats), \
+                    unittest.mock.patch.object(qubes.api.scheduler,
+                        'call_scheduler', scheduler):
+                qubes.api.write_prometheus(path)
+            with open(path) as stats_file:
+                self.assertEqual(stats_file.read(),
+                    self.stats.format_prometheus()
+                    + scheduler.format_prometheus())
+            self.assertEqual(os.listdir(tmpdir), ['qubesd.prom'])
+
+
+class TC_20_CallScheduler(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.get_event_loop()
+        self.scheduler = qubes.api.scheduler.CallScheduler()
+        self.started = []
+        self.tasks = []
+
+    def tearDown(self):
+        for task in self.tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        super().tearDown()
+
+    def call(self, source, api='admin', duration=None):
+        '''Schedule a call, which takes *duration* seconds (or lasts until
+        the slot is released, if :py:obj:`None`)'''
+        @asyncio.coroutine
+        def coro():
+            slot = yield from self.scheduler.acquire(source, api)
+            self.started.append(source)
+            if duration is not None:
+                yield from asyncio.sleep(duration)
+                slot.release()
+            return slot
+        task = asyncio.ensure_future(coro())
+        self.tasks.append(task)
+        return task
+
+    def run_loop(self, duration=0.01):
+        self.loop.run_until_complete(asyncio.sleep(duration))
+
+    def test_000_unlimited(self):
+        slot = self.loop.run_until_complete(
+            self.scheduler.acquire('test-vm1', 'admin'))
+        self.assertEqual(self.scheduler.in_flight, 1)
+        slot.release()
+        slot.release()
+        self.assertEqual(self.scheduler.in_flight, 0)
+        self.assertEqual(self.scheduler.queues, {})
+        self.assertEqual(self.scheduler.delayed, {})
+
+    def test_001_max_in_flight(self):
+        self.scheduler.configure([('test-vm1', '*', {'max-in-flight': 1})])
+        first = self.call('test-vm1')
+        second = self.call('test-vm1')
+        other = self.call('test-vm2')
+        self.run_loop()
+        self.assertEqual(self.started, ['test-vm1', 'test-vm2'])
+        self.assertEqual(self.scheduler.format_stats(),
+            'queue test-vm1 admin queued=1 in_flight=1 delayed=1\n'
+            'queue test-vm2 admin queued=0 in_flight=1 delayed=0\n')
+        first.result().release()
+        self.run_loop()
+        self.assertTrue(second.done())
+        second.result().release()
+        other.result().release()
+        self.assertEqual(self.scheduler.in_flight, 0)
+
+    def test_002_rate(self):
+        self.scheduler.configure([('*', 'admin', {'rate': 20})])
+        tasks = [self.call('test-vm1', duration=0) for _ in range(21)]
+        tasks.append(self.call('test-vm1', api='misc', duration=0))
+        self.run_loop()
+        # a burst of 20 calls, then the next one after 1/20 s
+        self.assertEqual(len(self.started), 21)
+        self.assertIn('test-vm1', self.started)
+        self.assertFalse(tasks[20].done())
+        self.assertTrue(tasks[21].done())
+        self.loop.run_until_complete(asyncio.wait_for(tasks[20], 1))
+
+    def test_003_fair(self):
+        self.scheduler.configure([('test-vm2', '*', {'weight': 2})],
+            max_in_flight=1)
+        blocker = self.call('dom0')
+        self.run_loop()
+        for _ in range(4):
+            self.call('test-vm1', duration=0)
+        for _ in range(4):
+            self.call('test-vm2', duration=0)
+        self.run_loop()
+        blocker.result().release()
+        self.run_loop(0.1)
+        self.assertEqual(self.started, ['dom0',
+            'test-vm1', 'test-vm2', 'test-vm2', 'test-vm1', 'test-vm2',
+            'test-vm2', 'test-vm1', 'test-vm1'])
+
+    def test_004_reconfigure(self):
+        self.scheduler.configure([('*', '*', {'max-in-flight': 1})])
+        first = self.call('test-vm1')
+        second = self.call('test-vm1')
+        self.run_loop()
+        self.assertFalse(second.done())
+        self.scheduler.configure([])
+        self.run_loop()
+        self.assertTrue(second.done())
+        first.result().release()
+        second.result().release()
+        self.assertEqual(self.scheduler.queues, {})
+
+    def test_005_cancel_waiting(self):
+        self.scheduler.configure([], max_in_flight=1)
+        first = self.call('test-vm1')
+        second = self.call('test-vm1')
+        third = self.call('test-vm2')
+        self.run_loop()
+        second.cancel()
+        self.run_loop()
+        first.result().release()
+        self.run_loop()
+        self.assertTrue(third.done())
+        third.result().release()
+        self.assertEqual(self.started, ['test-vm1', 'test-vm2'])
+        self.assertEqual(self.scheduler.in_flight, 0)
+
+    def test_010_load_config(self):
+        with tempfile.NamedTemporaryFile('w') as config:
+            config.write(
+                '# defaults\n'
+                '* * max-in-flight=8\n'
+                '@global max-in-flight=16\n'
+                'sys-net admin rate=2.5 burst=5 weight=0.5  # comment\n')
+            config.flush()
+            self.scheduler.load_config(config.name)
+        self.assertEqual(self.scheduler.max_in_flight, 16)
+        self.assertEqual(self.scheduler.get_options('sys-net', 'admin'),
+            {'max-in-flight': 8, 'rate': 2.5, 'burst': 5, 'weight': 0.5})
+        self.assertEqual(self.scheduler.get_options('sys-net', 'misc'),
+            {'max-in-flight': 8})
+
+    def test_011_load_config_invalid(self):
+        self.scheduler.configure([('*', '*', {'max-in-flight': 1})])
+        for line in ('sys-net', 'sys-net admin rate', 'sys-net admin x=1',
+                'sys-net admin rate=-1', 'sys-net admin burst=1.5',
+                '@global rate=1'):
+            with self.subTest(line):
+                with tempfile.NamedTemporaryFile('w') as config:
+                    config.write(line + '\n')
+                    config.flush()
+                    with self.assertRaises(qubes.exc.QubesException):
+                        self.scheduler.load_config(config.name)
+                self.assertEqual(self.scheduler.rules,
+                    [('*', '*', {'max-in-flight': 1})])
+
+    def test_012_load_config_missing(self):
+        self.scheduler.configure([('*', '*', {'max-in-flight': 1})])
+        self.scheduler.load_config('/nonexistent/qubesd-scheduler.conf')
+        self.assertEqual(self.scheduler.rules, [])
+
+    def test_020_format_prometheus(self):
+        self.scheduler.configure([('*', '*', {'max-in-flight': 1})])
+        self.call('test-vm1')
+        self.call('test-vm1')
+        self.run_loop()
+        lines = self.scheduler.format_prometheus().splitlines()
+        self.assertIn('# TYPE qubesd_scheduler_queued gauge', lines)
+        self.assertIn(
+            'qubesd_scheduler_queued{source="test-vm1",api="admin"} 1',
+            lines)
+        self.assertIn(
+            'qubesd_scheduler_in_flight{source="test-vm1",api="admin"} 1',
+            lines)
+        self.assertIn('qubesd_scheduler_delayed_total'
+            '{source="test-vm1",api="admin"} 1', lines)
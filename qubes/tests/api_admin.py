@@ -90,6 +90,9 @@ class AdminAPITestCase(qubes.tests.QubesTestCase):
             mgmt_obj.execute(untrusted_payload=payload))
         self.assertEventFired(self.emitter,
             'mgmt-permission:' + method.decode('ascii'))
+        if isinstance(response, qubes.api.StreamedResponse):
+            # what the client would receive
+            response = ''.join(response)
         return response
 
 
@@ -106,6 +109,26 @@ class TC_00_VMs(AdminAPITestCase):
         self.assertEqual(value,
             'test-vm1 class=AppVM state=Halted\n')
 
+    def test_002_vm_list_bulk_state(self):
+        self.app.vmm.offline_mode = False
+        libvirt_domain = unittest.mock.Mock()
+        libvirt_domain.UUID.return_value = self.vm.uuid.bytes
+        libvirt_domain.ID.return_value = 3
+        self.app.vmm.libvirt_conn.getAllDomainStats.return_value = [
+            (libvirt_domain, {'state.state': libvirt.VIR_DOMAIN_PAUSED}),
+        ]
+        self.app.vmm.libvirt_conn.lookupByUUID.reset_mock()
+
+        value = self.call_mgmt_func(b'admin.vm.List', b'dom0')
+        self.assertEqual(value,
+            'dom0 class=AdminVM state=Running\n'
+            'test-template class=TemplateVM state=Halted\n'
+            'test-vm1 class=AppVM state=Paused\n')
+        self.app.vmm.libvirt_conn.getAllDomainStats.assert_called_once_with(
+            libvirt.VIR_DOMAIN_STATS_STATE)
+        self.assertFalse(self.app.vmm.libvirt_conn.lookupByUUID.called)
+        self.assertFalse(libvirt_domain.state.called)
+
     def test_010_vm_property_list(self):
         # this test is kind of stupid, but at least check if appropriate
         # mgmt-permission event is fired
@@ -144,6 +167,46 @@ class TC_00_VMs(AdminAPITestCase):
             b'netvm')
         self.assertEqual(value, 'default=True type=vm ')
 
+    def test_026_vm_property_get_all(self):
+        value = self.call_mgmt_func(b'admin.vm.property.GetAll',
+            b'test-vm1')
+        lines = value.splitlines()
+        self.assertEqual(len(lines), len(self.vm.property_list()))
+        self.assertIn('name default=False type=str test-vm1', lines)
+        self.assertIn('vcpus default=True type=int 42', lines)
+        self.assertIn('label default=False type=label red', lines)
+        self.assertIn('netvm default=True type=vm ', lines)
+
+    def test_027_vm_property_get_all_filtered(self):
+        def deny_vcpus(subject, event, dest, arg):
+            if arg == 'vcpus':
+                raise qubes.api.PermissionDenied()
+        self.emitter.events_enabled = True
+        self.emitter.add_handler('mgmt-permission:admin.vm.property.Get',
+            deny_vcpus)
+
+        value = self.call_mgmt_func(b'admin.vm.property.GetAll',
+            b'test-vm1')
+        names = [line.split(' ', 1)[0] for line in value.splitlines()]
+        self.assertNotIn('vcpus', names)
+        self.assertIn('name', names)
+        self.assertEqual(len(names), len(self.vm.property_list()) - 1)
+
+    def test_028_vm_property_get_all_domains(self):
+        value = self.call_mgmt_func(
+            b'admin.vm.property.GetAllDomains', b'dom0')
+        lines = value.splitlines()
+        self.assertIn('test-vm1 name default=False type=str test-vm1', lines)
+        self.assertIn('test-template name default=False type=str '
+            'test-template', lines)
+        self.assertEqual(len(lines), sum(len(vm.property_list())
+            for vm in self.app.domains))
+
+    def test_029_vm_property_get_all_domains_vm(self):
+        with self.assertRaises(AssertionError):
+            self.call_mgmt_func(b'admin.vm.property.GetAllDomains',
+                b'test-vm1')
+
     def test_030_vm_property_set_vm(self):
         netvm = self.app.add_new_vm('AppVM', label='red', name='test-net',
             template='test-template', provides_network=True)
@@ -410,6 +473,8 @@ class TC_00_VMs(AdminAPITestCase):
         }
         self.vm.volumes.configure_mock(**volumes_conf)
         self.vm.storage = unittest.mock.Mock()
+        self.vm.storage.revert.side_effect = \
+            asyncio.coroutine(lambda *args: None)
         value = self.call_mgmt_func(b'admin.vm.volume.Revert',
             b'test-vm1', b'private', b'rev1')
         self.assertIsNone(value)
@@ -417,8 +482,7 @@ class TC_00_VMs(AdminAPITestCase):
             [unittest.mock.call.keys(),
                 unittest.mock.call.__getattr__('__getitem__')('private')])
         self.assertEqual(self.vm.storage.mock_calls,
-            [unittest.mock.call.get_pool(self.vm.volumes['private']),
-             unittest.mock.call.get_pool().revert('rev1')])
+            [unittest.mock.call.revert('private', 'rev1')])
 
     def test_110_vm_volume_revert_invalid_rev(self):
         self.vm.volumes = unittest.mock.MagicMock()
@@ -443,6 +507,8 @@ class TC_00_VMs(AdminAPITestCase):
         }
         self.vm.volumes.configure_mock(**volumes_conf)
         self.vm.storage = unittest.mock.Mock()
+        self.vm.storage.resize.side_effect = \
+            asyncio.coroutine(lambda *args: None)
         value = self.call_mgmt_func(b'admin.vm.volume.Resize',
             b'test-vm1', b'private', b'1024000000')
         self.assertIsNone(value)
@@ -939,12 +1005,363 @@ class TC_00_VMs(AdminAPITestCase):
                 unittest.mock.call(vm2, 'test-event2', arg1='abc'),
             ])
 
+    def test_272_events_many_subscribers(self):
+        # without history, handlers are unregistered after the last client
+        qubes.api.admin.EventBus.for_app(self.app).history_size = 0
+        send_event1 = unittest.mock.Mock(spec=[])
+        send_event2 = unittest.mock.Mock(spec=[])
+        mgmt_obj1 = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+            b'admin.Events', b'dom0', b'', send_event=send_event1)
+        mgmt_obj2 = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+            b'admin.Events', b'test-vm1', b'', send_event=send_event2)
+
+        @asyncio.coroutine
+        def fire_event():
+            # a single handler, regardless of number of subscribers
+            self.assertEqual(len(self.vm.__handlers__['*']), 1)
+            self.template.fire_event('test-event', arg1='abc')
+            self.vm.fire_event('test-event2')
+            mgmt_obj1.cancel()
+            mgmt_obj2.cancel()
+
+        loop = asyncio.get_event_loop()
+        execute_tasks = [
+            asyncio.ensure_future(mgmt_obj1.execute(untrusted_payload=b'')),
+            asyncio.ensure_future(mgmt_obj2.execute(untrusted_payload=b'')),
+        ]
+        asyncio.ensure_future(fire_event())
+        loop.run_until_complete(asyncio.wait(execute_tasks))
+        self.assertEqual(send_event1.mock_calls,
+            [
+                unittest.mock.call(self.app, 'connection-established'),
+                unittest.mock.call(self.template, 'test-event', arg1='abc'),
+                unittest.mock.call(self.vm, 'test-event2'),
+            ])
+        self.assertEqual(send_event2.mock_calls,
+            [
+                unittest.mock.call(self.app, 'connection-established'),
+                unittest.mock.call(self.vm, 'test-event2'),
+            ])
+        self.assertFalse(self.vm.__handlers__['*'])
+        self.assertFalse(self.app.__handlers__['*'])
+
+    def overflow_subscriber(self, overflow, send_seq=False):
+        bus = qubes.api.admin.EventBus.for_app(self.app)
+        bus.queue_size = 2
+        bus.overflow = overflow
+        send_event = unittest.mock.Mock(spec=[])
+        subscriber = qubes.api.admin.EventSubscriber(bus, self.vm, [],
+            send_event, send_seq=send_seq)
+        bus.subscribe(subscriber)
+        self.addCleanup(bus.unsubscribe, subscriber)
+        return subscriber, send_event
+
+    def test_273_events_overflow_drop(self):
+        subscriber, send_event = self.overflow_subscriber('drop')
+        for i in range(4):
+            self.vm.fire_event('test-event', arg1=i)
+        loop = asyncio.get_event_loop()
+        run_task = asyncio.ensure_future(subscriber.run())
+        loop.run_until_complete(asyncio.sleep(0))
+        run_task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            loop.run_until_complete(run_task)
+        self.assertEqual(send_event.mock_calls, [
+            unittest.mock.call(self.vm, 'test-event', arg1=0),
+            unittest.mock.call(self.vm, 'test-event', arg1=1),
+            unittest.mock.call(self.app, 'events-dropped', count=2),
+        ])
+
+    def test_274_events_overflow_coalesce(self):
+        subscriber, send_event = self.overflow_subscriber('coalesce')
+        self.vm.fire_event('test-event', arg1=0)
+        self.vm.fire_event('test-event2')
+        self.vm.fire_event('test-event', arg1=1)
+        self.vm.fire_event('test-event3')
+        loop = asyncio.get_event_loop()
+        run_task = asyncio.ensure_future(subscriber.run())
+        loop.run_until_complete(asyncio.sleep(0))
+        run_task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            loop.run_until_complete(run_task)
+        self.assertEqual(send_event.mock_calls, [
+            unittest.mock.call(self.vm, 'test-event', arg1=1),
+            unittest.mock.call(self.vm, 'test-event2'),
+            unittest.mock.call(self.app, 'events-dropped', count=1),
+        ])
+
+    def run_subscriber(self, subscriber):
+        loop = asyncio.get_event_loop()
+        run_task = asyncio.ensure_future(subscriber.run())
+        loop.run_until_complete(asyncio.sleep(0))
+        run_task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            loop.run_until_complete(run_task)
+
+    def test_274_events_overflow_coalesce_seq(self):
+        subscriber, send_event = self.overflow_subscriber('coalesce',
+            send_seq=True)
+        subscriber.bus.history_size = 1000
+        epoch = subscriber.bus.epoch
+        self.vm.fire_event('test-event', arg1=0)
+        self.vm.fire_event('test-event2')
+        self.vm.fire_event('test-event3')
+        self.vm.fire_event('test-event', arg1=1)
+        self.run_subscriber(subscriber)
+        # in order of sequence numbers, but seq 1 (coalesced) and 3
+        # (dropped) are lost
+        self.assertEqual(send_event.mock_calls, [
+            unittest.mock.call(self.vm, 'test-event2', seq=epoch + '-2'),
+            unittest.mock.call(self.vm, 'test-event', arg1=1,
+                seq=epoch + '-4'),
+            unittest.mock.call(self.app, 'events-resync'),
+        ])
+        # resuming before the lost ones gets them from the history
+        calls = self.events_since(epoch + '-2', lambda: None)
+        self.assertEqual(calls, [
+            unittest.mock.call(self.app, 'connection-established',
+                seq=epoch + '-2'),
+            unittest.mock.call(self.vm, 'test-event3', seq=epoch + '-3'),
+            unittest.mock.call(self.vm, 'test-event', arg1='1',
+                seq=epoch + '-4'),
+        ])
+
+    def test_274_events_overflow_drop_seq(self):
+        subscriber, send_event = self.overflow_subscriber('drop',
+            send_seq=True)
+        epoch = subscriber.bus.epoch
+        for i in range(3):
+            self.vm.fire_event('test-event', arg1=i)
+        self.run_subscriber(subscriber)
+        self.assertEqual(send_event.mock_calls, [
+            unittest.mock.call(self.vm, 'test-event', arg1=0,
+                seq=epoch + '-1'),
+            unittest.mock.call(self.vm, 'test-event', arg1=1,
+                seq=epoch + '-2'),
+            unittest.mock.call(self.app, 'events-resync'),
+        ])
+
+    def test_278_events_overflow_disconnect(self):
+        subscriber, send_event = self.overflow_subscriber('disconnect')
+        for i in range(3):
+            self.vm.fire_event('test-event', arg1=i)
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(asyncio.wait_for(subscriber.run(), 1))
+        self.assertEqual(send_event.mock_calls, [])
+
+    def test_279_events_selected(self):
+        send_event = unittest.mock.Mock(spec=[])
+        self.template.tags.add('selected')
+        mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+            b'admin.Events', b'dom0', b'', send_event=send_event)
+
+        @asyncio.coroutine
+        def fire_event():
+            self.vm.fire_event('domain-test')
+            self.vm.fire_event('property-set:test')
+            self.vm.fire_event('property-set:other')
+            self.template.fire_event('domain-test2')
+            self.app.fire_event('domain-test')
+            vm2 = self.app.add_new_vm('AppVM', label='red', name='test-vm2',
+                template='test-template')
+            vm2.fire_event('domain-test')
+            mgmt_obj.cancel()
+
+        loop = asyncio.get_event_loop()
+        execute_task = asyncio.ensure_future(mgmt_obj.execute(
+            untrusted_payload=b'event=domain-* event=property-set:test '
+                b'vm=test-vm1 tag=selected'))
+        asyncio.ensure_future(fire_event())
+        loop.run_until_complete(execute_task)
+        self.assertEqual(send_event.mock_calls,
+            [
+                unittest.mock.call(self.app, 'connection-established'),
+                unittest.mock.call(self.vm, 'domain-test'),
+                unittest.mock.call(self.vm, 'property-set:test'),
+                unittest.mock.call(self.template, 'domain-test2'),
+            ])
+
+    def test_996_events_invalid_selector(self):
+        for payload in (b'event', b'event=', b'name=test-vm1',
+                b'vm=test-vm1/', b'event=domain-[a-z]*', b'since=a:1',
+                b'since=now since=now'):
+            with self.subTest(payload):
+                with self.assertRaises(qubes.api.ProtocolError):
+                    self.call_mgmt_func(b'admin.Events', b'dom0', b'',
+                        payload)
+                self.assertFalse(self.app.__handlers__['*'])
+
+    def test_275_event_stats(self):
+        profiler = qubes.events.enable_profiling()
+        self.addCleanup(qubes.events.disable_profiling)
+
+        def on_test_event(subject, event):
+            pass
+        self.vm.add_handler('test-event', on_test_event)
+        self.vm.fire_event('test-event')
+
+        value = self.call_mgmt_func(b'admin.EventStats', b'dom0')
+        self.assertIn('event test-event count=1 ', value)
+        self.assertIn('handler test-event {} count=1 '.format(
+            profiler.handler_name(on_test_event)), value)
+
+    def test_276_event_stats_disabled(self):
+        with self.assertRaises(qubes.exc.QubesException):
+            self.call_mgmt_func(b'admin.EventStats', b'dom0')
+
+    def test_276_event_stats_disabled_denied(self):
+        def deny(subject, event, dest, arg):
+            raise qubes.api.PermissionDenied()
+        self.emitter.events_enabled = True
+        self.emitter.add_handler('mgmt-permission:admin.EventStats', deny)
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.EventStats', b'dom0')
+
+    def test_277_event_stats_vm(self):
+        qubes.events.enable_profiling()
+        self.addCleanup(qubes.events.disable_profiling)
+        with self.assertRaises(AssertionError):
+            self.call_mgmt_func(b'admin.EventStats', b'test-vm1')
+
     def test_280_feature_list(self):
         self.vm.features['test-feature'] = 'some-value'
         value = self.call_mgmt_func(b'admin.vm.feature.List', b'test-vm1')
         self.assertEqual(value, 'test-feature\n')
         self.assertFalse(self.app.save.called)
 
+    def events_since(self, since, fire_event):
+        '''Call admin.Events with since=*since*, calling *fire_event*
+        after the connection is established'''
+        send_event = unittest.mock.Mock(spec=[])
+        mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+            b'admin.Events', b'dom0', b'', send_event=send_event)
+
+        @asyncio.coroutine
+        def fire_events():
+            fire_event()
+            mgmt_obj.cancel()
+
+        loop = asyncio.get_event_loop()
+        execute_task = asyncio.ensure_future(mgmt_obj.execute(
+            untrusted_payload=b'since=' + since.encode()))
+        asyncio.ensure_future(fire_events())
+        loop.run_until_complete(execute_task)
+        return send_event.mock_calls
+
+    def test_281_events_resume(self):
+        bus = qubes.api.admin.EventBus.for_app(self.app)
+        bus.history_size = 1000
+        epoch = bus.epoch
+        calls = self.events_since('now',
+            lambda: self.vm.fire_event('test-event', arg1='abc'))
+        self.assertEqual(calls, [
+            unittest.mock.call(self.app, 'connection-established',
+                seq=epoch + '-0'),
+            unittest.mock.call(self.vm, 'test-event', arg1='abc',
+                seq=epoch + '-1'),
+        ])
+        # events while disconnected are still recorded
+        self.vm.fire_event('test-event', arg1='def')
+        self.template.fire_event('test-event2')
+        calls = self.events_since(epoch + '-1',
+            lambda: self.vm.fire_event('test-event3'))
+        self.assertEqual(calls, [
+            unittest.mock.call(self.app, 'connection-established',
+                seq=epoch + '-1'),
+            unittest.mock.call(self.vm, 'test-event', arg1='def',
+                seq=epoch + '-2'),
+            unittest.mock.call(self.template, 'test-event2',
+                seq=epoch + '-3'),
+            unittest.mock.call(self.vm, 'test-event3', seq=epoch + '-4'),
+        ])
+
+    def test_282_events_resume_wrapped(self):
+        bus = qubes.api.admin.EventBus.for_app(self.app)
+        bus.history_size = 2
+        self.events_since('now', lambda: None)
+        for i in range(3):
+            self.vm.fire_event('test-event', arg1=i)
+        calls = self.events_since(bus.epoch + '-0', lambda: None)
+        self.assertEqual(calls, [
+            unittest.mock.call(self.app, 'connection-established',
+                seq=bus.epoch + '-3'),
+            unittest.mock.call(self.app, 'events-resync'),
+        ])
+        # still available
+        calls = self.events_since(bus.epoch + '-1', lambda: None)
+        self.assertEqual(calls, [
+            unittest.mock.call(self.app, 'connection-established',
+                seq=bus.epoch + '-1'),
+            unittest.mock.call(self.vm, 'test-event', arg1='1',
+                seq=bus.epoch + '-2'),
+            unittest.mock.call(self.vm, 'test-event', arg1='2',
+                seq=bus.epoch + '-3'),
+        ])
+
+    def test_282_events_resume_history(self):
+        bus = qubes.api.admin.EventBus.for_app(self.app)
+        bus.history_size = 1000
+        self.events_since('now', lambda: None)
+        self.vm.fire_event('test-event', other=self.template)
+        # the history does not keep the objects
+        self.assertEqual(list(bus.history),
+            [(1, 'test-vm1', 'test-event', {'other': 'test-template'})])
+        del self.app.domains['test-vm1']
+        calls = self.events_since(bus.epoch + '-0', lambda: None)
+        self.assertEqual(calls[0], unittest.mock.call(self.app,
+            'connection-established', seq=bus.epoch + '-0'))
+        self.assertNotIn('test-event', [call[1][1] for call in calls])
+
+    def test_283_events_resume_up_to_date(self):
+        bus = qubes.api.admin.EventBus.for_app(self.app)
+        bus.history_size = 1000
+        self.events_since('now', lambda: None)
+        self.vm.fire_event('test-event')
+        calls = self.events_since(bus.epoch + '-1', lambda: None)
+        self.assertEqual(calls, [
+            unittest.mock.call(self.app, 'connection-established',
+                seq=bus.epoch + '-1'),
+        ])
+
+    def test_283_events_resume_restarted(self):
+        # token issued by another qubesd instance
+        bus = qubes.api.admin.EventBus.for_app(self.app)
+        bus.history_size = 1000
+        calls = self.events_since('x' + bus.epoch + '-0', lambda: None)
+        self.assertEqual(calls, [
+            unittest.mock.call(self.app, 'connection-established',
+                seq=bus.epoch + '-0'),
+            unittest.mock.call(self.app, 'events-resync'),
+        ])
+
+    def test_283_events_resume_no_history(self):
+        bus = qubes.api.admin.EventBus.for_app(self.app)
+        calls = self.events_since('now', lambda: None)
+        token = calls[0][2]['seq']
+        # not recorded, there are no subscribers
+        self.vm.fire_event('test-event')
+        self.assertFalse(bus.handlers_registered)
+        calls = self.events_since(token, lambda: None)
+        self.assertEqual(calls, [
+            unittest.mock.call(self.app, 'connection-established',
+                seq=calls[0][2]['seq']),
+            unittest.mock.call(self.app, 'events-resync'),
+        ])
+        self.assertNotEqual(calls[0][2]['seq'], token)
+
+    def test_284_stats(self):
+        qubes.api.call_stats.clear()
+        self.addCleanup(qubes.api.call_stats.clear)
+        qubes.api.call_stats.record('admin.vm.List', 0.002, 0, False)
+        value = self.call_mgmt_func(b'admin.Stats', b'dom0')
+        self.assertEqual(value, 'method admin.vm.List count=1 '
+            'total=0.002000 histogram=0.0001:0,0.001:0,0.01:1,0.1:0,1:0,'
+            '10:0,inf:0 errors=0 payload=0\n')
+
+    def test_285_stats_vm(self):
+        with self.assertRaises(AssertionError):
+            self.call_mgmt_func(b'admin.Stats', b'test-vm1')
+
     def test_290_feature_get(self):
         self.vm.features['test-feature'] = 'some-value'
         value = self.call_mgmt_func(b'admin.vm.feature.Get', b'test-vm1',
@@ -1380,6 +1797,19 @@ class TC_00_VMs(AdminAPITestCase):
         self.assertEqual(value, '')
         self.assertFalse(self.app.save.called)
 
+    def test_463_vm_device_available_invalid_description(self):
+        def device_list(vm, event):
+            dev = qubes.devices.DeviceInfo(vm, '1234')
+            dev.description = 'Some\ndevice'
+            yield dev
+        self.vm.add_handler('device-list:testclass', device_list)
+        mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+            b'admin.vm.device.testclass.Available', b'test-vm1', b'')
+        # fails before anything is sent to the client
+        with self.assertRaises(AssertionError):
+            asyncio.get_event_loop().run_until_complete(
+                mgmt_obj.execute(untrusted_payload=b''))
+
     def test_470_vm_device_list_persistent(self):
         assignment = qubes.devices.DeviceAssignment(self.vm, '1234',
             persistent=True)
@@ -1769,7 +2199,6 @@ class TC_00_VMs(AdminAPITestCase):
             b'admin.vm.Pause',
             b'admin.vm.Unpause',
             b'admin.vm.Kill',
-            b'admin.Events',
             b'admin.vm.feature.List',
             b'admin.vm.feature.Get',
             b'admin.vm.feature.Remove',
@@ -1858,7 +2287,6 @@ class TC_00_VMs(AdminAPITestCase):
             b'admin.pool.Info',
             b'admin.pool.Remove',
             b'admin.backup.Execute',
-            b'admin.Events',
         ]
         # make sure also no methods on actual VM gets called
         vm_mock = unittest.mock.MagicMock()
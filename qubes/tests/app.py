@@ -21,13 +21,24 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import asyncio
+import collections
+import json
 import os
+import shutil
+import threading
+import time
+import unittest.mock
 import uuid
 
+import libvirt
 import lxml.etree
 
 import qubes
+import qubes.app
+import qubes.config
 import qubes.events
+import qubes.storage.file
 
 import qubes.tests
 import qubes.tests.init
@@ -35,6 +46,14 @@ import qubes.tests.init
 class TestApp(qubes.tests.TestEmitter):
     pass
 
+class DependentTestVM(qubes.tests.init.TestVM):
+    netvm = qubes.VMProperty('netvm', allow_none=True, default=None)
+    template = qubes.VMProperty('template', allow_none=True, default=None)
+
+    def __init__(self, *args, **kwargs):
+        self.uuid = uuid.uuid4()
+        super(DependentTestVM, self).__init__(*args, **kwargs)
+
 class TC_30_VMCollection(qubes.tests.QubesTestCase):
     def setUp(self):
         super().setUp()
@@ -47,7 +66,7 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
             None, None, qid=2, name='testvm2')
 
     def test_000_contains(self):
-        self.vms._dict = {1: self.testvm1}
+        self.vms.add(self.testvm1)
 
         self.assertIn(1, self.vms)
         self.assertIn('testvm1', self.vms)
@@ -58,7 +77,7 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
         self.assertNotIn(self.testvm2, self.vms)
 
     def test_001_getitem(self):
-        self.vms._dict = {1: self.testvm1}
+        self.vms.add(self.testvm1)
 
         self.assertIs(self.vms[1], self.testvm1)
         self.assertIs(self.vms['testvm1'], self.testvm1)
@@ -127,6 +146,29 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
         self.assertEventFired(self.app, 'domain-delete',
             kwargs={'vm': self.testvm2})
 
+        self.assertNotIn('testvm2', self.vms)
+        self.assertNotIn(2, self.vms)
+        with self.assertRaises(KeyError):
+            self.vms['testvm2']
+
+    def test_009_rename(self):
+        self.vms.add(self.testvm1)
+        self.vms.add(self.testvm2)
+
+        self.testvm1.name = 'testvm3'
+
+        self.assertNotIn('testvm1', self.vms)
+        self.assertIs(self.vms['testvm3'], self.testvm1)
+        self.assertEqual(list(self.vms.names()), ['testvm2', 'testvm3'])
+        self.assertEqual(list(self.vms), [self.testvm2, self.testvm1])
+
+    def test_010_getitem_uuid(self):
+        self.vms.add(self.testvm1)
+
+        self.assertIs(self.vms[self.testvm1.uuid], self.testvm1)
+        with self.assertRaises(KeyError):
+            self.vms[uuid.uuid4()]
+
     def test_100_get_new_unused_qid(self):
         self.vms.add(self.testvm1)
         self.vms.add(self.testvm2)
@@ -139,11 +181,88 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
 
         self.vms.get_new_unused_netid()
 
-#   def test_200_get_vms_based_on(self):
-#       pass
+    def test_102_get_new_unused_qid_reserved(self):
+        self.vms.add(self.testvm2)
+
+        qid = self.vms.get_new_unused_qid()
+        self.assertEqual(qid, 1)
+        # reserved, even before added
+        self.assertEqual(self.vms.get_new_unused_qid(), 3)
+        self.vms.release_qid(3)
+        self.assertEqual(self.vms.get_new_unused_qid(), 3)
+
+        self.vms.add(self.testvm1)
+        # no-op for qid in use
+        self.vms.release_qid(1)
+        self.assertEqual(self.vms.get_new_unused_qid(), 4)
+
+        del self.vms['testvm2']
+        self.assertEqual(self.vms.get_new_unused_qid(), 2)
+
+    def test_103_get_new_unused_qid_exhausted(self):
+        with unittest.mock.patch('qubes.config.max_qid', 3):
+            self.assertEqual(self.vms.get_new_unused_qid(), 1)
+            self.assertEqual(self.vms.get_new_unused_qid(), 2)
+            with self.assertRaises(LookupError):
+                self.vms.get_new_unused_qid()
 
-#   def test_201_get_vms_connected_to(self):
-#       pass
+    def test_104_get_new_unused_netid(self):
+        self.vms.add(self.testvm1)
+        self.assertEqual(self.vms.get_new_unused_netid(), 2)
+        # tracked after first use
+        self.vms.add(self.testvm2)
+        self.assertEqual(self.vms.get_new_unused_netid(), 3)
+
+    def test_105_get_new_unused_dispid(self):
+        dispid = self.vms.get_new_unused_dispid()
+        self.assertIn(dispid, range(qubes.config.max_dispid))
+        self.vms.release_dispid(dispid)
+
+        with unittest.mock.patch('qubes.config.max_dispid', 1):
+            self.assertEqual(self.vms.get_new_unused_dispid(), 0)
+            # reserved
+            with self.assertRaises(LookupError):
+                self.vms.get_new_unused_dispid()
+            self.vms.release_dispid(0)
+            self.assertEqual(self.vms.get_new_unused_dispid(), 0)
+
+    def test_200_get_vms_based_on(self):
+        self.app.domains = self.vms
+        template = self.vms.add(
+            DependentTestVM(self.app, None, qid=1, name='template'))
+        vm1 = self.vms.add(
+            DependentTestVM(self.app, None, qid=2, name='vm1'))
+        vm2 = self.vms.add(DependentTestVM(self.app, None, qid=3, name='vm2',
+            template=template))
+
+        self.assertEqual(self.vms.get_vms_based_on(template), {vm2})
+        vm1.template = template
+        self.assertEqual(self.vms.get_vms_based_on('template'), {vm1, vm2})
+        del vm2.template
+        self.assertEqual(self.vms.get_vms_based_on(template), {vm1})
+        del self.vms['vm1']
+        self.assertEqual(self.vms.get_vms_based_on(template), set())
+
+    def test_201_get_vms_connected_to(self):
+        self.app.domains = self.vms
+        netvm1 = self.vms.add(
+            DependentTestVM(self.app, None, qid=1, name='netvm1'))
+        netvm2 = self.vms.add(DependentTestVM(self.app, None, qid=2,
+            name='netvm2', netvm=netvm1))
+        vm1 = self.vms.add(
+            DependentTestVM(self.app, None, qid=3, name='vm1', netvm=netvm2))
+        vm2 = self.vms.add(
+            DependentTestVM(self.app, None, qid=4, name='vm2'))
+
+        self.assertEqual(self.vms.get_vms_connected_to(netvm1),
+            {netvm2, vm1})
+        vm2.netvm = netvm1
+        self.assertEqual(self.vms.get_vms_connected_to('netvm1'),
+            {netvm2, vm1, vm2})
+        vm1.netvm = None
+        self.assertEqual(self.vms.get_vms_connected_to(netvm1),
+            {netvm2, vm2})
+        self.assertEqual(self.vms.get_vms_connected_to(netvm2), set())
 
 
 class TC_90_Qubes(qubes.tests.QubesTestCase):
@@ -162,3 +281,589 @@ class TC_90_Qubes(qubes.tests.QubesTestCase):
             lxml.etree.parse(open(
                 os.path.join(qubes.tests.in_git, 'doc/example.xml'), 'rb')),
             'qubes.rng')
+
+
+class TC_91_QubesXML(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.test_base_dir = '/tmp/qubes-test-dir'
+        self.base_dir_patch = unittest.mock.patch.dict(qubes.config.system_path,
+            {'qubes_base_dir': self.test_base_dir})
+        self.base_dir_patch.start()
+        self.app = qubes.Qubes('/tmp/qubes-test.xml', load=False)
+        self.app.vmm = unittest.mock.Mock(spec=qubes.app.VMMConnection)
+        self.app.load_initial_values()
+        self.app.default_kernel = '1.0'
+        self.template = self.app.add_new_vm('TemplateVM', label='black',
+            name='test-template')
+        self.app.default_template = 'test-template'
+        self.vm1 = self.app.add_new_vm('AppVM', label='red', name='test-vm1',
+            template='test-template')
+        self.vm2 = self.app.add_new_vm('AppVM', label='red', name='test-vm2',
+            template='test-template')
+
+    def tearDown(self):
+        self.base_dir_patch.stop()
+        if os.path.exists(self.test_base_dir):
+            shutil.rmtree(self.test_base_dir)
+        super().tearDown()
+
+    def assertXMLUpToDate(self, xml):
+        # compare with the tree built from scratch
+        expected = lxml.etree.Element('qubes')
+        expected.append(self.app.xml_labels())
+        expected.append(self.app.xml_pools())
+        expected.append(self.app.xml_properties())
+        domains = lxml.etree.SubElement(expected, 'domains')
+        for vm in self.app.domains:
+            domains.append(vm.__xml__())
+        self.assertEqual(lxml.etree.tostring(xml),
+            lxml.etree.tostring(expected))
+
+    def test_000_unchanged_domains_reused(self):
+        xml = self.app.__xml__()
+        vm1_xml = xml.find('./domains/domain[@id="domain-{}"]'.format(
+            self.vm1.qid))
+        vm2_xml = xml.find('./domains/domain[@id="domain-{}"]'.format(
+            self.vm2.qid))
+
+        self.vm2.tags.add('testtag')
+        xml = self.app.__xml__()
+        self.assertIs(self.vm1.xml_fragment(), vm1_xml)
+        self.assertIsNot(self.vm2.xml_fragment(), vm2_xml)
+        self.assertXMLUpToDate(xml)
+
+    def test_001_invalidate(self):
+        self.app.__xml__()
+        self.vm1.features['test-feature'] = '1'
+        self.assertXMLUpToDate(self.app.__xml__())
+        del self.vm1.features['test-feature']
+        self.assertXMLUpToDate(self.app.__xml__())
+        self.vm1.memory = 1000
+        self.assertXMLUpToDate(self.app.__xml__())
+        del self.vm1.memory
+        self.assertXMLUpToDate(self.app.__xml__())
+        self.vm1.tags.add('testtag')
+        self.assertXMLUpToDate(self.app.__xml__())
+        self.vm1.tags.remove('testtag')
+        self.assertXMLUpToDate(self.app.__xml__())
+        self.vm1.volumes['private'].size *= 2
+        self.vm1.fire_event('domain-volume-config-changed')
+        self.assertXMLUpToDate(self.app.__xml__())
+
+    def test_002_global(self):
+        self.app.__xml__()
+        self.app.default_netvm = self.vm1
+        self.assertXMLUpToDate(self.app.__xml__())
+        self.app.labels[99] = qubes.Label(99, '0x000000', 'testlabel')
+        self.assertXMLUpToDate(self.app.__xml__())
+        del self.app.labels[99]
+        self.assertXMLUpToDate(self.app.__xml__())
+        self.app.pools['test'] = qubes.storage.file.FilePool(name='test',
+            dir_path=os.path.join(self.test_base_dir, 'test-pool'))
+        self.assertXMLUpToDate(self.app.__xml__())
+
+    def test_010_save_scheduled(self):
+        self.app.save_flush_window = 0.01
+        with unittest.mock.patch.object(self.app, '_write_store') as write:
+            future = self.app.save()
+            self.assertIs(self.app.save(), future)
+            self.assertFalse(write.called)
+            self.loop.run_until_complete(self.app.save_barrier())
+            write.assert_called_once_with(True)
+            self.assertTrue(future.done())
+
+            # next save starts a new batch
+            self.assertIsNot(self.app.save(), future)
+            self.loop.run_until_complete(self.app.save_barrier())
+            self.assertEqual(write.call_count, 2)
+
+    def test_011_save_barrier_flush(self):
+        self.app.save_flush_window = 3600
+        with unittest.mock.patch.object(self.app, '_write_store') as write:
+            self.app.save()
+            self.loop.run_until_complete(asyncio.wait_for(
+                self.app.save_barrier(flush=True), 1))
+            write.assert_called_once_with(True)
+            # nothing pending
+            self.loop.run_until_complete(self.app.save_barrier())
+            self.assertEqual(write.call_count, 1)
+
+    def test_012_save_scheduled_error(self):
+        self.app.save_flush_window = 0
+        with unittest.mock.patch.object(self.app, '_write_store',
+                side_effect=OSError('no space left')):
+            self.app.save()
+            with self.assertRaises(OSError):
+                self.loop.run_until_complete(self.app.save_barrier())
+
+    def test_020_journal(self):
+        self.addCleanup(self.cleanup_store)
+        self.app.enable_journal()
+        # do not compact in the middle of the test
+        self.app.journal.max_size_ratio = 100
+        self.app.save()
+        self.app._release_lock()
+        journal_path = qubes.app.StoreJournal.get_path(self.app.store)
+        store_stat = os.stat(self.app.store)
+        with open(journal_path) as journal:
+            self.assertEqual(len(journal.readlines()), 1)
+
+        self.vm1.tags.add('testtag')
+        self.vm1.features['test-feature'] = 'value'
+        self.vm1.memory = 1000
+        self.vm1.volumes['private'].size *= 2
+        self.vm1.fire_event('domain-volume-config-changed')
+        # no actual change
+        self.vm2.fire_event('domain-volume-config-changed')
+        self.vm2.kernelopts = 'opt'
+        self.app.default_netvm = self.vm1
+        vm3 = self.app.add_new_vm('AppVM', label='green', name='test-vm3',
+            template='test-template')
+        vm3.features['test-feature'] = 'value'
+        self.app.save(lock=False)
+
+        self.assertEqual(os.stat(self.app.store), store_stat)
+        with open(journal_path) as journal:
+            records = [json.loads(line) for line in journal.readlines()[1:]]
+        self.assertIn({'domain': self.vm1.qid, 'section': 'tags',
+            'key': 'testtag', 'xml': '<tag name="testtag"/>'}, records)
+        self.assertIn({'domain': self.vm1.qid, 'section': 'properties',
+            'key': 'memory', 'xml': '<property name="memory">1000</property>'},
+            records)
+        self.assertIn({'domain': None, 'section': 'properties',
+            'key': 'default_netvm',
+            'xml': '<property name="default_netvm">test-vm1</property>'},
+            records)
+        self.assertIn(self.vm1.qid, [r['domain'] for r in records
+            if r['section'] == 'volume-config'])
+        self.assertNotIn(self.vm2.qid, [r['domain'] for r in records
+            if r['section'] == 'volume-config'])
+        # vm3 is written as a whole
+        self.assertEqual(
+            [(r['section'], r['key']) for r in records
+                if r['domain'] == vm3.qid],
+            [(None, None)])
+
+        del self.vm1.features['test-feature']
+        self.app.domains[self.vm2.qid].tags.add('other')
+        del self.app.domains[self.vm2.qid]
+        self.app.save(lock=False)
+        self.assertEqual(os.stat(self.app.store), store_stat)
+
+        app = qubes.Qubes(self.app.store, offline_mode=True)
+        self.assertNotIn('test-vm2', app.domains)
+        vm1 = app.domains['test-vm1']
+        self.assertEqual(vm1.tags, {'testtag'})
+        self.assertNotIn('test-feature', vm1.features)
+        self.assertEqual(vm1.memory, 1000)
+        self.assertEqual(vm1.volume_config['private']['size'],
+            str(self.vm1.volumes['private'].size))
+        self.assertEqual(app.default_netvm, vm1)
+        self.assertEqual(app.domains['test-vm3'].features['test-feature'],
+            'value')
+
+    def test_021_journal_compaction(self):
+        self.addCleanup(self.cleanup_store)
+        self.app.enable_journal()
+        self.app.save(lock=False)
+        store_stat = os.stat(self.app.store)
+        journal_path = qubes.app.StoreJournal.get_path(self.app.store)
+
+        for i in range(100):
+            self.vm1.memory = 1000 + i
+            self.app.save(lock=False)
+        self.assertNotEqual(os.stat(self.app.store), store_stat)
+        self.assertLess(os.path.getsize(journal_path),
+            os.path.getsize(self.app.store) * self.app.journal.max_size_ratio)
+
+        app = qubes.Qubes(self.app.store, offline_mode=True)
+        self.assertEqual(app.domains['test-vm1'].memory, 1099)
+
+    def test_022_journal_stale(self):
+        self.addCleanup(self.cleanup_store)
+        self.app.enable_journal()
+        self.app.save(lock=False)
+        self.vm1.memory = 1000
+        self.app.save(lock=False)
+
+        # full store written by someone not using journal
+        self.app.journal.close()
+        self.app.journal = None
+        self.vm1.memory = 2000
+        self.app.save(lock=False)
+        self.assertFalse(os.path.exists(
+            qubes.app.StoreJournal.get_path(self.app.store)))
+
+        app = qubes.Qubes(self.app.store, offline_mode=True)
+        self.assertEqual(app.domains['test-vm1'].memory, 2000)
+
+    def test_023_journal_concurrent(self):
+        self.addCleanup(self.cleanup_store)
+        self.app.enable_journal()
+        self.app.save(lock=False)
+        journal_path = qubes.app.StoreJournal.get_path(self.app.store)
+
+        app = qubes.Qubes(self.app.store, offline_mode=True)
+        # changes appended to the journal by another instance
+        self.vm1.memory = 1234
+        self.app.save(lock=False)
+        app.domains['test-vm2'].memory = 1000
+        with self.assertRaises(qubes.exc.QubesException):
+            app.save(lock=False)
+        self.assertTrue(os.path.exists(journal_path))
+
+        app = qubes.Qubes(self.app.store, offline_mode=True)
+        self.assertEqual(app.domains['test-vm1'].memory, 1234)
+        app.domains['test-vm2'].memory = 1000
+        app.save(lock=False)
+        app = qubes.Qubes(self.app.store, offline_mode=True)
+        self.assertEqual(app.domains['test-vm1'].memory, 1234)
+        self.assertEqual(app.domains['test-vm2'].memory, 1000)
+
+    def test_024_journal_volume_config(self):
+        self.addCleanup(self.cleanup_store)
+        self.app.enable_journal()
+        self.app.save(lock=False)
+        volume = self.vm1.volumes['private']
+        size = volume.size * 2
+
+        def revert(revision=None):
+            # pylint: disable=unused-argument
+            volume.size = size
+        with unittest.mock.patch.object(volume, 'revert', revert):
+            self.loop.run_until_complete(
+                self.vm1.storage.revert('private'))
+        self.app.save(lock=False)
+
+        app = qubes.Qubes(self.app.store, offline_mode=True)
+        self.assertEqual(
+            app.domains['test-vm1'].volume_config['private']['size'],
+            str(size))
+
+    def test_030_cache(self):
+        self.addCleanup(self.cleanup_store)
+        self.vm1.features['test-feature'] = 'value'
+        self.vm1.tags.add('testtag')
+        self.vm1.netvm = None
+        self.vm2.volumes['private'].size *= 2
+        self.app.save(lock=False)
+        cache_path = qubes.app.StoreCache.get_path(self.app.store)
+
+        app = qubes.Qubes(self.app.store, offline_mode=True, cache=True)
+        self.assertTrue(os.path.exists(cache_path))
+        expected = lxml.etree.tostring(app.__xml__())
+
+        with unittest.mock.patch.object(qubes.Qubes, '_load_xml') \
+                as mock_load_xml:
+            app = qubes.Qubes(self.app.store, offline_mode=True, cache=True)
+        self.assertFalse(mock_load_xml.called)
+        self.assertEqual(lxml.etree.tostring(app.__xml__()), expected)
+        vm1 = app.domains['test-vm1']
+        self.assertIs(vm1.template, app.domains['test-template'])
+        self.assertIs(vm1.label, app.labels[1])
+        self.assertEqual(vm1.uuid, self.vm1.uuid)
+        self.assertIsNone(vm1.netvm)
+        self.assertEqual(vm1.features['test-feature'], 'value')
+        self.assertIn('testtag', vm1.tags)
+        self.assertIs(app.default_template, app.domains['test-template'])
+
+    def test_031_cache_stale(self):
+        self.addCleanup(self.cleanup_store)
+        self.app.save(lock=False)
+        qubes.Qubes(self.app.store, offline_mode=True, cache=True)
+
+        self.vm1.memory = 1000
+        self.app.save(lock=False)
+        app = qubes.Qubes(self.app.store, offline_mode=True, cache=True)
+        self.assertEqual(app.domains['test-vm1'].memory, 1000)
+        # and the cache is updated
+        with unittest.mock.patch.object(qubes.Qubes, '_load_xml') \
+                as mock_load_xml:
+            app = qubes.Qubes(self.app.store, offline_mode=True, cache=True)
+        self.assertFalse(mock_load_xml.called)
+        self.assertEqual(app.domains['test-vm1'].memory, 1000)
+
+    def test_032_cache_broken(self):
+        self.addCleanup(self.cleanup_store)
+        self.app.save(lock=False)
+        cache = qubes.app.StoreCache(self.app)
+        with open(self.app.store, 'rb') as fh:
+            data = cache.dump(cache.get_key(self.app.store, fh))
+        # objects of other types are refused
+        data['domains'][0]['features'] = collections.OrderedDict()
+        cache.write(data)
+
+        with self.assertNotRaises(Exception):
+            app = qubes.Qubes(self.app.store, offline_mode=True, cache=True)
+        self.assertIn('test-vm1', app.domains)
+
+    def test_040_lazy_load(self):
+        self.addCleanup(self.cleanup_store)
+        self.vm1.memory = 1000
+        self.vm1.features['test-feature'] = 'value'
+        self.vm2.tags.add('testtag')
+        self.app.save(lock=False)
+
+        app = qubes.Qubes(self.app.store, offline_mode=True, lazy=True)
+        vm1 = app.domains['test-vm1']
+        vm2 = app.domains['test-vm2']
+        template = app.domains['test-template']
+        self.assertTrue(vm1.is_load_deferred())
+        self.assertTrue(vm2.is_load_deferred())
+        self.assertEqual(vm1.qid, self.vm1.qid)
+
+        self.assertEqual(vm1.memory, 1000)
+        self.assertFalse(vm1.is_load_deferred())
+        self.assertTrue(vm1.events_enabled)
+        # initialised by domain-load handler
+        self.assertIsNotNone(vm1.storage)
+        self.assertEqual(vm1.features['test-feature'], 'value')
+        self.assertIs(vm1.template, template)
+        self.assertTrue(vm2.is_load_deferred())
+
+        self.assertIn('testtag', vm2.tags)
+        self.assertFalse(vm2.is_load_deferred())
+        self.assertEqual(app.domains.get_vms_based_on(template), {vm1, vm2})
+
+    def test_041_lazy_events(self):
+        self.addCleanup(self.cleanup_store)
+        self.vm1.memory = 1000
+        self.app.save(lock=False)
+
+        app = qubes.Qubes(self.app.store, offline_mode=True, lazy=True)
+        vm1 = app.domains['test-vm1']
+        handler = unittest.mock.Mock(return_value=None)
+        vm1.add_handler('property-set:memory', handler)
+        vm1.memory = 2000
+        handler.assert_called_once_with(vm1, 'property-set:memory',
+            name='memory', newvalue=2000, oldvalue=1000)
+
+    def test_042_lazy_save(self):
+        self.addCleanup(self.cleanup_store)
+        self.vm2.features['test-feature'] = 'value'
+        self.app.save(lock=False)
+        app = qubes.Qubes(self.app.store, offline_mode=True)
+        vm2_xml = lxml.etree.tostring(app.domains['test-vm2'].__xml__())
+
+        app = qubes.Qubes(self.app.store, offline_mode=True, lazy=True)
+        app.domains['test-vm1'].memory = 1000
+        app.save(lock=False)
+        self.assertTrue(app.domains['test-vm2'].is_load_deferred())
+
+        app = qubes.Qubes(self.app.store, offline_mode=True)
+        self.assertEqual(app.domains['test-vm1'].memory, 1000)
+        self.assertEqual(lxml.etree.tostring(app.domains['test-vm2'].__xml__()),
+            vm2_xml)
+
+    def test_043_lazy_dependencies(self):
+        self.addCleanup(self.cleanup_store)
+        netvm = self.app.add_new_vm('AppVM', label='red', name='test-net',
+            template='test-template', provides_network=True)
+        self.vm1.netvm = netvm
+        self.app.save(lock=False)
+
+        def dependencies(app):
+            return (
+                [vm.name for vm in app.domains['test-net'].connected_vms],
+                sorted(vm.name for vm in app.domains.get_vms_based_on(
+                    app.domains['test-template'])))
+
+        expected = dependencies(
+            qubes.Qubes(self.app.store, offline_mode=True))
+        self.assertEqual(expected, (['test-vm1'],
+            ['test-net', 'test-vm1', 'test-vm2']))
+
+        app = qubes.Qubes(self.app.store, offline_mode=True, lazy=True)
+        # finishes loading of test-vm1 after the index is built
+        app.domains['test-net'].connected_vms
+        app.domains['test-vm1'].memory
+        self.assertEqual(dependencies(app), expected)
+
+    def cleanup_store(self):
+        for path in (self.app.store,
+                qubes.app.StoreJournal.get_path(self.app.store),
+                qubes.app.StoreCache.get_path(self.app.store)):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class TC_92_PowerStateCache(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = qubes.Qubes('/tmp/qubes-test.xml', load=False)
+        self.app.vmm = qubes.app.VMMConnection(offline_mode=False)
+        self.app.vmm._libvirt_conn = unittest.mock.Mock()
+        self.libvirt_conn = self.app.vmm._libvirt_conn
+        self.libvirt_conn.getInfo.return_value = \
+            ('x86_64', 16000, 4, 2000, 1, 1, 4, 1)
+        self.app.load_initial_values()
+        self.app.default_kernel = '1.0'
+        self.template = self.app.add_new_vm('TemplateVM', label='black',
+            name='test-template')
+        self.app.default_template = 'test-template'
+        self.vm = self.app.add_new_vm('AppVM', label='red', name='test-vm1',
+            template='test-template')
+        self.libvirt_domain = unittest.mock.Mock()
+        self.libvirt_domain.UUID.return_value = self.vm.uuid.bytes
+        self.libvirt_domain.ID.return_value = 3
+        self.libvirt_conn.getAllDomainStats.return_value = [
+            (self.libvirt_domain, {'state.state': libvirt.VIR_DOMAIN_PAUSED}),
+        ]
+
+    def test_000_register(self):
+        self.app.vmm.register_event_handlers(self.app)
+        self.libvirt_conn.domainEventRegisterAny.assert_called_once_with(
+            None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+            self.app.vmm._domain_event_callback, self.app)
+        self.libvirt_conn.getAllDomainStats.assert_called_once_with(
+            libvirt.VIR_DOMAIN_STATS_STATE)
+
+        self.assertTrue(self.vm.is_running())
+        self.assertTrue(self.vm.is_paused())
+        self.assertEqual(self.vm.get_power_state(), 'Paused')
+        self.assertFalse(self.template.is_running())
+        self.assertFalse(self.template.is_paused())
+        self.assertEqual(self.template.get_power_state(), 'Halted')
+        self.assertEqual(self.app.domains.get_power_states(
+            [self.vm, self.template]),
+            {self.vm: 'Paused', self.template: 'Halted'})
+        self.assertFalse(self.libvirt_conn.lookupByUUID.called)
+        self.assertFalse(self.libvirt_domain.isActive.called)
+        self.assertFalse(self.libvirt_domain.state.called)
+        self.assertEqual(self.libvirt_conn.getAllDomainStats.call_count, 1)
+
+    def test_001_event(self):
+        self.app.vmm.register_event_handlers(self.app)
+        self.libvirt_domain.name.return_value = self.vm.name
+        self.libvirt_domain.isActive.return_value = 1
+        self.libvirt_domain.state.return_value = \
+            [libvirt.VIR_DOMAIN_RUNNING, 0]
+        self.app.vmm._domain_event_callback(None, self.libvirt_domain,
+            libvirt.VIR_DOMAIN_EVENT_RESUMED, 0, self.app)
+        self.assertTrue(self.vm.is_running())
+        self.assertFalse(self.vm.is_paused())
+
+        self.libvirt_domain.state.reset_mock()
+        self.assertTrue(self.vm.is_running())
+        self.assertFalse(self.vm.is_paused())
+        self.assertFalse(self.libvirt_domain.state.called)
+
+    def test_002_invalidate_on_action(self):
+        self.app.vmm.register_event_handlers(self.app)
+        self.libvirt_domain.state.return_value = \
+            [libvirt.VIR_DOMAIN_RUNNING, 0]
+        self.vm._libvirt_domain = self.libvirt_domain
+        self.libvirt_domain.call_async.side_effect = \
+            asyncio.coroutine(lambda *args: None)
+        self.loop.run_until_complete(self.vm.unpause())
+        self.libvirt_domain.call_async.assert_called_once_with('resume')
+        # no event yet, ask libvirt
+        self.assertFalse(self.vm.is_paused())
+        self.assertTrue(self.libvirt_domain.state.called)
+
+    def test_003_reconnect(self):
+        self.app.vmm.register_event_handlers(self.app)
+        self.libvirt_conn.getAllDomainStats.return_value = []
+        self.libvirt_conn.domainEventRegisterAny.reset_mock()
+        with unittest.mock.patch.object(self.vm, 'fire_event') as fire_event:
+            self.app.vmm._on_reconnect()
+            fire_event.assert_called_once_with('domain-shutdown')
+        self.assertTrue(self.libvirt_conn.domainEventRegisterAny.called)
+        self.assertFalse(self.vm.is_running())
+        self.assertEqual(self.vm.get_power_state(), 'Halted')
+
+    def test_004_reconnect_callback(self):
+        reconnect_cb = unittest.mock.Mock()
+        with unittest.mock.patch('libvirt.open', create=True) as mock_open:
+            conn = qubes.app.VirConnectWrapper('test:///',
+                reconnect_cb=reconnect_cb)
+            old_conn = mock_open.return_value
+            old_conn.isAlive.return_value = False
+            old_conn.getAllDomainStats.side_effect = libvirt.libvirtError(
+                'connection closed')
+            new_conn = unittest.mock.Mock()
+            mock_open.return_value = new_conn
+            conn.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_STATE)
+        reconnect_cb.assert_called_once_with()
+        new_conn.getAllDomainStats.assert_called_once_with(
+            libvirt.VIR_DOMAIN_STATS_STATE)
+
+
+class TC_93_LibvirtCallAsync(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        with unittest.mock.patch('libvirt.open', create=True) as mock_open:
+            self.conn = qubes.app.VirConnectWrapper('test:///')
+        self.libvirt_conn = mock_open.return_value
+        self.calls = []
+
+    def tearDown(self):
+        # pylint: disable=protected-access
+        if self.conn._executor is not None:
+            self.conn._executor.shutdown()
+        super().tearDown()
+
+    def domain(self, uuid):
+        libvirt_domain = unittest.mock.Mock()
+        libvirt_domain.UUID.return_value = uuid
+        libvirt_domain.destroy.side_effect = \
+            lambda: self.slow_call(uuid, 'destroy')
+        libvirt_domain.resume.side_effect = \
+            lambda: self.slow_call(uuid, 'resume')
+        return qubes.app.VirDomainWrapper(self.conn, libvirt_domain)
+
+    def slow_call(self, uuid, name):
+        self.calls.append((uuid, name, 'start'))
+        time.sleep(0.1)
+        self.calls.append((uuid, name, 'end'))
+        return threading.get_ident()
+
+    def test_000_call_in_thread(self):
+        dom = self.domain(b'1')
+        loop = asyncio.get_event_loop()
+        thread_id = loop.run_until_complete(dom.call_async('destroy'))
+        self.assertNotEqual(thread_id, threading.get_ident())
+        self.assertEqual(self.calls, [
+            (b'1', 'destroy', 'start'), (b'1', 'destroy', 'end')])
+
+    def test_001_serialized_per_domain(self):
+        dom1 = self.domain(b'1')
+        dom2 = self.domain(b'2')
+        loop = asyncio.get_event_loop()
+        # not asyncio.gather(), it does not preserve order of scheduling
+        tasks = [
+            asyncio.ensure_future(dom1.call_async('destroy')),
+            asyncio.ensure_future(dom2.call_async('destroy')),
+            asyncio.ensure_future(dom1.call_async('resume')),
+        ]
+        loop.run_until_complete(asyncio.wait(tasks))
+        self.assertEqual([call for call in self.calls if call[0] == b'1'], [
+            (b'1', 'destroy', 'start'), (b'1', 'destroy', 'end'),
+            (b'1', 'resume', 'start'), (b'1', 'resume', 'end'),
+        ])
+        # the other domain is not waiting for the first one
+        self.assertLess(self.calls.index((b'2', 'destroy', 'start')),
+            self.calls.index((b'1', 'destroy', 'end')))
+
+    def test_002_connection_call(self):
+        self.libvirt_conn.defineXML.return_value = libvirt.virDomain()
+        loop = asyncio.get_event_loop()
+        dom = loop.run_until_complete(
+            self.conn.call_async(b'1', 'defineXML', '<domain/>'))
+        self.libvirt_conn.defineXML.assert_called_once_with('<domain/>')
+        self.assertIsInstance(dom, qubes.app.VirDomainWrapper)
+
+    def test_003_reconnect(self):
+        dom = self.domain(b'1')
+        dom._vm.destroy.side_effect = libvirt.libvirtError('connection closed')
+        dom._vm.connect.return_value.isAlive.return_value = False
+        new_dom = self.libvirt_conn.lookupByUUID.return_value
+        with unittest.mock.patch('libvirt.open', create=True) as mock_open:
+            mock_open.return_value = self.libvirt_conn
+            self.libvirt_conn.isAlive.return_value = False
+            loop = asyncio.get_event_loop()
+            loop.run_until_complete(dom.call_async('destroy'))
+        new_dom.destroy.assert_called_once_with()
@@ -0,0 +1,445 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+'''Benchmarks of :py:class:`qubes.Qubes` with many domains.
+
+This is not part of the test suite, run it directly::
+
+    python3 -m qubes.tests.benchmark --domains 100 1000 5000
+
+Stores are generated in a temporary directory, in offline mode, so this does
+not need (nor touch) a running system. The limit of qids is raised for that,
+to fit more domains than a real system could run. Number of tags, features,
+device assignments and firewall rules of each domain can be set too.
+
+Results are printed as a table, and with ``--json FILE`` also written as JSON
+(``-`` for standard output), to be compared between releases::
+
+    {
+        "parameters": {"domains": [...], "tags": 1, ...},
+        "properties": {"uncached": ..., "cached": ...},
+        "results": [
+            {"domains": 100, "xml": ..., "cache": ..., "lazy": ..., ...},
+            ...
+        ]
+    }
+
+All the times are in seconds.
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import unittest.mock
+
+import qubes
+import qubes.api
+import qubes.api.admin
+import qubes.app
+import qubes.config
+import qubes.devices
+import qubes.firewall
+import qubes.vm.appvm
+
+
+def generate_store(path, domains, tags=1, features=1, devices=0,
+        firewall_rules=0):
+    '''Generate store with a template and *domains* AppVMs based on it.
+
+    All the AppVMs use the same network VM, which is also backend of their
+    block devices.
+
+    :param str path: path of the store to create
+    :param int domains: number of AppVMs
+    :param int tags: number of tags of each AppVM
+    :param int features: number of features of each AppVM
+    :param int devices: number of block device assignments of each AppVM
+    :param int firewall_rules: number of firewall rules of each AppVM
+    '''
+
+    app = qubes.Qubes(path, load=False, offline_mode=True)
+    app.load_initial_values()
+    app.default_kernel = '1.0'
+    app.add_new_vm('TemplateVM', name='bench-template', label='black')
+    app.default_template = 'bench-template'
+    netvm = app.add_new_vm('AppVM', name='bench-netvm', label='red',
+        provides_network=True)
+    app.default_netvm = 'bench-netvm'
+    app.clockvm = 'bench-netvm'
+    app.updatevm = 'bench-netvm'
+    labels = list(app.labels.values())
+    for i in range(domains):
+        vm = app.add_new_vm('AppVM', name='bench-vm{}'.format(i),
+            label=labels[i % len(labels)])
+        for j in range(features):
+            vm.features['service/bench{}'.format(j)] = '1'
+        for j in range(tags):
+            vm.tags.add('bench-tag{}'.format((i + j) % 100))
+        for j in range(devices):
+            vm.devices['block'].attach(qubes.devices.DeviceAssignment(
+                netvm, 'bench{}'.format(j), {'read-only': 'yes'},
+                persistent=True))
+        if firewall_rules:
+            os.makedirs(vm.dir_path, exist_ok=True)
+            vm.firewall.rules = [qubes.firewall.Rule(None, action='accept',
+                    proto='tcp', dsthost='10.0.{}.{}'.format(j // 256,
+                        j % 256), dstports='443')
+                for j in range(firewall_rules)]
+            vm.firewall.save()
+    app.save()
+
+
+def measure(func, repeat):
+    '''Call *func* *repeat* times, return the best time in seconds'''
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_load(path, repeat):
+    '''Time loading the store from XML, from a fresh cache and lazily
+    (including use of a single domain).
+
+    :returns: dict with ``xml``, ``cache`` and ``lazy`` load times, in seconds
+    '''
+
+    cache_path = qubes.app.StoreCache.get_path(path)
+
+    def load(cache):
+        qubes.Qubes(path, offline_mode=True, cache=cache)
+
+    def load_xml():
+        # cache present but disabled, that is the pre-cache load
+        load(False)
+
+    results = {'xml': measure(load_xml, repeat)}
+    # first load with cache enabled writes it
+    load(True)
+    assert os.path.exists(cache_path)
+    results['cache'] = measure(lambda: load(True), repeat)
+
+    def load_lazy():
+        app = qubes.Qubes(path, offline_mode=True, lazy=True)
+        list(app.domains['bench-vm0'].features)
+
+    results['lazy'] = measure(load_lazy, repeat)
+    return results
+
+
+def bench_save(path, repeat):
+    '''Time the first (full) save after loading the store.
+
+    :returns: dict with ``save`` time, in seconds
+    '''
+
+    best = None
+    for _ in range(repeat):
+        app = qubes.Qubes(path, offline_mode=True)
+        elapsed = measure(app.save, 1)
+        if best is None or elapsed < best:
+            best = elapsed
+    return {'save': best}
+
+
+def bench_firewall(app, repeat):
+    '''Time loading firewall rules of all the domains.
+
+    :returns: dict with ``firewall`` time, in seconds
+    '''
+
+    def load():
+        for vm in app.domains:
+            if hasattr(vm, 'firewall'):
+                qubes.firewall.Firewall(vm)
+
+    return {'firewall': measure(load, repeat)}
+
+
+def bench_lookups(app, calls):
+    '''Time lookups in :py:class:`qubes.app.VMCollection`.
+
+    :param int calls: number of lookups of each kind
+    :returns: dict with times of *calls* lookups by ``lookup_name``,
+        ``lookup_qid``, ``lookup_uuid`` and of ``lookup_contains``
+        (``name in app.domains``), in seconds
+    '''
+
+    rand = random.Random(0)
+    # uuid of dom0 is not an uuid.UUID
+    vms = [vm for vm in app.domains if vm.qid != 0]
+    sample = [rand.choice(vms) for _ in range(calls)]
+    names = [vm.name for vm in sample]
+    qids = [vm.qid for vm in sample]
+    uuids = [vm.uuid for vm in sample]
+    domains = app.domains
+
+    def lookup(keys):
+        for key in keys:
+            domains[key]  # pylint: disable=pointless-statement
+
+    def contains():
+        for name in names:
+            assert name in domains
+
+    return {
+        'lookup_name': measure(lambda: lookup(names), 1),
+        'lookup_qid': measure(lambda: lookup(qids), 1),
+        'lookup_uuid': measure(lambda: lookup(uuids), 1),
+        'lookup_contains': measure(contains, 1),
+    }
+
+
+def call_admin_api(app, method, dest, arg=b''):
+    '''Call Admin API *method* as dom0 and return its response'''
+    mgmt = qubes.api.admin.QubesAdminAPI(app, b'dom0', method,
+        dest.encode(), arg)
+    response = asyncio.get_event_loop().run_until_complete(
+        mgmt.execute(untrusted_payload=b''))
+    if isinstance(response, qubes.api.StreamedResponse):
+        response = ''.join(response)
+    return response
+
+
+def bench_admin_api(app, repeat, calls):
+    '''Time Admin API calls, without the transport.
+
+    :param int calls: number of ``admin.vm.property.Get`` calls
+    :returns: dict with times of ``admin.vm.List`` of all the domains
+        (``admin_vm_list``) and of *calls* ``admin.vm.property.Get`` calls
+        (``admin_property_get``), in seconds
+    '''
+
+    rand = random.Random(0)
+    names = [rand.choice(list(app.domains.names())) for _ in range(calls)]
+
+    def property_get():
+        for name in names:
+            call_admin_api(app, b'admin.vm.property.Get', name, b'label')
+
+    return {
+        'admin_vm_list': measure(
+            lambda: call_admin_api(app, b'admin.vm.List', 'dom0'), repeat),
+        'admin_property_get': measure(property_get, 1),
+    }
+
+
+def bench_event_fanout(app, repeat, subscribers=1):
+    '''Time delivering events of all the domains to *subscribers*
+    ``admin.Events`` subscribers of dom0.
+
+    :returns: dict with times of subscribing (``events_subscribe``), firing an
+        event on each domain (``events_fire``), sending them to the
+        subscribers (``events_deliver``) and unsubscribing
+        (``events_unsubscribe``), in seconds
+    '''
+
+    loop = asyncio.get_event_loop()
+    delivered = []
+    vms = list(app.domains)
+    bus = qubes.api.admin.EventBus.for_app(app)
+    bus.queue_size = len(vms)
+    subscribers = [qubes.api.admin.EventSubscriber(bus, None, [],
+            lambda subject, event, **kwargs: delivered.append(event))
+        for _ in range(subscribers)]
+    tasks = []
+
+    def subscribe():
+        for subscriber in subscribers:
+            bus.subscribe(subscriber)
+            tasks.append(asyncio.ensure_future(subscriber.run()))
+
+    def unsubscribe():
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.wait(tasks))
+        for subscriber in subscribers:
+            bus.unsubscribe(subscriber)
+
+    def fire():
+        for vm in vms:
+            vm.fire_event('bench-event')
+
+    def deliver():
+        while any(subscriber.queue for subscriber in subscribers):
+            loop.run_until_complete(asyncio.sleep(0))
+
+    results = {}
+    results['events_subscribe'] = measure(subscribe, 1)
+    results['events_fire'] = results['events_deliver'] = None
+    for _ in range(repeat):
+        fire_time = measure(fire, 1)
+        deliver_time = measure(deliver, 1)
+        results['events_fire'] = min(fire_time,
+            results['events_fire'] or fire_time)
+        results['events_deliver'] = min(deliver_time,
+            results['events_deliver'] or deliver_time)
+    results['events_unsubscribe'] = measure(unsubscribe, 1)
+    assert delivered.count('bench-event') == \
+        len(vms) * repeat * len(subscribers)
+    return results
+
+
+def bench_properties(calls):
+    '''Time property metadata lookups, with and without per-class cache.
+
+    Uncached time is time of building the table of properties of a class,
+    which is what every lookup did before it was cached.
+
+    :param int calls: number of calls to time
+    :returns: dict with ``uncached`` and ``cached`` times of *calls* calls of
+        :py:meth:`qubes.PropertyHolder.property_list` and
+        :py:meth:`qubes.PropertyHolder.property_get_def`, in seconds
+    '''
+
+    cls = qubes.vm.appvm.AppVM
+
+    def uncached():
+        for _ in range(calls):
+            qubes._PropertyTable(cls)  # pylint: disable=protected-access
+
+    def cached():
+        for _ in range(calls):
+            cls.property_list()
+            cls.property_get_def('memory')
+
+    return {'uncached': measure(uncached, 1), 'cached': measure(cached, 1)}
+
+
+#: columns of the table printed: result key, header
+COLUMNS = (
+    ('domains', 'domains'),
+    ('xml', 'xml [s]'),
+    ('cache', 'cache [s]'),
+    ('lazy', 'lazy [s]'),
+    ('save', 'save [s]'),
+    ('firewall', 'firewall [s]'),
+    ('lookup_name', 'by name [s]'),
+    ('admin_vm_list', 'vm.List [s]'),
+    ('admin_property_get', 'prop.Get [s]'),
+    ('events_fire', 'events [s]'),
+    ('events_deliver', 'delivery [s]'),
+)
+
+
+def run(path, domains, args):
+    '''Run all the benchmarks with *domains* domains.
+
+    :returns: dict of results
+    '''
+
+    generate_store(path, domains, tags=args.tags, features=args.features,
+        devices=args.devices, firewall_rules=args.firewall_rules)
+    results = {'domains': domains}
+    results.update(bench_load(path, args.repeat))
+    results.update(bench_save(path, args.repeat))
+
+    app = qubes.Qubes(path, offline_mode=True)
+    results.update(bench_firewall(app, args.repeat))
+    results.update(bench_lookups(app, args.calls))
+    results.update(bench_admin_api(app, args.repeat, args.calls))
+    results.update(bench_event_fanout(app, args.repeat, args.subscribers))
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--domains', metavar='N', type=int, nargs='+',
+        default=[100, 1000, 5000],
+        help='numbers of domains to test with (default: %(default)s)')
+    parser.add_argument('--tags', metavar='N', type=int, default=1,
+        help='number of tags of each domain (default: %(default)s)')
+    parser.add_argument('--features', metavar='N', type=int, default=1,
+        help='number of features of each domain (default: %(default)s)')
+    parser.add_argument('--devices', metavar='N', type=int, default=0,
+        help='number of device assignments of each domain '
+            '(default: %(default)s)')
+    parser.add_argument('--firewall-rules', metavar='N', type=int, default=0,
+        help='number of firewall rules of each domain (default: %(default)s)')
+    parser.add_argument('--repeat', metavar='N', type=int, default=3,
+        help='report the best of N runs (default: %(default)s)')
+    parser.add_argument('--calls', metavar='N', type=int, default=1000,
+        help='number of lookups and property.Get calls to time '
+            '(default: %(default)s)')
+    parser.add_argument('--subscribers', metavar='N', type=int, default=1,
+        help='number of admin.Events subscribers (default: %(default)s)')
+    parser.add_argument('--json', metavar='FILE',
+        help='write results as JSON to FILE (- for standard output)')
+    args = parser.parse_args(args)
+
+    tmpdir = tempfile.mkdtemp(prefix='qubes-benchmark-')
+    base_dir_patch = unittest.mock.patch.dict(qubes.config.system_path,
+        {'qubes_base_dir': tmpdir})
+    max_qid_patch = unittest.mock.patch('qubes.config.max_qid',
+        max(args.domains) + 10)
+    base_dir_patch.start()
+    max_qid_patch.start()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # table goes to stderr when JSON goes to stdout
+    out = sys.stderr if args.json == '-' else sys.stdout
+    report = {
+        'parameters': {key: getattr(args, key) for key in ('domains',
+            'tags', 'features', 'devices', 'firewall_rules', 'repeat',
+            'calls', 'subscribers')},
+        'results': [],
+    }
+    try:
+        report['properties'] = bench_properties(10000)
+        print('property lookups (10000 calls): {:.4f} s uncached, '
+            '{:.4f} s cached'.format(report['properties']['uncached'],
+                report['properties']['cached']), file=out)
+
+        print(' '.join('{:>13}'.format(header) for _, header in COLUMNS),
+            file=out)
+        for domains in args.domains:
+            path = os.path.join(tmpdir, 'qubes-{}.xml'.format(domains))
+            results = run(path, domains, args)
+            report['results'].append(results)
+            print(' '.join('{:>13}'.format(results['domains'])
+                if key == 'domains' else '{:>13.4f}'.format(results[key])
+                for key, _ in COLUMNS), file=out)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+        max_qid_patch.stop()
+        base_dir_patch.stop()
+        shutil.rmtree(tmpdir)
+
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=4, sort_keys=True)
+        sys.stdout.write('\n')
+    elif args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(report, json_file, indent=4, sort_keys=True)
+            json_file.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -19,7 +19,10 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import asyncio
+
 import qubes.events
+import qubes.exc
 import qubes.tests
 
 class TC_00_Emitter(qubes.tests.QubesTestCase):
@@ -135,3 +138,181 @@ class TC_00_Emitter(qubes.tests.QubesTestCase):
                 ['testevent_2', 'testevent_1'])
             self.assertEqual(list(effect2),
                 ['testevent_1'])
+
+    def test_006_handlers_changed(self):
+        class TestEmitter(qubes.events.Emitter):
+            @qubes.events.handler('testevent')
+            def on_testevent_1(self, event):
+                yield 'testevent_1'
+
+        class TestEmitterSub(TestEmitter):
+            pass
+
+        def on_testevent_2(subject, event):
+            yield 'testevent_2'
+
+        def on_testevent_3(subject, event):
+            yield 'testevent_3'
+
+        emitter = TestEmitterSub()
+        emitter.events_enabled = True
+        self.assertEqual(emitter.fire_event('testevent'), ['testevent_1'])
+
+        # like extensions do
+        qubes.events.Emitter.add_handler(TestEmitter, 'testevent',
+            on_testevent_2)
+        self.assertEqual(emitter.fire_event('testevent'),
+            ['testevent_1', 'testevent_2'])
+
+        emitter.add_handler('testevent', on_testevent_3)
+        self.assertEqual(emitter.fire_event('testevent'),
+            ['testevent_1', 'testevent_2', 'testevent_3'])
+        self.assertEqual(emitter.fire_event_pre('testevent'),
+            ['testevent_3', 'testevent_1', 'testevent_2'])
+
+        qubes.events.Emitter.remove_handler(TestEmitter, 'testevent',
+            on_testevent_2)
+        emitter.remove_handler('testevent', on_testevent_3)
+        self.assertEqual(emitter.fire_event('testevent'), ['testevent_1'])
+
+    def test_007_fire_event_async(self):
+        class TestEmitter(qubes.events.Emitter):
+            def __init__(self):
+                # pylint: disable=bad-super-call
+                super(TestEmitter, self).__init__()
+                self.started = asyncio.Future()
+                self.log = []
+
+            @qubes.events.handler('testevent')
+            @asyncio.coroutine
+            def on_testevent_1(self, event):
+                # finishes only if run concurrently with on_testevent_2
+                yield from self.started
+                self.log.append('testevent_1')
+                return ['testevent_1']
+
+            @qubes.events.handler('testevent')
+            @asyncio.coroutine
+            def on_testevent_2(self, event):
+                self.started.set_result(True)
+                yield from asyncio.sleep(0)
+                self.log.append('testevent_2')
+                return ['testevent_2']
+
+            @qubes.events.handler('testevent')
+            def on_testevent_3(self, event):
+                self.log.append('testevent_3')
+                yield 'testevent_3'
+
+        @asyncio.coroutine
+        def on_testevent_4(subject, event):
+            # extension handler, all bound ones have to be finished already
+            subject.log.append('testevent_4')
+            return ['testevent_4']
+
+        emitter = TestEmitter()
+        emitter.add_handler('testevent', on_testevent_4)
+        emitter.events_enabled = True
+
+        effects = self.loop.run_until_complete(asyncio.wait_for(
+            emitter.fire_event_async('testevent'), 5))
+        self.assertCountEqual(effects[:3],
+            ['testevent_1', 'testevent_2', 'testevent_3'])
+        self.assertEqual(effects[3:], ['testevent_4'])
+        self.assertEqual(emitter.log[-1], 'testevent_4')
+
+        with self.assertRaises(qubes.exc.QubesException):
+            emitter.fire_event('testevent')
+
+    def test_008_fire_event_pre_async(self):
+        class TestEmitter(qubes.events.Emitter):
+            @qubes.events.handler('testevent')
+            @asyncio.coroutine
+            def on_testevent_1(self, event):
+                yield from asyncio.sleep(0)
+                return ['testevent_1']
+
+        def on_testevent_2(subject, event):
+            yield 'testevent_2'
+
+        emitter = TestEmitter()
+        emitter.add_handler('testevent', on_testevent_2)
+        emitter.events_enabled = True
+
+        effects = self.loop.run_until_complete(
+            emitter.fire_event_pre_async('testevent'))
+        self.assertEqual(effects, ['testevent_2', 'testevent_1'])
+        effects = self.loop.run_until_complete(
+            emitter.fire_event_async('testevent'))
+        self.assertEqual(effects, ['testevent_1', 'testevent_2'])
+
+    def test_009_fire_event_async_exception(self):
+        class TestEmitter(qubes.events.Emitter):
+            def __init__(self):
+                # pylint: disable=bad-super-call
+                super(TestEmitter, self).__init__()
+                self.finished = False
+
+            @qubes.events.handler('testevent')
+            @asyncio.coroutine
+            def on_testevent_1(self, event):
+                yield from asyncio.sleep(0)
+                raise qubes.exc.QubesException('failed')
+
+            @qubes.events.handler('testevent')
+            @asyncio.coroutine
+            def on_testevent_2(self, event):
+                yield from asyncio.sleep(0.01)
+                self.finished = True
+
+        emitter = TestEmitter()
+        emitter.events_enabled = True
+        with self.assertRaises(qubes.exc.QubesException):
+            self.loop.run_until_complete(
+                emitter.fire_event_async('testevent'))
+        # the other handler in the group is not abandoned
+        self.assertTrue(emitter.finished)
+
+    def test_010_profiling(self):
+        class TestEmitter(qubes.events.Emitter):
+            @qubes.events.handler('testevent')
+            def on_testevent_1(self, event):
+                yield 'testevent_1'
+
+            @qubes.events.handler('testevent-async')
+            @asyncio.coroutine
+            def on_testevent_2(self, event):
+                yield from asyncio.sleep(0)
+                return ['testevent_2']
+
+        emitter = TestEmitter()
+        emitter.events_enabled = True
+        emitter.fire_event('testevent')
+        self.assertIsNone(qubes.events.get_profiler())
+
+        profiler = qubes.events.enable_profiling()
+        self.addCleanup(qubes.events.disable_profiling)
+        self.assertEqual(emitter.fire_event('testevent'), ['testevent_1'])
+        self.assertEqual(emitter.fire_event('testevent'), ['testevent_1'])
+        self.assertEqual(self.loop.run_until_complete(
+            emitter.fire_event_async('testevent-async')), ['testevent_2'])
+
+        self.assertEqual(profiler.events['testevent'].count, 2)
+        self.assertEqual(profiler.handlers[
+            ('testevent', TestEmitter.on_testevent_1)].count, 2)
+        self.assertEqual(sum(profiler.handlers[
+            ('testevent', TestEmitter.on_testevent_1)].histogram), 2)
+        self.assertEqual(profiler.events['testevent-async'].count, 1)
+        self.assertEqual(profiler.handlers[
+            ('testevent-async', TestEmitter.on_testevent_2)].count, 1)
+
+        lines = profiler.format_stats().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].startswith('event testevent count=2 '))
+        self.assertTrue(lines[1].startswith('handler testevent '
+            'qubes.tests.events.TC_00_Emitter.test_010_profiling.<locals>.'
+            'TestEmitter.on_testevent_1 count=2 '))
+        self.assertTrue(lines[2].startswith('event testevent-async count=1 '))
+
+        profiler.clear()
+        self.assertEqual(profiler.format_stats(), '')
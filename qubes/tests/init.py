@@ -281,6 +281,31 @@ class TC_20_PropertyHolder(qubes.tests.QubesTestCase):
         expected_prop3.text = 'testdefault'
         self.assertXMLEqual(elements_with_defaults[2], expected_prop3)
 
+    def test_007_property_list_dynamic(self):
+        class MyTestHolder(TestHolder):
+            pass
+
+        # fill the caches
+        MyTestHolder.property_list()
+        TestHolder.property_list()
+
+        TestHolder.testprop5 = qubes.property('testprop5', order=4)
+        try:
+            self.assertListEqual(
+                [p.__name__ for p in MyTestHolder.property_list()],
+                ['testprop1', 'testprop2', 'testprop3', 'testprop4',
+                    'testprop5'])
+            self.assertIs(MyTestHolder.property_get_def('testprop5'),
+                TestHolder.testprop5)
+        finally:
+            del TestHolder.testprop5
+
+        self.assertListEqual(
+            [p.__name__ for p in MyTestHolder.property_list()],
+            ['testprop1', 'testprop2', 'testprop3', 'testprop4'])
+        with self.assertRaises(AttributeError):
+            MyTestHolder.property_get_def('testprop5')
+
     @unittest.skip('test not implemented')
     def test_010_property_require(self):
         pass
@@ -324,7 +349,7 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
         self.testvm2 = TestVM(None, None, qid=2, name='testvm2')
 
     def test_000_contains(self):
-        self.vms._dict = {1: self.testvm1}
+        self.vms.add(self.testvm1)
 
         self.assertIn(1, self.vms)
         self.assertIn('testvm1', self.vms)
@@ -335,7 +360,7 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
         self.assertNotIn(self.testvm2, self.vms)
 
     def test_001_getitem(self):
-        self.vms._dict = {1: self.testvm1}
+        self.vms.add(self.testvm1)
 
         self.assertIs(self.vms[1], self.testvm1)
         self.assertIs(self.vms['testvm1'], self.testvm1)
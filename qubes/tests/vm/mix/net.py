@@ -47,11 +47,11 @@ class TC_00_NetVMMixin(
             provides_network=True)
         self.nonetvm = qubes.vm.qubesvm.QubesVM(self.app, None, qid=4,
             name=qubes.tests.VMPREFIX + 'nonet')
-        self.app.domains = qubes.app.VMCollection(self.app)
-        for domain in (vm, self.netvm1, self.netvm2, self.nonetvm):
-            self.app.domains._dict[domain.qid] = domain
         self.app.default_netvm = self.netvm1
         self.app.default_fw_netvm = self.netvm1
+        self.app.domains = qubes.app.VMCollection(self.app)
+        for domain in (vm, self.netvm1, self.netvm2, self.nonetvm):
+            self.app.domains.add(domain)
 
 
     @qubes.tests.skipUnlessDom0
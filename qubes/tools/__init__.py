@@ -314,6 +314,10 @@ class QubesArgumentParser(argparse.ArgumentParser):
         ``--force-root`` (optional)
         ``--qubesxml`` location of :file:`qubes.xml` (help is suppressed)
         ``--offline-mode`` do not talk to hypervisor (help is suppressed)
+        ``--store-cache`` load :file:`qubes.xml` through a binary cache \
+            (help is suppressed)
+        ``--lazy`` defer loading of each domain until it is used \
+            (help is suppressed)
         ``--verbose`` and ``--quiet``
     '''
 
@@ -331,6 +335,10 @@ class QubesArgumentParser(argparse.ArgumentParser):
                               dest='app', help=argparse.SUPPRESS)
             self.add_argument('--offline-mode', action='store_true',
                 default=None, dest='offline_mode', help=argparse.SUPPRESS)
+            self.add_argument('--store-cache', action='store_true',
+                default=False, dest='store_cache', help=argparse.SUPPRESS)
+            self.add_argument('--lazy', action='store_true',
+                default=False, dest='lazy', help=argparse.SUPPRESS)
 
 
         self.add_argument('--verbose', '-v', action='count',
@@ -358,7 +366,9 @@ class QubesArgumentParser(argparse.ArgumentParser):
         if self._want_app and not self._want_app_no_instance:
             self.set_qubes_verbosity(namespace)
             namespace.app = qubes.Qubes(namespace.app,
-                offline_mode=namespace.offline_mode)
+                offline_mode=namespace.offline_mode,
+                cache=namespace.store_cache,
+                lazy=namespace.lazy)
 
         if self._want_force_root:
             self.dont_run_as_root(namespace)
@@ -11,6 +11,9 @@ import qubes.api
 import qubes.api.admin
 import qubes.api.internal
 import qubes.api.misc
+import qubes.app
+import qubes.events
+import qubes.exc
 import qubes.utils
 import qubes.vm.qubesvm
 
@@ -20,10 +23,75 @@ def sighandler(loop, signame, servers):
         server.close()
     loop.stop()
 
+def dump_event_stats(app):
+    profiler = qubes.events.get_profiler()
+    if profiler is None:
+        app.log.warning('caught SIGUSR1, but event profiling is not enabled '
+            '(use --profile-events)')
+        return
+    app.log.info('event handler statistics:\n%s', profiler.format_stats())
+
+def write_metrics(loop, app, path, interval):
+    try:
+        qubes.api.write_prometheus(path)
+    except OSError as e:
+        app.log.warning('failed to write metrics to %s: %s', path, e)
+    loop.call_later(interval, write_metrics, loop, app, path, interval)
+
+def load_scheduler_config(app, path):
+    try:
+        qubes.api.scheduler.call_scheduler.load_config(path)
+    except (OSError, qubes.exc.QubesException) as e:
+        app.log.error('failed to load scheduler configuration, '
+            'keeping the previous one: %s', e)
+
 parser = qubes.tools.QubesArgumentParser(description='Qubes OS daemon')
 parser.add_argument('--debug', action='store_true', default=False,
     help='Enable verbose error logging (all exceptions with full '
          'tracebacks) and also send tracebacks to Admin API clients')
+parser.add_argument('--journal', action='store_true', default=False,
+    help='Append changes to a journal next to qubes.xml instead of '
+         'rewriting the whole file on each change')
+parser.add_argument('--save-flush-window', metavar='SECONDS', type=float,
+    default=0.0,
+    help='Delay writing qubes.xml after a change by this many seconds, to '
+         'write changes made in the meantime at once (default: %(default)s, '
+         'which still merges changes made at the same time)')
+parser.add_argument('--profile-events', action='store_true', default=False,
+    help='Collect statistics of event handlers; they are available through '
+         'admin.EventStats call and logged on SIGUSR1')
+parser.add_argument('--events-queue-size', metavar='N', type=int,
+    default=qubes.api.admin.EventBus.queue_size,
+    help='Maximum number of events queued for a single admin.Events client '
+         '(default: %(default)s)')
+parser.add_argument('--events-overflow',
+    choices=qubes.api.admin.EventBus.overflow_policies,
+    default=qubes.api.admin.EventBus.overflow,
+    help='What to do with events for an admin.Events client with full '
+         'queue: drop them, coalesce them with queued events of the same '
+         'qube and name, or disconnect the client (default: %(default)s)')
+parser.add_argument('--events-history-size', metavar='N', type=int,
+    default=qubes.api.admin.EventBus.history_size,
+    help='Number of recent events kept for admin.Events clients resuming '
+         'after reconnection, 0 to disable (default: %(default)s); when '
+         'enabled, all events are recorded after the first admin.Events '
+         'call, even when there are no clients')
+parser.add_argument('--libvirt-workers', metavar='N', type=int,
+    default=qubes.app.VirConnectWrapper.max_workers,
+    help='Number of threads making blocking libvirt calls, like starting '
+         'qubes, in parallel (default: %(default)s)')
+parser.add_argument('--metrics-file', metavar='PATH', nargs='?',
+    const='/var/run/qubes/qubesd.prom',
+    help='Periodically write statistics of API calls (also available '
+         'through admin.Stats call) to this file, for the textfile collector '
+         'of Prometheus node exporter (default path: %(const)s)')
+parser.add_argument('--metrics-interval', metavar='SECONDS', type=float,
+    default=15.0,
+    help='How often to write --metrics-file (default: %(default)s)')
+parser.add_argument('--scheduler-config', metavar='PATH',
+    default='/etc/qubes/qubesd-scheduler.conf',
+    help='Limits of API calls per source qube, see qubes.api.scheduler; '
+         'reloaded on SIGHUP (default: %(default)s)')
 
 def main(args=None):
     loop = asyncio.get_event_loop()
@@ -35,6 +103,16 @@ def main(args=None):
         raise
 
     args.app.vmm.register_event_handlers(args.app)
+    args.app.vmm.libvirt_conn.max_workers = args.libvirt_workers
+    args.app.save_flush_window = args.save_flush_window
+    if args.journal:
+        args.app.enable_journal()
+    if args.profile_events:
+        qubes.events.enable_profiling()
+    event_bus = qubes.api.admin.EventBus.for_app(args.app)
+    event_bus.queue_size = args.events_queue_size
+    event_bus.overflow = args.events_overflow
+    event_bus.history_size = args.events_history_size
 
     servers = loop.run_until_complete(qubes.api.create_servers(
         qubes.api.admin.QubesAdminAPI,
@@ -50,6 +128,13 @@ def main(args=None):
     for signame in ('SIGINT', 'SIGTERM'):
         loop.add_signal_handler(getattr(signal, signame),
             sighandler, loop, signame, servers)
+    loop.add_signal_handler(signal.SIGUSR1, dump_event_stats, args.app)
+    load_scheduler_config(args.app, args.scheduler_config)
+    loop.add_signal_handler(signal.SIGHUP, load_scheduler_config, args.app,
+        args.scheduler_config)
+    if args.metrics_file:
+        write_metrics(loop, args.app, args.metrics_file,
+            args.metrics_interval)
 
     qubes.utils.systemd_notify()
     # make sure children will not inherit this
@@ -59,6 +144,8 @@ def main(args=None):
         loop.run_forever()
         loop.run_until_complete(asyncio.wait([
             server.wait_closed() for server in servers]))
+        # do not lose changes waiting for the flush window
+        args.app.flush_save()
         for sockname in socknames:
             try:
                 os.unlink(sockname)
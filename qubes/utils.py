@@ -21,7 +21,9 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import collections
 import hashlib
+import itertools
 import random
 import string
 import os
@@ -148,8 +150,54 @@ def urandom(size):
     return hashlib.sha512(rand).digest()
 
 
+# entry point registry: group -> name -> list of entry points
+_entry_points = {}
+# entry point -> loaded object
+_loaded_entry_points = {}
+
+
+def iter_entry_points(group, name=None):
+    '''Iterate over entry points in *group*, optionally only named *name*.
+
+    This is :py:func:`pkg_resources.iter_entry_points`, except that installed
+    distributions are scanned only once per group and the result is kept for
+    the whole process. See :py:func:`clear_entry_points_cache`.
+    '''
+
+    try:
+        by_name = _entry_points[group]
+    except KeyError:
+        by_name = collections.OrderedDict()
+        for ep in pkg_resources.iter_entry_points(group):
+            by_name.setdefault(ep.name, []).append(ep)
+        _entry_points[group] = by_name
+
+    if name is None:
+        return itertools.chain.from_iterable(list(by_name.values()))
+    return iter(list(by_name.get(name, ())))
+
+
+def load_entry_point(ep):
+    '''Load object pointed by an entry point, only once per process'''
+    try:
+        return _loaded_entry_points[ep]
+    except KeyError:
+        obj = _loaded_entry_points[ep] = ep.load()
+        return obj
+
+
+def clear_entry_points_cache():
+    '''Forget all the entry points found by :py:func:`iter_entry_points`.
+
+    Needed only when set of installed distributions changes, while the
+    process is running.
+    '''
+    _entry_points.clear()
+    _loaded_entry_points.clear()
+
+
 def get_entry_point_one(group, name):
-    epoints = tuple(pkg_resources.iter_entry_points(group, name))
+    epoints = tuple(iter_entry_points(group, name))
     if not epoints:
         raise KeyError(name)
     elif len(epoints) > 1:
@@ -157,7 +205,7 @@ def get_entry_point_one(group, name):
             'more than 1 implementation of {!r} found: {}'.format(name,
                 ', '.join('{}.{}'.format(ep.module_name, '.'.join(ep.attrs))
                     for ep in epoints)))
-    return epoints[0].load()
+    return load_entry_point(epoints[0])
 
 
 def random_string(length=5):
@@ -25,6 +25,7 @@
 
 '''
 
+import asyncio
 import datetime
 import os
 import re
@@ -264,6 +265,28 @@ class BaseVM(qubes.PropertyHolder):
     '''
     # pylint: disable=no-member
 
+    #: prefixes of events, after which XML representation of the domain needs
+    #: to be regenerated
+    xml_invalidating_events = (
+        'property-set:',
+        'property-del:',
+        'clone-properties',
+        'domain-feature-set',
+        'domain-feature-delete',
+        'domain-tag-add',
+        'domain-tag-delete',
+        'device-attach:',
+        'device-detach:',
+    )
+
+    #: properties loaded even when loading of the domain is deferred by
+    #: :py:meth:`defer_load`, as they are needed to find the domain
+    identity_properties = ('qid', 'name', 'uuid')
+
+    #: attributes not available before finishing loading deferred by
+    #: :py:meth:`defer_load`
+    deferred_attributes = ('features', 'devices', 'tags', 'volumes', 'storage')
+
     def __init__(self, app, xml, features=None, devices=None, tags=None,
             **kwargs):
         # pylint: disable=redefined-outer-name
@@ -273,6 +296,10 @@ class BaseVM(qubes.PropertyHolder):
         #: mother :py:class:`qubes.Qubes` object
         self.app = app
 
+        # XML representation built by last call to xml_fragment(), or None
+        # if the domain was changed since then
+        self._xml_fragment = None
+
         super(BaseVM, self).__init__(xml, **kwargs)
 
         #: dictionary of features of this qube
@@ -324,6 +351,84 @@ class BaseVM(qubes.PropertyHolder):
 
         # SEE:1815 firewall, policy.
 
+    def defer_load(self):
+        '''Load only :py:attr:`identity_properties` from :file:`qubes.xml`
+        and postpone loading the rest of this domain.
+
+        Used by :py:meth:`qubes.Qubes.load` in lazy mode, instead of stages 2
+        and 4. Remaining properties, features, devices and tags are loaded and
+        ``domain-load`` is fired by :py:meth:`finish_load`, which is called on
+        first access to anything not loaded yet and before firing any event
+        on this domain.
+        '''
+
+        self._load_properties_named(self.identity_properties)
+        self._deferred_load = {name: self.__dict__.pop(name)
+            for name in self.deferred_attributes}
+        # nothing changed since loading, so the element can be saved as is
+        self._xml_fragment = self.xml
+
+    def is_load_deferred(self):
+        '''Check whether loading was deferred and is not finished yet'''
+        return '_deferred_load' in self.__dict__
+
+    def finish_load(self):
+        '''Finish loading deferred by :py:meth:`defer_load`, if it was.'''
+
+        deferred = self.__dict__.pop('_deferred_load', None)
+        if deferred is None:
+            return
+        self.__dict__.update(deferred)
+        self._load_properties_named(set(
+            prop.__name__ for prop in self.property_list(load_stage=2)
+            if prop.__name__ not in self.identity_properties))
+        self.load_properties(load_stage=4)
+        self.load_extras()
+        # the properties were set with events disabled, and this domain may
+        # have got into the reverse dependency index while half loaded
+        self.app.domains.update_dependencies(self)
+        self.events_enabled = True
+        self.fire_event('domain-load')
+
+    def _load_properties_named(self, names):
+        for node in self.xml.xpath('./properties/property'):
+            name = node.get('name')
+            if name in names:
+                setattr(self, name, node.get('ref') or node.text)
+
+    def __getattr__(self, name):
+        # called only for attributes not found otherwise, which includes
+        # unset properties and ones not loaded yet
+        if name.startswith('__') or not self.is_load_deferred():
+            raise AttributeError('{!r} object has no attribute {!r}'.format(
+                self.__class__.__name__, name))
+        self.finish_load()
+        return getattr(self, name)
+
+    def fire_event(self, event, **kwargs):
+        if self.is_load_deferred():
+            self.finish_load()
+        return super(BaseVM, self).fire_event(event, **kwargs)
+
+    def fire_event_pre(self, event, **kwargs):
+        if self.is_load_deferred():
+            self.finish_load()
+        return super(BaseVM, self).fire_event_pre(event, **kwargs)
+
+    @asyncio.coroutine
+    def fire_event_async(self, event, **kwargs):
+        if self.is_load_deferred():
+            self.finish_load()
+        return (yield from super(BaseVM, self).fire_event_async(
+            event, **kwargs))
+
+    @asyncio.coroutine
+    def fire_event_pre_async(self, event, **kwargs):
+        if self.is_load_deferred():
+            self.finish_load()
+        return (yield from super(BaseVM, self).fire_event_pre_async(
+            event, **kwargs))
+
     def init_log(self):
         '''Initialise logger for this domain.'''
         self.log = qubes.log.get_vm_logger(self.name)
@@ -365,6 +470,37 @@ class BaseVM(qubes.PropertyHolder):
 
         return element
 
+    def xml_fragment(self):
+        '''Return XML representation of this domain for :file:`qubes.xml`.
+
+        Unlike :py:meth:`__xml__`, the element is cached and rebuilt only
+        after the domain was changed (see :py:attr:`xml_invalidating_events`
+        and :py:meth:`invalidate_xml`). Returned element is reused, so when
+        appended to another tree, it is moved out of the previous one.
+
+        :rtype: lxml.etree._Element
+        '''
+
+        if self._xml_fragment is None:
+            self._xml_fragment = self.__xml__()
+        return self._xml_fragment
+
+    def invalidate_xml(self):
+        '''Drop cached XML representation of this domain.
+
+        Needed only after changing state saved in :file:`qubes.xml` without
+        firing any of :py:attr:`xml_invalidating_events`.
+        '''
+
+        self._xml_fragment = None
+
+    @qubes.events.handler('*')
+    def on_event_invalidate_xml(self, event, **kwargs):
+        '''Drop cached XML representation after relevant change'''
+        # pylint: disable=unused-argument
+        if event.startswith(self.xml_invalidating_events):
+            self._xml_fragment = None
+
     def __repr__(self):
         proprepr = []
         for prop in self.property_list():
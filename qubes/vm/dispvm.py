@@ -136,11 +136,16 @@ class DispVM(qubes.vm.qubesvm.QubesVM):
                 'Refusing to start DispVM out of this AppVM, because '
                 'dispvm_allowed=False')
         app = appvm.app
-        dispvm = app.add_new_vm(
-            cls,
-            dispid=app.domains.get_new_unused_dispid(),
-            template=app.domains[appvm],
-            **kwargs)
+        dispid = app.domains.get_new_unused_dispid()
+        try:
+            dispvm = app.add_new_vm(
+                cls,
+                dispid=dispid,
+                template=app.domains[appvm],
+                **kwargs)
+        finally:
+            # no-op if the VM was added
+            app.domains.release_dispid(dispid)
         # exclude template
         proplist = [prop for prop in dispvm.property_list()
             if prop.clone and prop.__name__ not in ['template']]
@@ -23,6 +23,7 @@
 
 ''' This module contains the NetVMMixin '''
 
+import asyncio
 import os
 import re
 
@@ -165,9 +166,8 @@ class NetVMMixin(qubes.events.Emitter):
         ''' Return a generator containing all domains connected to the current
             NetVM.
         '''
-        for vm in self.app.domains:
-            if getattr(vm, 'netvm', None) is self:
-                yield vm
+        for vm in sorted(self.app.domains.get_dependents('netvm', self)):
+            yield vm
 
     #
     # used in both
@@ -189,32 +189,41 @@ class NetVMMixin(qubes.events.Emitter):
         super(NetVMMixin, self).__init__(*args, **kwargs)
 
     @qubes.events.handler('domain-start')
+    @asyncio.coroutine
     def on_domain_started(self, event, **kwargs):
         '''Connect this domain to its downstream domains. Also reload firewall
         in its netvm.
 
         This is needed when starting netvm *after* its connected domains.
+        Downstream domains are reconnected concurrently, so one slow domain
+        does not delay the others.
         '''  # pylint: disable=unused-argument
 
         if self.netvm:
             self.netvm.reload_firewall_for_vm(self)  # pylint: disable=no-member
 
-        for vm in self.connected_vms:
-            if not vm.is_running():
-                continue
-            vm.log.info('Attaching network')
-
-            try:
-                # 1426
-                vm.run('modprobe -r xen-netfront xennet',
-                    user='root', wait=True)
-            except:  # pylint: disable=bare-except
-                pass
-
-            try:
-                vm.attach_network()
-            except qubes.exc.QubesException:
-                vm.log.warning('Cannot attach network', exc_info=1)
+        connected_vms = [vm for vm in self.connected_vms if vm.is_running()]
+        if connected_vms:
+            yield from asyncio.gather(*(self._reattach_network(vm)
+                for vm in connected_vms))
+
+    @staticmethod
+    @asyncio.coroutine
+    def _reattach_network(vm):
+        '''Attach network of running domain *vm* again'''
+        vm.log.info('Attaching network')
+
+        try:
+            # 1426
+            yield from vm.run_for_stdio('modprobe -r xen-netfront xennet',
+                user='root')
+        except Exception:  # pylint: disable=broad-except
+            pass
+
+        try:
+            vm.attach_network()
+        except qubes.exc.QubesException:
+            vm.log.warning('Cannot attach network', exc_info=1)
 
     @qubes.events.handler('domain-pre-shutdown')
     def shutdown_net(self, event, force=False):
@@ -24,6 +24,7 @@
 from __future__ import absolute_import
 
 import asyncio
+import contextlib
 import copy
 import base64
 import datetime
@@ -156,7 +157,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
         .. event:: domain-spawn (subject, event, start_guid)
 
-            Fired after creating libvirt domain.
+            Fired after creating libvirt domain. Handlers may be
+            coroutines.
 
             :param subject: Event emitter (the qube object)
             :param event: Event name (``'domain-spawn'``)
@@ -165,7 +167,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
         .. event:: domain-start (subject, event, start_guid)
 
-            Fired at the end of :py:meth:`start` method.
+            Fired at the end of :py:meth:`start` method. Handlers may be
+            coroutines.
 
             :param subject: Event emitter (the qube object)
             :param event: Event name (``'domain-start'``)
@@ -300,6 +303,16 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             :param event: Event name (``'domain-tag-delete'``)
             :param tag: tag name
 
+        .. event:: domain-volume-config-changed (subject, event)
+
+            Configuration of the domain's volumes (as saved in
+            :file:`qubes.xml`) may have changed. Fired by
+            :py:class:`qubes.storage.Storage` after operations on the
+            volumes, like resize or revert.
+
+            :param subject: Event emitter (the qube object)
+            :param event: Event name (``'domain-volume-config-changed'``)
+
         .. event:: feature-request (subject, event, *, untrusted_features)
 
             The domain is performing a feature request.
@@ -352,6 +365,10 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
     #: directory in which domains of this class will reside
     dir_path_prefix = qubes.config.system_path['qubes_appvms_dir']
 
+    xml_invalidating_events = qubes.vm.BaseVM.xml_invalidating_events + (
+        'domain-volume-config-changed',
+    )
+
     #
     # properties loaded from XML
     #
@@ -653,6 +670,9 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         # Init private attrs
 
         self._libvirt_domain = None
+        #: cached tuple (is active, libvirt state) of the domain, kept up to
+        #: date by libvirt events in qubesd; :py:obj:`None` when unknown
+        self._libvirt_state = None
         self._qdb_connection = None
 
         if xml is None:
@@ -696,13 +716,21 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         element = super(QubesVM, self).__xml__()
 
         if hasattr(self, 'volumes'):
-            volume_config_node = lxml.etree.Element('volume-config')
-            for volume in self.volumes.values():
-                volume_config_node.append(volume.__xml__())
-            element.append(volume_config_node)
+            element.append(self.xml_volume_config())
 
         return element
 
+    def xml_volume_config(self):
+        '''Serialise configuration of domain's volumes
+
+        :rtype: lxml.etree._Element
+        '''
+
+        volume_config_node = lxml.etree.Element('volume-config')
+        for volume in self.volumes.values():
+            volume_config_node.append(volume.__xml__())
+        return volume_config_node
+
     #
     # event handlers
     #
@@ -786,6 +814,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         if self._libvirt_domain is not None:
             self.libvirt_domain.undefine()
             self._libvirt_domain = None
+            self._libvirt_state = None
         if self._qdb_connection is not None:
             self._qdb_connection.close()
             self._qdb_connection = None
@@ -864,16 +893,18 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
             try:
                 yield from self.storage.start()
-                self._update_libvirt_domain()
+                yield from self._update_libvirt_domain_async()
 
-                self.libvirt_domain.createWithFlags(
+                # the state changes sooner than libvirt event arrives
+                self._libvirt_state = None
+                yield from self.libvirt_domain.call_async('createWithFlags',
                     libvirt.VIR_DOMAIN_START_PAUSED)
             finally:
                 if qmemman_client:
                     qmemman_client.close()
 
             try:
-                self.fire_event('domain-spawn',
+                yield from self.fire_event_async('domain-spawn',
                     start_guid=start_guid)
 
                 self.log.info('Setting Qubes DB info for the VM')
@@ -881,7 +912,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
                 self.create_qdb_entries()
 
                 self.log.warning('Activating the {} VM'.format(self.name))
-                self.libvirt_domain.resume()
+                self._libvirt_state = None
+                yield from self.libvirt_domain.call_async('resume')
 
                 # close() is not really needed, because the descriptor is
                 # close-on-exec anyway, the reason to postpone close() is that
@@ -894,7 +926,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
                 yield from self.start_qrexec_daemon()
 
-                self.fire_event('domain-start', start_guid=start_guid)
+                yield from self.fire_event_async('domain-start',
+                    start_guid=start_guid)
 
             except:  # pylint: disable=bare-except
                 if self.is_running() or self.is_paused():
@@ -937,7 +970,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
         self.fire_event_pre('domain-pre-shutdown', force=force)
 
-        self.libvirt_domain.shutdown()
+        self._libvirt_state = None
+        yield from self.libvirt_domain.call_async('shutdown')
 
         while wait and not self.is_halted():
             yield from asyncio.sleep(0.25)
@@ -955,7 +989,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         if not self.is_running() and not self.is_paused():
             raise qubes.exc.QubesVMNotStartedError(self)
 
-        self.libvirt_domain.destroy()
+        self._libvirt_state = None
+        yield from self.libvirt_domain.call_async('destroy')
 
         return self
 
@@ -979,10 +1014,12 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
         if list(self.devices['pci'].attached()):
             yield from self.run_service_for_stdio('qubes.SuspendPre')
-            self.libvirt_domain.pMSuspendForDuration(
+            self._libvirt_state = None
+            yield from self.libvirt_domain.call_async('pMSuspendForDuration',
                 libvirt.VIR_NODE_SUSPEND_TARGET_MEM, 0, 0)
         else:
-            self.libvirt_domain.suspend()
+            self._libvirt_state = None
+            yield from self.libvirt_domain.call_async('suspend')
 
         return self
 
@@ -993,7 +1030,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         if not self.is_running():
             raise qubes.exc.QubesVMNotRunningError(self)
 
-        self.libvirt_domain.suspend()
+        self._libvirt_state = None
+        yield from self.libvirt_domain.call_async('suspend')
 
         return self
 
@@ -1007,7 +1045,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
         # pylint: disable=not-an-iterable
         if self.get_power_state() == "Suspended":
-            self.libvirt_domain.pMWakeup()
+            self._libvirt_state = None
+            yield from self.libvirt_domain.call_async('pMWakeup')
             yield from self.run_service_for_stdio('qubes.SuspendPost')
         else:
             yield from self.unpause()
@@ -1020,7 +1059,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         if not self.is_paused():
             raise qubes.exc.QubesVMNotPausedError(self)
 
-        self.libvirt_domain.resume()
+        self._libvirt_state = None
+        yield from self.libvirt_domain.call_async('resume')
 
         return self
 
@@ -1481,6 +1521,11 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         # device) extension while constructing libvirt XML
         if self.app.vmm.offline_mode:
             return 'Halted'
+        if self._libvirt_state is not None:
+            is_active, state = self._libvirt_state
+            if is_active:
+                return self._power_state_of_active(state)
+            return 'Halted'
         if self._libvirt_domain is None:
             try:
                 self._libvirt_domain = self.app.vmm.libvirt_conn.lookupByUUID(
@@ -1497,22 +1542,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
         try:
             if libvirt_domain.isActive():
-                # pylint: disable=line-too-long
-                if libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_PAUSED:
-                    return "Paused"
-                elif libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_CRASHED:
-                    return "Crashed"
-                elif libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_SHUTDOWN:
-                    return "Halting"
-                elif libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_SHUTOFF:
-                    return "Dying"
-                elif libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_PMSUSPENDED:  # nopep8
-                    return "Suspended"
-                else:
-                    if not self.is_fully_usable():
-                        return "Transient"
-
-                    return "Running"
+                return self._power_state_of_active(libvirt_domain.state()[0])
 
             return 'Halted'
         except libvirt.libvirtError as e:
@@ -1522,6 +1552,28 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
         assert False
 
+    def _power_state_of_active(self, state):
+        '''Power state of active domain, which is in libvirt *state*
+
+        .. seealso::
+           :py:meth:`get_power_state`
+        '''  # pylint: disable=too-many-return-statements
+
+        if state == libvirt.VIR_DOMAIN_PAUSED:
+            return "Paused"
+        elif state == libvirt.VIR_DOMAIN_CRASHED:
+            return "Crashed"
+        elif state == libvirt.VIR_DOMAIN_SHUTDOWN:
+            return "Halting"
+        elif state == libvirt.VIR_DOMAIN_SHUTOFF:
+            return "Dying"
+        elif state == libvirt.VIR_DOMAIN_PMSUSPENDED:
+            return "Suspended"
+        elif not self.is_fully_usable():
+            return "Transient"
+
+        return "Running"
+
     def is_halted(self):
         ''' Check whether this domain's state is 'Halted'
             :returns: :py:obj:`True` if this domain is halted, \
@@ -1540,6 +1592,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
         if self.app.vmm.offline_mode:
             return False
+        if self._libvirt_state is not None:
+            return self._libvirt_state[0]
 
         # don't try to define libvirt domain, if it isn't there, VM surely
         # isn't running
@@ -1565,9 +1619,29 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         :rtype: bool
         '''
 
+        if self._libvirt_state is not None:
+            return self._libvirt_state[1] == libvirt.VIR_DOMAIN_PAUSED
         return self.libvirt_domain \
             and self.libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_PAUSED
 
+    def _refresh_libvirt_state(self):
+        '''Refresh cached state of this domain from libvirt.
+
+        This is called on libvirt events, only then the cache is kept up to
+        date (see :py:meth:`qubes.app.VMMConnection.register_event_handlers`).
+        '''
+        self._libvirt_state = None
+        try:
+            if self._libvirt_domain is None:
+                self._libvirt_domain = self.app.vmm.libvirt_conn.lookupByUUID(
+                    self.uuid.bytes)
+            self._libvirt_state = (bool(self._libvirt_domain.isActive()),
+                self._libvirt_domain.state()[0])
+        except libvirt.libvirtError as e:
+            if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                raise
+            self._libvirt_state = (False, libvirt.VIR_DOMAIN_SHUTOFF)
+
     def is_qrexec_running(self):
         '''Check whether qrexec for this domain is available.
 
@@ -1844,9 +1918,27 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
     def _update_libvirt_domain(self):
         '''Re-initialise :py:attr:`libvirt_domain`.'''
         domain_config = self.create_config_file()
-        try:
+        with self._define_errors():
             self._libvirt_domain = self.app.vmm.libvirt_conn.defineXML(
                 domain_config)
+
+    @asyncio.coroutine
+    def _update_libvirt_domain_async(self):
+        '''Re-initialise :py:attr:`libvirt_domain`, without blocking the
+        event loop.
+
+        This method is a coroutine.
+        '''
+        domain_config = self.create_config_file()
+        with self._define_errors():
+            self._libvirt_domain = \
+                yield from self.app.vmm.libvirt_conn.call_async(
+                    self.uuid.bytes, 'defineXML', domain_config)
+
+    @contextlib.contextmanager
+    def _define_errors(self):
+        try:
+            yield
         except libvirt.libvirtError as e:
             if e.get_error_code() == libvirt.VIR_ERR_OS_TYPE \
                     and e.get_str2() == 'hvm':
@@ -26,6 +26,7 @@ import json
 import os
 import os.path
 import socket
+import struct
 import subprocess
 
 # don't import 'qubes.config' please, it takes 0.3s
@@ -616,6 +617,10 @@ def qubesd_call(dest, method, arg=None, payload=None):
     client_socket.shutdown(socket.SHUT_WR)
 
     return_data = client_socket.makefile('rb').read()
+    return _parse_qubesd_response(return_data)
+
+
+def _parse_qubesd_response(return_data):
     if return_data.startswith(b'0\x00'):
         return return_data[2:]
     elif return_data.startswith(b'2\x00'):
@@ -627,6 +632,90 @@ def qubesd_call(dest, method, arg=None, payload=None):
             'invalid qubesd response: {!r}'.format(return_data))
 
 
+class QubesdConnection(object):
+    '''Connection to qubesd, reused for many calls.
+
+    This uses the pipelined framing of qubesd protocol (see
+    :py:class:`qubes.api.QubesDaemonProtocol`), so next request can be sent
+    before receiving reply to the previous one::
+
+        with QubesdConnection() as conn:
+            request_ids = [conn.send_request(vm, 'internal.vm.Start')
+                for vm in vms]
+            for request_id in request_ids:
+                conn.get_response(request_id)
+    '''
+    magic = b'\xffqubesd'
+    version = 1
+    frame_header = struct.Struct('!II')
+
+    def __init__(self, path=QUBESD_INTERNAL_SOCK):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.file = self.socket.makefile('rb')
+        preamble = self.magic + bytes([self.version])
+        self.socket.sendall(preamble)
+        if self.file.read(len(preamble)) != preamble:
+            self.close()
+            raise AssertionError('qubesd does not support pipelined calls')
+        self.next_request_id = 0
+        #: data of replies being received, by request id
+        self.pending = {}
+        #: complete replies not retrieved yet, by request id
+        self.replies = {}
+
+    def send_request(self, dest, method, arg=None, payload=None):
+        '''Send a request, without waiting for the reply.
+
+        :returns: request id, to be passed to :py:meth:`get_response`
+        '''
+        request = b'\0'.join(call_arg.encode('ascii') if call_arg else b''
+            for call_arg in ('dom0', method, dest, arg))
+        request += b'\0' + (payload or b'')
+        request_id = self.next_request_id
+        self.next_request_id = (self.next_request_id + 1) % 2**32
+        self.pending[request_id] = []
+        self.socket.sendall(
+            self.frame_header.pack(request_id, len(request)) + request)
+        return request_id
+
+    def get_response(self, request_id):
+        '''Wait for reply to the request, the same as
+        :py:func:`qubesd_call` would return'''
+        while request_id not in self.replies:
+            self._read_frame()
+        return _parse_qubesd_response(self.replies.pop(request_id))
+
+    def call(self, dest, method, arg=None, payload=None):
+        '''Call qubesd and wait for the reply, see :py:func:`qubesd_call`'''
+        return self.get_response(
+            self.send_request(dest, method, arg, payload))
+
+    def _read_frame(self):
+        header = self.file.read(self.frame_header.size)
+        if len(header) < self.frame_header.size:
+            raise AssertionError('qubesd closed the connection')
+        request_id, length = self.frame_header.unpack(header)
+        if length:
+            data = self.file.read(length)
+            if len(data) < length:
+                raise AssertionError('qubesd closed the connection')
+            self.pending[request_id].append(data)
+        else:
+            self.replies[request_id] = b''.join(
+                self.pending.pop(request_id))
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 def get_system_info():
     ''' Get system information
 
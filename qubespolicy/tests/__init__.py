@@ -763,3 +763,47 @@ class TC_30_Misc(qubes.tests.QubesTestCase):
             unittest.mock.call().makefile().read(),
         ])
 
+
+    @unittest.mock.patch('socket.socket')
+    def test_010_qubesd_connection(self, mock_socket):
+        header = qubespolicy.QubesdConnection.frame_header
+        mock_config = {
+            'return_value.makefile.return_value.read.side_effect': [
+                b'\xffqubesd\x01',
+                # replies in different order than requests
+                header.pack(1, 9), b'2\x00SomeErr',
+                header.pack(0, 5), b'0\x00dat',
+                header.pack(1, 14), b'or\x00traceback\x00\x00',
+                header.pack(0, 0),
+                header.pack(1, 0),
+            ]
+        }
+        mock_socket.configure_mock(**mock_config)
+        with qubespolicy.QubesdConnection() as conn:
+            request1 = conn.send_request('test', 'method')
+            request2 = conn.send_request('test', 'method2', 'arg', b'payload')
+            with self.assertRaises(qubespolicy.QubesMgmtException) as e:
+                conn.get_response(request2)
+            self.assertEqual(e.exception.exc_type, 'SomeError')
+            self.assertEqual(conn.get_response(request1), b'dat')
+        self.assertEqual(mock_socket.mock_calls, [
+            unittest.mock.call(socket.AF_UNIX, socket.SOCK_STREAM),
+            unittest.mock.call().connect(qubespolicy.QUBESD_INTERNAL_SOCK),
+            unittest.mock.call().makefile('rb'),
+            unittest.mock.call().sendall(b'\xffqubesd\x01'),
+            unittest.mock.call().makefile().read(8),
+            unittest.mock.call().sendall(
+                header.pack(0, 18) + b'dom0\x00method\x00test\x00\x00'),
+            unittest.mock.call().sendall(header.pack(1, 29) +
+                b'dom0\x00method2\x00test\x00arg\x00payload'),
+            unittest.mock.call().makefile().read(8),
+            unittest.mock.call().makefile().read(9),
+            unittest.mock.call().makefile().read(8),
+            unittest.mock.call().makefile().read(5),
+            unittest.mock.call().makefile().read(8),
+            unittest.mock.call().makefile().read(14),
+            unittest.mock.call().makefile().read(8),
+            unittest.mock.call().makefile().read(8),
+            unittest.mock.call().makefile().close(),
+            unittest.mock.call().close(),
+        ])
@@ -244,6 +244,7 @@ fi
 %{python3_sitelib}/qubes/api/admin.py
 %{python3_sitelib}/qubes/api/internal.py
 %{python3_sitelib}/qubes/api/misc.py
+%{python3_sitelib}/qubes/api/scheduler.py
 
 %dir %{python3_sitelib}/qubes/vm
 %dir %{python3_sitelib}/qubes/vm/__pycache__
@@ -304,6 +305,7 @@ fi
 %{python3_sitelib}/qubes/tests/api_admin.py
 %{python3_sitelib}/qubes/tests/api_misc.py
 %{python3_sitelib}/qubes/tests/app.py
+%{python3_sitelib}/qubes/tests/benchmark.py
 %{python3_sitelib}/qubes/tests/devices.py
 %{python3_sitelib}/qubes/tests/devices_block.py
 %{python3_sitelib}/qubes/tests/events.py
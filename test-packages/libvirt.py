@@ -11,6 +11,9 @@ added as needed.
 class libvirtError(Exception):
     pass
 
+class virDomain(object):
+    pass
+
 def openReadOnly(*args, **kwargs):
     raise libvirtError('mock module, always raises')
 
@@ -21,3 +24,11 @@ VIR_DOMAIN_SHUTDOWN = 4
 VIR_DOMAIN_SHUTOFF = 5
 VIR_DOMAIN_CRASHED = 6
 VIR_DOMAIN_PMSUSPENDED = 7
+
+VIR_DOMAIN_STATS_STATE = 1
+
+VIR_DOMAIN_EVENT_ID_LIFECYCLE = 0
+VIR_DOMAIN_EVENT_STARTED = 2
+VIR_DOMAIN_EVENT_SUSPENDED = 3
+VIR_DOMAIN_EVENT_RESUMED = 4
+VIR_DOMAIN_EVENT_STOPPED = 5